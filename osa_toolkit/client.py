@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Client for the inventory server.
+
+This module only uses the standard library, so that asking a running
+inventory server for the inventory avoids importing the generator.
+"""
+
+import os
+import socket
+
+
+SOCKET_ENV_VAR = 'OSA_INVENTORY_SOCKET'
+SOCKET_FILENAME = 'openstack_inventory.sock'
+DEFAULT_CONFIG_DIR = os.path.join('/etc', 'openstack_deploy')
+
+
+class ServerUnavailable(Exception):
+    pass
+
+
+class ServerError(Exception):
+    pass
+
+
+class ServerMismatch(ServerUnavailable):
+    """The server serves another configuration or environment"""
+
+
+def socket_path(config=None):
+    """Return the path of the inventory server socket for a configuration
+
+    The ``OSA_INVENTORY_SOCKET`` environment variable takes precedence over
+    the socket kept in the configuration directory.
+
+    :param config: ``str`` Directory from which configs are pulled
+    """
+    path = os.environ.get(SOCKET_ENV_VAR)
+    if path:
+        return path
+    return os.path.join(os.path.expanduser(config or DEFAULT_CONFIG_DIR),
+                        SOCKET_FILENAME)
+
+
+def request(command, path, config=None, environment=None):
+    """Send a command to the inventory server and return its reply
+
+    The command line is followed by one ``<name> <path>`` line for each of
+    the configuration and environment directories given, and an empty line.
+    The server refuses requests for directories it does not serve.
+
+    :param command: ``str`` Command line, e.g. ``list`` or ``host aio1``
+    :param path: ``str`` Path of the server socket
+    :param config: ``str`` Directory from which configs are pulled, checked
+        against the server's if given
+    :param environment: ``str`` Directory containing the base env.d,
+        checked against the server's if given
+    :returns: ``str`` Body of the reply
+    :raises: ServerUnavailable, ServerMismatch, ServerError
+    """
+    if not os.path.exists(path):
+        raise ServerUnavailable(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error:
+            raise ServerUnavailable(path)
+        lines = [command]
+        for name, value in (('config', config),
+                            ('environment', environment)):
+            if value is not None:
+                lines.append('{} {}'.format(name, value))
+        sock.sendall('{}\n\n'.format('\n'.join(lines)).encode('utf-8'))
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+
+    status, _, body = b''.join(chunks).partition(b'\n')
+    body = body.decode('utf-8')
+    if status == b'mismatch':
+        raise ServerMismatch(body)
+    if status != b'ok':
+        raise ServerError(body)
+    return body
@@ -36,9 +36,79 @@ def merge_dict(base_items, new_items):
     return base_items
 
 
+class OrderedSet(list):
+    """List of unique items with constant time membership tests.
+
+    Items keep their insertion order and, being a ``list``, serialise to
+    JSON exactly like the plain lists used for group members. Adding an
+    item which is already present does nothing.
+    """
+    def __init__(self, items=()):
+        super(OrderedSet, self).__init__()
+        self._members = set()
+        self.extend(items)
+
+    def __reduce__(self):
+        # Copies and pickles rebuild the members from the items, rather
+        # than restoring them before the items are appended again.
+        return self.__class__, (list(self),)
+
+    def __contains__(self, item):
+        return item in self._members
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __setitem__(self, index, value):
+        super(OrderedSet, self).__setitem__(index, value)
+        self._members = set(self)
+
+    def __delitem__(self, index):
+        super(OrderedSet, self).__delitem__(index)
+        self._members = set(self)
+
+    def __setslice__(self, start, end, values):
+        super(OrderedSet, self).__setslice__(start, end, values)
+        self._members = set(self)
+
+    def __delslice__(self, start, end):
+        super(OrderedSet, self).__delslice__(start, end)
+        self._members = set(self)
+
+    def append(self, item):
+        if item not in self._members:
+            self._members.add(item)
+            super(OrderedSet, self).append(item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def insert(self, index, item):
+        if item not in self._members:
+            self._members.add(item)
+            super(OrderedSet, self).insert(index, item)
+
+    def remove(self, item):
+        super(OrderedSet, self).remove(item)
+        self._members.discard(item)
+
+    def pop(self, index=-1):
+        item = super(OrderedSet, self).pop(index)
+        self._members.discard(item)
+        return item
+
+    def clear(self):
+        del self[:]
+
+
 def append_if(array, item):
     """Append an ``item`` to an ``array`` if its not already in it.
 
+    The membership test is constant time when ``array`` is an
+    ``OrderedSet``.
+
     :param array: ``list``  List object to append to
     :param item: ``object``  Object to append to the list
     :returns bool:  Flag indicating whether the append happened (True)
@@ -18,17 +18,28 @@
 
 import copy
 import datetime
+import hashlib
 import json
 import logging
 import os
 from osa_toolkit import dictutils as du
+from osa_toolkit import timing
+import re
 import tarfile
+import uuid
 import yaml
 
 
 logger = logging.getLogger('osa-inventory')
 
 INVENTORY_FILENAME = 'openstack_inventory.json'
+FINGERPRINT_FILENAME = 'openstack_inventory_fingerprint.json'
+HOST_INDEX_FILENAME = 'openstack_inventory_hosts.json'
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_INDENT = 4
+_ENCODER = json.JSONEncoder(indent=_INDENT, separators=(',', ': '),
+                            sort_keys=True)
 
 
 class MissingDataSource(Exception):
@@ -133,6 +144,7 @@ def _extra_config(user_defined_config, base_dir):
     for root_dir, _, files in os.walk(base_dir):
         for name in files:
             if name.endswith(('.yml', '.yaml')):
+                timing.count('files_parsed')
                 with open(os.path.join(root_dir, name), 'rb') as f:
                     du.merge_dict(
                         user_defined_config,
@@ -211,19 +223,23 @@ def _load_from_json(filename, preferred_path=None, raise_if_missing=True):
     target_file = file_find(filename, preferred_path, raise_if_missing)
     dictionary = False
     if target_file is not False:
+        timing.count('files_parsed')
         with open(target_file, 'rb') as f_handle:
             dictionary = json.loads(f_handle.read().decode('ascii'))
 
     return dictionary, target_file
 
 
-def load_inventory(preferred_path=None, default_inv=None, filename=None):
+def load_inventory(preferred_path=None, default_inv=None, filename=None,
+                   backup=True):
     """Create an inventory dictionary from the given source file or a default
         inventory. If an inventory is found then a backup tarball is created
-        as well.
+        as well, unless ``backup`` is False.
 
     :param preferred_path: ``str`` Path to the inventory directory to try FIRST
     :param default_inv: ``dict`` Default inventory skeleton
+    :param backup: ``bool`` Whether to add the inventory found to the backup
+        tarball. Callers which only read the inventory should not.
 
     :return: ``(dict, str)`` Dictionary describing the JSON file contents or
         ``default_inv``, and the directory from which the inventory was loaded
@@ -235,8 +251,9 @@ def load_inventory(preferred_path=None, default_inv=None, filename=None):
     else:
         inv_fn = INVENTORY_FILENAME
 
-    inventory, file_loaded = _load_from_json(inv_fn, preferred_path,
-                                            raise_if_missing=False)
+    with timing.phase('load_inventory'):
+        inventory, file_loaded = _load_from_json(inv_fn, preferred_path,
+                                                 raise_if_missing=False)
     if file_loaded is not False:
         load_path = os.path.dirname(file_loaded)
     else:
@@ -244,7 +261,9 @@ def load_inventory(preferred_path=None, default_inv=None, filename=None):
 
     if inventory is not False:
         logger.debug("Loaded existing inventory from {}".format(file_loaded))
-        _make_backup(load_path, file_loaded)
+        if backup:
+            with timing.phase('backup'):
+                _make_backup(load_path, file_loaded)
     else:
         logger.debug("No existing inventory, created fresh skeleton.")
         inventory = copy.deepcopy(default_inv)
@@ -252,20 +271,262 @@ def load_inventory(preferred_path=None, default_inv=None, filename=None):
     return inventory, load_path
 
 
+def _inventory_file(save_path):
+    """Return the path of the inventory file in a directory
+
+    :param save_path: ``str`` Path of the directory, or the inventory file
+        name to look up
+    """
+    if INVENTORY_FILENAME == save_path:
+        return file_find(save_path)
+    return os.path.join(save_path, INVENTORY_FILENAME)
+
+
+def _replace_file(target_file, write):
+    """Replace a file with the content written by a function
+
+    The content is written to a temporary file in the same directory, which
+    is flushed to disk and then renamed over the target. Readers of the
+    target see either the old or the new file, never a partly written one,
+    even after a crash. An existing target keeps its permission bits.
+
+    :param target_file: ``str`` Path of the file to replace
+    :param write: ``callable`` Called with the temporary file, opened in
+        binary mode
+    """
+    temp_file = os.path.join(
+        os.path.dirname(target_file),
+        '.{}.{}'.format(os.path.basename(target_file), uuid.uuid4().hex)
+    )
+    fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(target_file):
+            os.chmod(temp_file, os.stat(target_file).st_mode & 0o7777)
+        os.rename(temp_file, target_file)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+
+
 def save_inventory(inventory_json, save_path):
     """Save an inventory dictionary
 
     :param inventory_json: ``str`` String of JSON formatted inventory to store
     :param save_path: ``str`` Path of the directory to save to
     """
+    inventory_file = _inventory_file(save_path)
+    _replace_file(inventory_file,
+                  lambda f: f.write(inventory_json.encode('ascii')))
+    logger.info("Inventory written")
+
+    _save_host_index(host_offsets(inventory_json), inventory_file)
+
+
+class _JSONStream(object):
+    """Write JSON to a binary file, keeping track of the offset"""
+    def __init__(self, f):
+        self._file = f
+        self.offset = 0
+
+    def write(self, text):
+        data = text.encode('ascii')
+        self._file.write(data)
+        self.offset += len(data)
+
+    def write_value(self, value, level):
+        """Write a value nested ``level`` objects deep.
+
+        Encoded strings never hold a line break, so every line break of the
+        encoded value is indentation.
+        """
+        indent = '\n' + ' ' * _INDENT * level
+        for chunk in _ENCODER.iterencode(value):
+            self.write(chunk.replace('\n', indent))
+
+    def write_object(self, obj, level, path, offsets):
+        """Write an object, recording the offsets of the members at a path.
+
+        :param obj: ``dict`` Object to write
+        :param level: ``int`` Number of objects it is nested in
+        :param path: ``tuple`` Keys leading from this object to the object
+            whose members' offsets are recorded
+        :param offsets: ``dict`` Member names mapped to ``[offset, length]``
+        """
+        if not obj:
+            self.write('{}')
+            return
+
+        indent = '\n' + ' ' * _INDENT * (level + 1)
+        separator = '{' + indent
+        for key, value in sorted(obj.items()):
+            self.write(separator + _ENCODER.encode(key) + ': ')
+            separator = ',' + indent
+            if not path:
+                start = self.offset
+                self.write_value(value, level + 1)
+                offsets[key] = [start, self.offset - start]
+            elif key == path[0] and isinstance(value, dict):
+                self.write_object(value, level + 1, path[1:], offsets)
+            else:
+                self.write_value(value, level + 1)
+        self.write('\n' + ' ' * _INDENT * level + '}')
+
+
+def write_inventory(inventory, save_path):
+    """Write an inventory dictionary as JSON, without building the document
+
+    The inventory is formatted like ``json.dumps`` with an indent of 4 and
+    sorted keys, and streamed to a temporary file renamed over the inventory
+    file. The host index is written from the offsets recorded while the host
+    variables were written.
+
+    :param inventory: ``dict`` Inventory to store
+    :param save_path: ``str`` Path of the directory to save to
+    :return: ``str`` Path of the inventory file
+    """
+    inventory_file = _inventory_file(save_path)
+    offsets = {}
+
+    def write(f):
+        stream = _JSONStream(f)
+        stream.write_object(inventory, 0, ('_meta', 'hostvars'), offsets)
+        timing.count('bytes_written', stream.offset)
+
+    _replace_file(inventory_file, write)
+    logger.info("Inventory written")
+
+    _save_host_index(offsets, inventory_file)
+    return inventory_file
 
-    if INVENTORY_FILENAME == save_path:
-        inventory_file = file_find(save_path)
-    else:
-        inventory_file = os.path.join(save_path, INVENTORY_FILENAME)
-    with open(inventory_file, 'wb') as f:
-        f.write(inventory_json.encode('ascii'))
-        logger.info("Inventory written")
+
+def _token(text, pos):
+    """Return the position of the next non whitespace character."""
+    return _WHITESPACE.match(text, pos).end()
+
+
+def _object_members(text, pos, decoder, stop_at=None):
+    """Return the ``(key, start, end)`` offsets of a JSON object's members
+
+    Values are skipped with the decoder. Scanning stops at the member named
+    ``stop_at``, which is returned with an end of None and without having
+    its value decoded.
+
+    :param text: ``str`` JSON document
+    :param pos: ``int`` Offset of the opening brace of the object
+    :param decoder: ``json.JSONDecoder`` Decoder used to skip tokens
+    :param stop_at: ``str`` Name of the member to stop at
+    """
+    members = []
+    pos = _token(text, pos + 1)
+    while text[pos] != '}':
+        key, pos = decoder.raw_decode(text, pos)
+        start = _token(text, _token(text, pos) + 1)
+        if key == stop_at:
+            members.append((key, start, None))
+            break
+        _, end = decoder.raw_decode(text, start)
+        members.append((key, start, end))
+        pos = _token(text, end)
+        if text[pos] == ',':
+            pos = _token(text, pos + 1)
+    return members
+
+
+def host_offsets(inventory_json):
+    """Return the offset and length of every host's variables in a JSON
+    formatted inventory
+
+    :param inventory_json: ``str`` String of JSON formatted inventory
+    :return: ``dict`` Host names mapped to ``[offset, length]``
+    """
+    decoder = json.JSONDecoder()
+    parent = _token(inventory_json, 0)
+    for key in ('_meta', 'hostvars'):
+        members = _object_members(inventory_json, parent, decoder,
+                                  stop_at=key)
+        if not members or members[-1][0] != key:
+            return {}
+        parent = members[-1][1]
+
+    return dict(
+        (host, [start, end - start])
+        for host, start, end in _object_members(inventory_json, parent,
+                                                decoder)
+    )
+
+
+def _save_host_index(offsets, inventory_file):
+    """Save the index of host variables of an inventory file
+
+    The index is only valid for the inventory file of the size and
+    modification time it records.
+
+    :param offsets: ``dict`` Result of ``host_offsets`` for the inventory
+    :param inventory_file: ``str`` Path of the file it was written to
+    """
+    stat = os.stat(inventory_file)
+    index = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'hosts': offsets
+    }
+    index_file = os.path.join(os.path.dirname(inventory_file),
+                              HOST_INDEX_FILENAME)
+    content = json.dumps(index, sort_keys=True).encode('ascii')
+    _replace_file(index_file, lambda f: f.write(content))
+    logger.debug("Host index written to {}".format(index_file))
+
+
+def load_host_vars(host, preferred_path=None):
+    """Return the variables of one host of the stored inventory
+
+    The host is looked up in the index written with the inventory and its
+    variables are read straight from the inventory file, without parsing the
+    rest of it. The whole inventory is loaded instead when the index is
+    missing or out of date.
+
+    :param host: ``str`` Name of the host
+    :param preferred_path: ``str`` Path to the inventory directory to try FIRST
+    :return: ``str`` JSON object of the host variables, empty if the host is
+        unknown, or None if there is no stored inventory
+    """
+    inventory_file = file_find(INVENTORY_FILENAME, preferred_path,
+                               raise_if_missing=False)
+    if inventory_file is False:
+        return None
+
+    index_file = os.path.join(os.path.dirname(inventory_file),
+                              HOST_INDEX_FILENAME)
+    try:
+        with open(index_file, 'rb') as f:
+            index = json.loads(f.read().decode('ascii'))
+    except (IOError, OSError, ValueError):
+        index = {}
+
+    stat = os.stat(inventory_file)
+    if (index.get('size') == stat.st_size and
+            index.get('mtime') == stat.st_mtime):
+        offsets = index['hosts'].get(host)
+        if offsets is None:
+            return '{}'
+        offset, length = offsets
+        with open(inventory_file, 'rb') as f:
+            f.seek(offset)
+            return f.read(length).decode('ascii')
+
+    logger.debug("Host index out of date, loading {}".format(inventory_file))
+    with open(inventory_file, 'rb') as f:
+        inventory = json.loads(f.read().decode('ascii'))
+    return json.dumps(
+        inventory['_meta']['hostvars'].get(host, {}),
+        indent=4,
+        separators=(',', ': '),
+        sort_keys=True
+    )
 
 
 def load_environment(config_path, environment):
@@ -298,6 +559,7 @@ def load_user_configuration(config_path=None):
                                  preferred_path=config_path,
                                  raise_if_missing=False)
     if user_config_file is not False:
+        timing.count('files_parsed')
         with open(user_config_file, 'rb') as f:
             user_defined_config.update(yaml.safe_load(f.read()) or {})
 
@@ -313,3 +575,124 @@ def load_user_configuration(config_path=None):
 
     logger.debug("User configuration loaded from: {}".format(user_config_file))
     return user_defined_config
+
+
+def _yaml_files(base_dir):
+    """Return the sorted paths of all YAML files below a directory.
+
+    :param base_dir: ``str`` Directory to walk
+    """
+    found = []
+    for root_dir, _, files in os.walk(base_dir):
+        for name in files:
+            if name.endswith(('.yml', '.yaml')):
+                found.append(os.path.join(root_dir, name))
+    return sorted(found)
+
+
+def input_files(config_path=None, environment_path=None):
+    """Return the paths of all files an inventory is generated from.
+
+    These are the files read by ``load_user_configuration``,
+    ``load_environment`` and ``load_inventory``, found with the same search
+    paths.
+
+    :param config_path: ``str`` path where the configuration files are kept
+    :param environment_path: ``str`` path where the base env.d is kept
+    :return: ``list`` Paths of the existing input files
+    """
+    paths = []
+    user_config_file = file_find('openstack_user_config.yml',
+                                 preferred_path=config_path,
+                                 raise_if_missing=False)
+    if user_config_file is not False:
+        paths.append(user_config_file)
+
+    for preferred_path, suffix in ((config_path, 'conf.d'),
+                                   (environment_path, 'env.d'),
+                                   (config_path, 'env.d')):
+        base_dir = dir_find(preferred_path, suffix, raise_if_missing=False)
+        if base_dir is not False:
+            paths.extend(_yaml_files(base_dir))
+
+    inventory_file = file_find(INVENTORY_FILENAME,
+                               preferred_path=config_path,
+                               raise_if_missing=False)
+    if inventory_file is not False:
+        paths.append(inventory_file)
+    return paths
+
+
+def fingerprint_files(paths, previous=None):
+    """Return the size, modification time and content hash of files.
+
+    Files whose size and modification time match their entry in a previous
+    fingerprint reuse its content hash, so unchanged files are not read.
+
+    :param paths: ``list`` Paths of the files
+    :param previous: ``dict`` Previous result of this function
+    :return: ``dict`` Mapping of paths to their ``size``, ``mtime`` and
+        ``sha256``
+    """
+    previous = previous or {}
+    fingerprint = {}
+    for path in paths:
+        stat = os.stat(path)
+        entry = previous.get(path)
+        if (entry and entry['size'] == stat.st_size and
+                entry['mtime'] == stat.st_mtime):
+            digest = entry['sha256']
+        else:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+        fingerprint[path] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': digest
+        }
+    return fingerprint
+
+
+def same_contents(fingerprint, other):
+    """Return whether two fingerprints hold the same files and contents
+
+    Modification times and sizes are not compared.
+
+    :param fingerprint: ``dict`` Result of ``fingerprint_files``
+    :param other: ``dict`` Result of ``fingerprint_files``
+    """
+    if fingerprint is None or other is None:
+        return False
+    if set(fingerprint) != set(other):
+        return False
+    return all(
+        fingerprint[path]['sha256'] == other[path]['sha256']
+        for path in fingerprint
+    )
+
+
+def load_fingerprint(preferred_path=None):
+    """Return the fingerprint saved by ``save_fingerprint``, or None
+
+    :param preferred_path: ``str`` Path to the inventory directory to try FIRST
+    """
+    try:
+        fingerprint, _ = _load_from_json(FINGERPRINT_FILENAME,
+                                         preferred_path,
+                                         raise_if_missing=False)
+    except ValueError:
+        logger.debug("Ignoring unreadable inventory fingerprint")
+        return None
+    return fingerprint or None
+
+
+def save_fingerprint(fingerprint, save_path):
+    """Save the fingerprint of the inputs of an inventory
+
+    :param fingerprint: ``dict`` Fingerprint to store
+    :param save_path: ``str`` Path of the directory to save to
+    """
+    fingerprint_file = os.path.join(save_path, FINGERPRINT_FILENAME)
+    content = json.dumps(fingerprint, sort_keys=True).encode('ascii')
+    _replace_file(fingerprint_file, lambda f: f.write(content))
+    logger.debug("Inventory fingerprint written")
@@ -15,12 +15,17 @@
 #
 # (c) 2014, Kevin Carter <kevin.carter@rackspace.com>
 
+import bisect
+import hashlib
 import json
 import logging
 import netaddr
 from osa_toolkit import dictutils as du
 from osa_toolkit import filesystem as filesys
 from osa_toolkit import ip
+from osa_toolkit import skeleton as sk
+from osa_toolkit import timing
+import os
 import uuid
 import warnings
 
@@ -125,6 +130,137 @@ class GroupConflict(Exception):
     pass
 
 
+class ConfigValidationError(Exception):
+    def __init__(self, errors):
+        self.errors = errors
+
+        error_msg = "The user configuration has {} errors:\n{}"
+
+        self.message = error_msg.format(
+            len(errors), '\n'.join('  - {}'.format(error) for error in errors)
+        )
+
+    def __str__(self):
+        return self.message
+
+
+class _ContainerIndex(object):
+    """Index of the container records of hostvars by container name.
+
+    Records are the hostvars entries holding a ``container_name`` or a
+    ``container_types`` key; entries without a container name are indexed
+    by host name. Names are kept sorted, so the records whose name starts
+    with a prefix are found with a bisection instead of a scan of every
+    host. Matching host names are returned in the order they were added to
+    hostvars.
+    """
+    def __init__(self, hostvars):
+        """Index the container records of hostvars.
+
+        :param hostvars: ``dict`` Host variables of the inventory
+        """
+        self._hostvars = hostvars
+        self._names = []
+        self._hosts = {}
+        self._keys = {}
+        self._order = {}
+        for hname in hostvars:
+            self._order[hname] = len(self._order)
+            self.update(hname)
+
+    def update(self, hname):
+        """Index, or re-index, the hostvars record of a host.
+
+        :param hname: ``str`` Name of the host
+        """
+        hdata = self._hostvars[hname]
+        if 'container_name' in hdata:
+            name = hdata['container_name']
+        elif 'container_types' in hdata:
+            name = hname
+        else:
+            return
+
+        if hname not in self._order:
+            self._order[hname] = len(self._order)
+
+        old_name = self._keys.get(hname)
+        if old_name == name:
+            return
+        if old_name is not None:
+            self._hosts[old_name].remove(hname)
+            if not self._hosts[old_name]:
+                del self._hosts[old_name]
+                del self._names[bisect.bisect_left(self._names, old_name)]
+
+        self._keys[hname] = name
+        if name not in self._hosts:
+            self._hosts[name] = []
+            bisect.insort(self._names, name)
+        self._hosts[name].append(hname)
+
+    def starting_with(self, prefix):
+        """Return the hosts whose indexed name starts with a prefix.
+
+        :param prefix: ``str`` Prefix of the container names
+        :returns: ``list`` Host names in hostvars order
+        """
+        matches = []
+        index = bisect.bisect_left(self._names, prefix)
+        while (index < len(self._names) and
+               self._names[index].startswith(prefix)):
+            matches.extend(self._hosts[self._names[index]])
+            index += 1
+        return sorted(matches, key=self._order.get)
+
+
+class _GroupClosure(object):
+    """Memoised closure of the groups of an inventory over their children.
+
+    The hosts of a group are those of its child groups, depth first, then
+    its own hosts. A host reachable through several paths is listed once,
+    where it is first reached. The hosts of each group are only collected
+    once, so groups shared by many others, like ``all_containers``, are not
+    walked again for each of them. Group membership must not change while
+    a closure is in use.
+    """
+    def __init__(self, inventory):
+        """Create an empty closure of the groups of an inventory.
+
+        :param inventory: ``dict``  Living dictionary of inventory
+        """
+        self._inventory = inventory
+        self._hosts = {}
+
+    def hosts(self, key):
+        """Return the hosts of a group and of its child groups.
+
+        :param key: ``str`` Group name. Names of hosts or of missing groups
+            have no hosts.
+        :returns: ``du.OrderedSet`` Host names
+        """
+        hosts = self._hosts.get(key)
+        if hosts is None:
+            hosts = du.OrderedSet()
+            lookup = self._inventory.get(key) or {}
+            for group in lookup.get('children') or []:
+                hosts.extend(self.hosts(group))
+            hosts.extend(lookup.get('hosts') or [])
+            self._hosts[key] = hosts
+        return hosts
+
+    def union(self, keys):
+        """Return the hosts of several groups, each host once.
+
+        :param keys: ``list`` Group names
+        :returns: ``du.OrderedSet`` Host names, in the order of the groups
+        """
+        hosts = du.OrderedSet()
+        for key in keys:
+            hosts.extend(self.hosts(key))
+        return hosts
+
+
 def _parse_belongs_to(key, belongs_to, inventory):
     """Parse all items in a `belongs_to` list.
 
@@ -146,7 +282,7 @@ def _parse_belongs_to(key, belongs_to, inventory):
 def _build_container_hosts(container_affinity, container_hosts, type_and_name,
                            inventory, host_type, container_type,
                            container_host_type, physical_host_type, config,
-                           properties, assignment):
+                           properties, assignment, container_index):
     """Add in all of the host associations into inventory.
 
     This will add in all of the hosts into the inventory based on the given
@@ -163,6 +299,7 @@ def _build_container_hosts(container_affinity, container_hosts, type_and_name,
     :param config: ``dict``  User defined information
     :param properties: ``dict``  Container properties
     :param assignment: ``str`` Name of container component target
+    :param container_index: ``_ContainerIndex`` Index of the container records
     """
     container_list = []
     is_metal = False
@@ -187,10 +324,11 @@ def _build_container_hosts(container_affinity, container_hosts, type_and_name,
                 container_host_name = '{}-{}'.format(type_and_name, cuuid)
                 logger.debug("Generated container name %s",
                              container_host_name)
+                timing.count('containers_created')
                 hostvars_options = hostvars[container_host_name] = {}
                 if container_host_type not in inventory:
                     inventory[container_host_type] = {
-                        "hosts": [],
+                        "hosts": du.OrderedSet(),
                     }
 
                 appended = du.append_if(
@@ -225,15 +363,17 @@ def _build_container_hosts(container_affinity, container_hosts, type_and_name,
                 'physical_host_group': physical_host_type,
                 'component': assignment
             })
+            container_index.update(container_host_name)
 
 
-def _append_container_types(inventory, host_type):
+def _append_container_types(inventory, host_type, container_index):
     """Append the "physical_host" type to all containers.
 
     :param inventory: ``dict``  Living dictionary of inventory
     :param host_type: ``str``  Name of the host type
+    :param container_index: ``_ContainerIndex`` Index of the container records
     """
-    for _host in inventory['_meta']['hostvars'].keys():
+    for _host in container_index.starting_with(host_type):
         hdata = inventory['_meta']['hostvars'][_host]
         if 'container_name' in hdata:
             if hdata['container_name'].startswith(host_type):
@@ -244,7 +384,7 @@ def _append_container_types(inventory, host_type):
 
 
 def _append_to_host_groups(inventory, container_type, assignment, host_type,
-                           type_and_name, host_options):
+                           type_and_name, host_options, container_index):
     """Append all containers to physical (logical) groups based on host types.
 
     :param inventory: ``dict``  Living dictionary of inventory
@@ -253,15 +393,18 @@ def _append_to_host_groups(inventory, container_type, assignment, host_type,
     :param assignment: ``str`` Name of container component target
     :param host_type: ``str``  Name of the host type
     :param type_and_name: ``str`` Combined name of host and container name
+    :param container_index: ``_ContainerIndex`` Index of the container records
     """
     physical_group_type = '{}_all'.format(container_type.split('_')[0])
     if physical_group_type not in inventory:
         logger.debug("Added %s group to inventory", physical_group_type)
-        inventory[physical_group_type] = {'hosts': []}
+        inventory[physical_group_type] = {'hosts': du.OrderedSet()}
 
     iph = inventory[physical_group_type]['hosts']
     iah = inventory[assignment]['hosts']
-    for hname, hdata in inventory['_meta']['hostvars'].items():
+    hostvars = inventory['_meta']['hostvars']
+    for hname in container_index.starting_with(host_type):
+        hdata = hostvars[hname]
         is_metal = False
         properties = hdata.get('properties')
         if properties:
@@ -327,7 +470,8 @@ def _append_to_host_groups(inventory, container_type, assignment, host_type,
 
 
 def _add_container_hosts(assignment, config, container_name, container_type,
-                         inventory, properties):
+                         inventory, properties, container_index,
+                         limit_hosts=None):
     """Add a given container name and type to the hosts.
 
     :param assignment: ``str`` Name of container component target
@@ -336,6 +480,9 @@ def _add_container_hosts(assignment, config, container_name, container_type,
     :param container_type: ``str``  Type of container
     :param inventory: ``dict``  Living dictionary of inventory
     :param properties: ``dict``  Dict of container properties
+    :param container_index: ``_ContainerIndex`` Index of the container records
+    :param limit_hosts: ``set`` Only add containers to these hosts. All hosts
+        are used if not set.
     """
     physical_host_type = '{}_hosts'.format(container_type.split('_')[0])
     # If the physical host type is not in config return
@@ -349,6 +496,9 @@ def _add_container_hosts(assignment, config, container_name, container_type,
         if host_type not in config[physical_host_type]:
             continue
 
+        if limit_hosts is not None and host_type not in limit_hosts:
+            continue
+
         # Get any set host options
         host_options = config[physical_host_type][host_type]
         affinity = host_options.get('affinity', {})
@@ -377,6 +527,7 @@ def _add_container_hosts(assignment, config, container_name, container_type,
             physical_host['container_types'] = container_host_type
         elif physical_host['container_types'] != container_host_type:
             physical_host['container_types'] = container_host_type
+        container_index.update(host_type)
 
         # Add all of the containers into the inventory
         logger.debug("Building containers for host %s", container_name)
@@ -392,38 +543,54 @@ def _add_container_hosts(assignment, config, container_name, container_type,
             config,
             properties,
             assignment,
+            container_index,
         )
 
         # Add the physical host type to all containers from the built inventory
-        _append_container_types(inventory, host_type)
+        _append_container_types(inventory, host_type, container_index)
         _append_to_host_groups(
             inventory,
             container_type,
             assignment,
             host_type,
             type_and_name,
-            host_options
+            host_options,
+            container_index
         )
 
 
-def user_defined_setup(config, inventory):
+def user_defined_setup(config, inventory, context, limit_hosts=None):
     """Apply user defined entries from config into inventory.
 
     :param config: ``dict``  User defined information
     :param inventory: ``dict``  Living dictionary of inventory
+    :param context: ``ip.AllocationContext`` Allocation state of the run
+    :param limit_hosts: ``set`` Only update the host variables of these
+        hosts. All hosts are updated if not set.
     """
     hvs = inventory['_meta']['hostvars']
     for key, value in config.items():
         if key.endswith('hosts'):
             if key not in inventory:
                 logger.debug("Key %s was added to inventory", key)
-                inventory[key] = {'hosts': []}
+                inventory[key] = {'hosts': du.OrderedSet()}
 
             if value is None:
                 logger.debug("Key %s had no value", key)
                 return
 
             for _key, _value in value.items():
+                context.used_ips.add(_value['ip'])
+                context.allocated_ips.add(_value['ip'])
+                appended = du.append_if(array=inventory[key]['hosts'],
+                                        item=_key)
+                if appended:
+                    logger.debug("Added host %s to group %s",
+                                 _key, key)
+
+                if limit_hosts is not None and _key not in limit_hosts:
+                    continue
+
                 if _key not in hvs:
                     hvs[_key] = {}
 
@@ -446,47 +613,41 @@ def user_defined_setup(config, inventory):
                     for _k, _v in _value['host_vars'].items():
                         hvs[_key][_k] = _v
 
-                ip.USED_IPS.add(_value['ip'])
-                appended = du.append_if(array=inventory[key]['hosts'],
-                                        item=_key)
-                if appended:
-                    logger.debug("Added host %s to group %s",
-                                 _key, key)
 
+def _ordered_groups(inventory):
+    """Convert the member lists of every group into ordered sets.
+
+    Inventory loaded from JSON holds plain lists, which would make every
+    membership test of ``du.append_if`` scan the whole group.
+
+    :param inventory: ``dict``  Living dictionary of inventory
+    """
+    for key, group in inventory.items():
+        if key == '_meta' or not isinstance(group, dict):
+            continue
+        for members in ('hosts', 'children'):
+            if isinstance(group.get(members), list):
+                group[members] = du.OrderedSet(group[members])
 
-def skel_setup(environment, inventory):
+
+def skel_setup(environment, inventory, skeleton=None):
     """Build out the main inventory skeleton as needed.
 
     :param environment: ``dict`` Known environment information
     :param inventory: ``dict``  Living dictionary of inventory
+    :param skeleton: ``sk.Skeleton`` Compiled skeleton of the environment,
+        compiled from it if not given
     """
-    for key, value in environment.items():
-        if key == 'version':
-            continue
-        for _key, _value in value.items():
-            if _key not in inventory:
-                logger.debug("Key %s added to inventory", _key)
-                inventory[_key] = {}
-                if _key.endswith('container'):
-                    if 'hosts' not in inventory[_key]:
-                        inventory[_key]['hosts'] = []
-                else:
-                    if 'children' not in inventory[_key]:
-                        inventory[_key]['children'] = []
-                    # TODO(nrb): This line is duplicated above;
-                    # is that necessary?
-                    if 'hosts' not in inventory[_key]:
-                        inventory[_key]['hosts'] = []
-
-            if 'belongs_to' in _value:
-                for assignment in _value['belongs_to']:
-                    if assignment not in inventory:
-                        logger.debug("Created group %s", assignment)
-                        inventory[assignment] = {}
-                        if 'children' not in inventory[assignment]:
-                            inventory[assignment]['children'] = []
-                        if 'hosts' not in inventory[assignment]:
-                            inventory[assignment]['hosts'] = []
+    if skeleton is None:
+        skeleton = sk.Skeleton.compile(environment)
+
+    for key, has_children in skeleton.groups:
+        if key not in inventory:
+            logger.debug("Key %s added to inventory", key)
+            inventory[key] = {}
+            if has_children:
+                inventory[key]['children'] = du.OrderedSet()
+            inventory[key]['hosts'] = du.OrderedSet()
 
 
 def skel_load(skeleton, inventory):
@@ -529,19 +690,24 @@ def network_entry(is_metal, interface,
     return _network
 
 
-def _add_additional_networks(key, inventory, ip_q, q_name, netmask, interface,
-                             bridge, net_type, net_mtu, user_config,
+def _add_additional_networks(hosts, inventory, ip_q, q_name, netmask,
+                             interface, bridge, net_type, net_mtu, user_config,
                              is_ssh_address, is_container_address,
-                             static_routes):
+                             static_routes, q6_name=None, netmask_v6=None,
+                             limit_hosts=None):
     """Process additional ip adds and append then to hosts as needed.
 
     If the host is found to be "is_metal" it will be marked as "on_metal"
     and will not have an additionally assigned IP address.
 
-    :param key: ``str`` Component key name. This could be a group or a host
-        name
+    Dual-stack networks name a second, IPv6 queue in ``q6_name``. Its
+    address is assigned in the same pass and stored next to the first one
+    as ``address_v6`` and ``netmask_v6``.
+
+    :param hosts: ``list`` Names of the hosts and containers bound to the
+        network, each listed once
     :param inventory: ``dict``  Living dictionary of inventory.
-    :param ip_q: ``object`` build queue of IP addresses.
+    :param ip_q: ``ip.IPBasePlugin`` IPAM plugin handing out addresses.
     :param q_name: ``str`` key to use in host vars for storage. May be blank.
     :param netmask: ``str`` netmask to use.
     :param interface: ``str`` interface name to set for the network.
@@ -549,36 +715,13 @@ def _add_additional_networks(key, inventory, ip_q, q_name, netmask, interface,
     :param is_ssh_address: ``bol`` set this address as ansible_host.
     :param is_container_address: ``bol`` set this address to container_address.
     :param static_routes: ``list`` List containing static route dicts.
+    :param q6_name: ``str`` IPv6 queue of a dual-stack network. May be blank.
+    :param netmask_v6: ``str`` netmask of the IPv6 queue.
+    :param limit_hosts: ``set`` Only assign addresses to these hosts and the
+        containers they hold. All hosts are used if not set.
     """
 
     base_hosts = inventory['_meta']['hostvars']
-    lookup = inventory.get(key, list())
-
-    if 'children' in lookup and lookup['children']:
-        for group in lookup['children']:
-            _add_additional_networks(
-                group,
-                inventory,
-                ip_q,
-                q_name,
-                netmask,
-                interface,
-                bridge,
-                net_type,
-                net_mtu,
-                user_config,
-                is_ssh_address,
-                is_container_address,
-                static_routes
-            )
-
-    # Make sure the lookup object has a value.
-    if lookup:
-        hosts = lookup.get('hosts')
-        if not hosts:
-            return
-    else:
-        return
 
     # TODO(cloudnull) after a few releases this should be removed.
     if q_name:
@@ -588,6 +731,8 @@ def _add_additional_networks(key, inventory, ip_q, q_name, netmask, interface,
 
     for container_host in hosts:
         container = base_hosts[container_host]
+        if not _in_limit(container_host, container, limit_hosts):
+            continue
 
         # TODO(cloudnull) after a few releases this should be removed.
         # This removes the old container network value that now serves purpose.
@@ -616,7 +761,8 @@ def _add_additional_networks(key, inventory, ip_q, q_name, netmask, interface,
             if old_address in container and container[old_address]:
                 network['address'] = container.pop(old_address)
             elif not is_metal:
-                address = ip.get_ip_address(name=q_name, ip_q=ip_q)
+                address = ip.get_ip_address(name=q_name, ip_q=ip_q,
+                                            owner=container_host)
                 if address:
                     network['address'] = address
 
@@ -638,6 +784,15 @@ def _add_additional_networks(key, inventory, ip_q, q_name, netmask, interface,
                 phg = user_config[cphg][container_host]
                 network['address'] = phg['ip']
 
+        if q6_name and not is_metal:
+            network = networks[old_address]
+            if not network.get('address_v6'):
+                address = ip.get_ip_address(name=q6_name, ip_q=ip_q,
+                                            owner=container_host)
+                if address:
+                    network['address_v6'] = address
+            network['netmask_v6'] = netmask_v6
+
         if is_ssh_address is True:
             container['ansible_host'] = networks[old_address]['address']
 
@@ -661,45 +816,127 @@ def _add_additional_networks(key, inventory, ip_q, q_name, netmask, interface,
                 networks[old_address]['static_routes'].append(route)
 
 
-def container_skel_load(container_skel, inventory, config):
+def _in_limit(container_host, container, limit_hosts):
+    """Return whether a host or the host holding a container is in a limit.
+
+    :param container_host: ``str`` Name of the host or container
+    :param container: ``dict`` Host variables of the host or container
+    :param limit_hosts: ``set`` Names of the hosts to use, None for all
+    """
+    if limit_hosts is None:
+        return True
+    return (container_host in limit_hosts or
+            container.get('physical_host') in limit_hosts)
+
+
+def _reserve_provider_addresses(inventory, provider_networks, ipam,
+                                group_closure, limit_hosts=None):
+    """Reserve the addresses every provider network will need in one pass.
+
+    Containers which will be given a new address by
+    ``_add_additional_networks`` are counted per queue, including the IPv6
+    queue of dual-stack networks, and all of their addresses are reserved
+    with a single request per queue. The run exits before any address is
+    assigned if a queue cannot satisfy its request.
+
+    :param inventory: ``dict``  Living dictionary of inventory
+    :param provider_networks: ``list`` Provider networks from user config
+    :param ipam: ``ip.IPBasePlugin`` IPAM plugin to reserve addresses from
+    :param group_closure: ``_GroupClosure`` Hosts of the inventory groups
+    :param limit_hosts: ``set`` Only count these hosts and the containers
+        they hold. All hosts are counted if not set.
+    :returns: ``ip.Reservation`` holding the reserved addresses
+    """
+    base_hosts = inventory['_meta']['hostvars']
+    owners = {}
+    seen = set()
+    for pn in provider_networks:
+        p_net = pn.get('network')
+        if not p_net:
+            continue
+
+        q_name = p_net.get('ip_from_q')
+        q6_name = p_net.get('ip6_from_q')
+        if q_name:
+            old_address = '{}_address'.format(q_name)
+        else:
+            old_address = '{}_address'.format(p_net['container_interface'])
+
+        group_binds = p_net.get('group_binds', list())
+        for container_host in group_closure.union(group_binds):
+            if (container_host, old_address) in seen:
+                continue
+            seen.add((container_host, old_address))
+
+            container = base_hosts[container_host]
+            if not _in_limit(container_host, container, limit_hosts):
+                continue
+            properties = container.get('properties')
+            if properties and properties.get('is_metal', False):
+                continue
+            network = container.get('container_networks', {}).get(
+                old_address
+            )
+            if network is None and not container.get(old_address):
+                owners.setdefault(q_name, []).append(container_host)
+            if q6_name and not (network or {}).get('address_v6'):
+                owners.setdefault(q6_name, []).append(container_host)
+
+    return ip.reserve_ip_addresses(ipam, owners)
+
+
+def container_skel_load(container_skel, inventory, config, context=None,
+                        limit_hosts=None, skeleton=None):
     """Build out all containers as defined in the environment file.
 
     :param container_skel: ``dict`` container skeleton for all known containers
     :param inventory: ``dict``  Living dictionary of inventory
     :param config: ``dict``  User defined information
+    :param context: ``ip.AllocationContext`` Allocation state of the run. A
+        new, empty context is used if none is given.
+    :param limit_hosts: ``set`` Only build the containers and networks of
+        these hosts, keeping those of the others as found in the inventory.
+        All hosts are built if not set.
+    :param skeleton: ``sk.Skeleton`` Compiled skeleton of the environment,
+        compiled from the container skeleton if not given
     """
     logger.debug("Loading container skeleton")
-
-    for key, value in container_skel.items():
-        contains_in = value.get('contains', False)
-        belongs_to_in = value.get('belongs_to', False)
-        if contains_in or belongs_to_in:
-            for assignment in value['contains']:
-                for container_type in value['belongs_to']:
-                    _add_container_hosts(
-                        assignment,
-                        config,
-                        key,
-                        container_type,
-                        inventory,
-                        value.get('properties', {})
-                    )
-    else:
-        cidr_networks = config.get('cidr_networks')
-        provider_queues = {}
-        for net_name in cidr_networks:
-            ip_q = ip.load_optional_q(
-                cidr_networks, cidr_name=net_name
+    if context is None:
+        context = ip.AllocationContext()
+    if skeleton is None:
+        skeleton = sk.Skeleton.compile({'container_skel': container_skel})
+
+    with timing.phase('containers'):
+        container_index = _ContainerIndex(inventory['_meta']['hostvars'])
+        for assignment, key, container_type, properties in skeleton.containers:
+            _add_container_hosts(
+                assignment,
+                config,
+                key,
+                container_type,
+                inventory,
+                properties,
+                container_index,
+                limit_hosts
             )
-            provider_queues[net_name] = ip_q
-            if ip_q is not None:
-                net = netaddr.IPNetwork(cidr_networks.get(net_name))
-                q_netmask = '{}_netmask'.format(net_name)
-                provider_queues[q_netmask] = str(net.netmask)
+    with timing.phase('networks'):
+        cidr_networks = config.get('cidr_networks')
+        queues = {}
+        netmasks = {}
+        for net_name, cidr in cidr_networks.items():
+            if cidr is not None:
+                queues[net_name] = cidr
+                netmasks[net_name] = str(netaddr.IPNetwork(cidr).netmask)
+
+        ipam = context.create_manager(queues,
+                                      owners=inventory['_meta']['hostvars'])
 
         overrides = config['global_overrides']
         # iterate over a list of provider_networks, var=pn
         pns = overrides.get('provider_networks', list())
+        group_closure = _GroupClosure(inventory)
+        reservation = _reserve_provider_addresses(inventory, pns, ipam,
+                                                  group_closure, limit_hosts)
         for pn in pns:
             # p_net are the provider_network values
             p_net = pn.get('network')
@@ -707,28 +944,29 @@ def container_skel_load(container_skel, inventory, config):
                 continue
 
             q_name = p_net.get('ip_from_q')
-            ip_from_q = provider_queues.get(q_name)
-            if ip_from_q:
-                netmask = provider_queues['{}_netmask'.format(q_name)]
-            else:
-                netmask = None
-
-            for group in p_net.get('group_binds', list()):
-                _add_additional_networks(
-                    key=group,
-                    inventory=inventory,
-                    ip_q=ip_from_q,
-                    q_name=q_name,
-                    netmask=netmask,
-                    interface=p_net['container_interface'],
-                    bridge=p_net['container_bridge'],
-                    net_type=p_net.get('container_type'),
-                    net_mtu=p_net.get('container_mtu'),
-                    user_config=config,
-                    is_ssh_address=p_net.get('is_ssh_address'),
-                    is_container_address=p_net.get('is_container_address'),
-                    static_routes=p_net.get('static_routes')
-                )
+            q6_name = p_net.get('ip6_from_q')
+            netmask = netmasks.get(q_name)
+
+            group_binds = p_net.get('group_binds', list())
+            _add_additional_networks(
+                hosts=group_closure.union(group_binds),
+                inventory=inventory,
+                ip_q=reservation,
+                q_name=q_name,
+                netmask=netmask,
+                interface=p_net['container_interface'],
+                bridge=p_net['container_bridge'],
+                net_type=p_net.get('container_type'),
+                net_mtu=p_net.get('container_mtu'),
+                user_config=config,
+                is_ssh_address=p_net.get('is_ssh_address'),
+                is_container_address=p_net.get('is_container_address'),
+                static_routes=p_net.get('static_routes'),
+                q6_name=q6_name,
+                netmask_v6=netmasks.get(q6_name),
+                limit_hosts=limit_hosts
+            )
+        reservation.release_unused()
 
     populate_lxc_hosts(inventory)
 
@@ -759,7 +997,7 @@ def _find_lxc_hosts(inventory):
     :returns: List of hostnames that are LXC hosts
     :rtype: list
     """
-    host_nodes = []
+    host_nodes = du.OrderedSet()
     for host, hostvars in inventory['_meta']['hostvars'].items():
         physical_host = hostvars.get('physical_host', None)
 
@@ -847,24 +1085,70 @@ def _parse_global_variables(user_cidr, inventory, user_defined_config):
                 del inventory['all']['vars'][key]
 
 
+class _HostAddressMap(object):
+    """IP and host maps of the host groups of a user configuration.
+
+    Both maps are built in a single walk of the host groups, recording every
+    address shared by several hosts and every host given several addresses
+    along the way. Each conflict is recorded once, however many groups list
+    the hosts involved.
+    """
+    def __init__(self, config):
+        """Map the hosts of a user configuration.
+
+        :param config: ``dict`` User provided configuration
+        """
+        self.hosts_by_ip = {}
+        self.ips_by_host = {}
+        self.shared_ips = []
+        self.multiple_ips = []
+        seen = set()
+        for key, value in config.items():
+            by_ip = key.endswith('hosts')
+            by_host = '_hosts' in key
+            if not (by_ip or by_host):
+                continue
+            for hostname, entries in (value or {}).items():
+                ip = entries['ip']
+                if by_ip:
+                    assigned_host = self.hosts_by_ip.setdefault(ip, hostname)
+                    if (assigned_host != hostname and
+                            ('ip', ip, hostname) not in seen):
+                        seen.add(('ip', ip, hostname))
+                        self.shared_ips.append(
+                            MultipleHostsWithOneIPError(ip, assigned_host,
+                                                        hostname)
+                        )
+                if by_host:
+                    current_ip = self.ips_by_host.setdefault(hostname, ip)
+                    if (current_ip != ip and
+                            ('host', hostname, ip) not in seen):
+                        seen.add(('host', hostname, ip))
+                        self.multiple_ips.append(
+                            MultipleIpForHostError(hostname, current_ip, ip)
+                        )
+
+
+def _raise_config_errors(errors):
+    """Raise the errors found in a configuration, if any.
+
+    A single error is raised as is, several are raised together.
+
+    :param errors: ``list`` Exceptions describing each error
+    :raises: ConfigValidationError
+    """
+    if len(errors) == 1:
+        raise errors[0]
+    elif errors:
+        raise ConfigValidationError(errors)
+
+
 def _check_same_ip_to_multiple_host(config):
     """Check for IPs assigned to multiple hosts
 
     : param: config:  ``dict`` User provided configuration
     """
-
-    ips_to_hostnames_mapping = dict()
-    for key, value in config.items():
-        if key.endswith('hosts'):
-            for _key, _value in value.items():
-                hostname = _key
-                ip = _value['ip']
-                if not (ip in ips_to_hostnames_mapping):
-                    ips_to_hostnames_mapping[ip] = hostname
-                else:
-                    if ips_to_hostnames_mapping[ip] != hostname:
-                        info = (ip, ips_to_hostnames_mapping[ip], hostname)
-                        raise MultipleHostsWithOneIPError(*info)
+    _raise_config_errors(_HostAddressMap(config).shared_ips[:1])
     logger.debug("No hosts with duplicated IPs found")
 
 
@@ -873,28 +1157,50 @@ def _check_multiple_ips_to_host(config):
 
     :param: config: ``dict`` User provided configuration
     """
-
-    # Extract only the dictionaries in the host groups.
-    host_ip_map = {}
-    for groupnames, group in config.items():
-        if '_hosts' in groupnames:
-            for hostname, entries in group.items():
-                if hostname not in host_ip_map:
-                    host_ip_map[hostname] = entries['ip']
-                else:
-                    current_ip = host_ip_map[hostname]
-                    new_ip = entries['ip']
-                    if not current_ip == new_ip:
-                        raise MultipleIpForHostError(hostname, current_ip,
-                                                     new_ip)
+    _raise_config_errors(_HostAddressMap(config).multiple_ips[:1])
     logger.debug("No hosts with multiple IPs found.")
     return True
 
 
-def _check_lxc_hosts(config):
+def _lxc_hosts_errors(config):
     if 'lxc_hosts' in config.keys():
-        raise LxcHostsDefined()
+        return [LxcHostsDefined()]
     logger.debug("lxc_hosts group not defined")
+    return []
+
+
+def _group_branch_errors(config, physical_skel):
+    """Return the groups having both hosts and child groups
+
+    :param config: ``dict`` The contents of the user configuration file.
+    :param physical_skel: ``dict`` The physical skeleton tree.
+    :returns: ``list`` One ``GroupConflict`` per parent group
+    """
+    children = {}
+    parents = []
+    for group, relations in physical_skel.items():
+        if 'belongs_to' not in relations:
+            continue
+        for parent in relations['belongs_to']:
+            if parent in config.keys():
+                if parent not in children:
+                    children[parent] = []
+                    parents.append(parent)
+                children[parent].append(group)
+
+    errors = []
+    for parent in parents:
+        if len(children[parent]) == 1:
+            child = "a child group {}".format(children[parent][0])
+        else:
+            child = "child groups {}".format(', '.join(children[parent]))
+        message = (
+            "Group {parent} has {child}, "
+            "but also has host entries in user configuration. "
+            "Hosts cannot be sibling with groups."
+        ).format(parent=parent, child=child)
+        errors.append(GroupConflict(message))
+    return errors
 
 
 def _check_group_branches(config, physical_skel):
@@ -913,77 +1219,131 @@ def _check_group_branches(config, physical_skel):
     :raises GroupConflict:
     """
     logging.debug("Checking group branches match expectations")
-    for group, relations in physical_skel.items():
-        if 'belongs_to' not in relations:
-            continue
-        parents = relations['belongs_to']
-        for parent in parents:
-            if parent in config.keys():
-                message = (
-                    "Group {parent} has a child group {child}, "
-                    "but also has host entries in user configuration. "
-                    "Hosts cannot be sibling with groups."
-                ).format(parent=parent, child=group)
-                raise GroupConflict(message)
+    _raise_config_errors(_group_branch_errors(config, physical_skel)[:1])
     logging.debug("Group branches ok.")
     return True
 
 
-def _check_config_settings(cidr_networks, config, container_skel):
-    """check preciseness of config settings
+def _cidr_errors(cidr_networks):
+    """Return the errors of the cidr_networks of a user configuration
+
+    :param cidr_networks: ``dict`` cidr_networks from config
+    """
+    if not cidr_networks:
+        return [SystemExit('No container CIDR specified in user config')]
+    if 'container' not in cidr_networks and 'management' not in cidr_networks:
+        return [SystemExit('No container or management network '
+                           'specified in user config.')]
+    return []
+
+
+def _provider_network_errors(cidr_networks, config, container_skel):
+    """Return the errors of the provider networks of a user configuration
+
+    Provider networks are only needed when some container is not on metal.
+    Queues are only looked up when ``cidr_networks`` holds a container or
+    management network.
 
     :param cidr_networks: ``dict`` cidr_networks from config
     :param config: ``dict``  User defined information
     :param container_skel: ``dict`` container skeleton for all known containers
     """
-
     # search for any container that doesn't have is_metal flag set to true
     is_provider_networks_needed = False
-    for key, value in container_skel.items():
+    for key, value in (container_skel or {}).items():
         properties = value.get('properties', {})
         is_metal = properties.get('is_metal', False)
         if not is_metal:
             is_provider_networks_needed = True
             break
 
-    if is_provider_networks_needed:
-        if ('global_overrides' not in config):
-            raise SystemExit(
-                "global_overrides can't be found in user config"
-            )
-
-        elif ('provider_networks' not in config['global_overrides']):
-            raise SystemExit(
-                "provider networks can't be found under "
-                "global_overrides in user config"
+    if not is_provider_networks_needed:
+        return []
+    if ('global_overrides' not in config):
+        return [SystemExit("global_overrides can't be found in user config")]
+    elif ('provider_networks' not in config['global_overrides']):
+        return [SystemExit("provider networks can't be found under "
+                           "global_overrides in user config")]
+
+    check_queues = not _cidr_errors(cidr_networks)
+    errors = []
+    # make sure that provider network's ip_from_q is valid
+    overrides = config['global_overrides']
+    pns = overrides.get('provider_networks', list())
+    for pn in pns:
+        p_net = pn.get('network')
+        if not p_net:
+            continue
+        q_name = p_net.get('ip_from_q')
+        if check_queues and q_name and q_name not in cidr_networks:
+            errors.append(
+                SystemExit("can't find " + q_name + " in cidr_networks")
             )
-        else:
-            # make sure that provider network's ip_from_q is valid
-            overrides = config['global_overrides']
-            pns = overrides.get('provider_networks', list())
-            for pn in pns:
-                p_net = pn.get('network')
-                if not p_net:
-                    continue
-                q_name = p_net.get('ip_from_q')
-                if q_name and q_name not in cidr_networks:
-                    raise SystemExit(
-                        "can't find " + q_name + " in cidr_networks"
-                    )
-                if (p_net.get('container_bridge') ==
-                        overrides.get('management_bridge')):
-                    if (not p_net.get('is_ssh_address') or
-                            not p_net.get('is_container_address')):
-                        raise ProviderNetworkMisconfiguration(q_name)
-
-    logger.debug("Provider network information OK")
+        q6_name = p_net.get('ip6_from_q')
+        if check_queues and q6_name:
+            if q6_name not in cidr_networks:
+                errors.append(
+                    SystemExit("can't find " + q6_name + " in cidr_networks")
+                )
+            else:
+                cidr = cidr_networks[q6_name]
+                if cidr and netaddr.IPNetwork(cidr).version != 6:
+                    errors.append(SystemExit(
+                        "ip6_from_q " + q6_name + " is not an IPv6"
+                        " network"
+                    ))
+        if (p_net.get('container_bridge') ==
+                overrides.get('management_bridge')):
+            if (not p_net.get('is_ssh_address') or
+                    not p_net.get('is_container_address')):
+                errors.append(ProviderNetworkMisconfiguration(q_name))
+        for route in p_net.get('static_routes') or []:
+            if not (route.get('cidr') and route.get('gateway')):
+                errors.append(MissingStaticRouteInfo(q_name))
+                break
+    return errors
+
+
+def _config_errors(config, environment):
+    """Return every error found in a user configuration
+
+    The configuration is checked in a single pass: cidr_networks, provider
+    networks, the addresses of the hosts, the lxc_hosts group and the
+    groups having both hosts and child groups.
 
-    # look for same ip address assigned to different hosts
-    _check_same_ip_to_multiple_host(config)
+    :param config: ``dict``  User defined information
+    :param environment: ``dict`` Merged environment
+    :returns: ``list`` Exceptions describing each error, in that order
+    """
+    cidr_networks = config.get('cidr_networks')
+    errors = _cidr_errors(cidr_networks)
+    errors.extend(_provider_network_errors(
+        cidr_networks, config, environment.get('container_skel')
+    ))
+    if not errors:
+        logger.debug("Provider network information OK")
+
+    host_map = _HostAddressMap(config)
+    errors.extend(host_map.shared_ips)
+    errors.extend(host_map.multiple_ips)
+    errors.extend(_lxc_hosts_errors(config))
+    errors.extend(_group_branch_errors(
+        config, environment.get('physical_skel') or {}
+    ))
+    return errors
+
+
+def _check_config_settings(config, environment):
+    """check preciseness of config settings
 
-    _check_multiple_ips_to_host(config)
+    Every error is looked for before any is raised. A single error is raised
+    as is, several are raised together as a ``ConfigValidationError``.
 
-    _check_lxc_hosts(config)
+    :param config: ``dict``  User defined information
+    :param environment: ``dict`` Merged environment
+    :raises: ConfigValidationError
+    """
+    _raise_config_errors(_config_errors(config, environment))
 
 
 def _check_all_conf_groups_present(config, environment):
@@ -998,7 +1358,7 @@ def _check_all_conf_groups_present(config, environment):
     :param environment: ``dict`` group membership mapping
     :rtype: bool, True if all groups are in environment, False otherwise
     """
-    excludes = ('global_overrides', 'cidr_networks', 'used_ips')
+    excludes = ('global_overrides', 'cidr_networks', 'used_ips', 'ipam')
     config_groups = [k for k in config.keys() if k not in excludes]
     env_groups = environment['physical_skel'].keys()
 
@@ -1034,107 +1394,411 @@ def _prepare_debug_logger():
     logger.info("Beginning new inventory run")
 
 
-def main(config=None, check=False, debug=False, environment=None, **kwargs):
-    """Run the main application.
+def ip_report(config=None, **kwargs):
+    """Report the utilisation of every ``cidr_networks`` queue.
+
+    Counters are computed from the user configuration and the existing
+    inventory without generating a new inventory, so no address is
+    allocated and nothing is written.
 
     :param config: ``str`` Directory from which to pull configs and overrides
-    :param check: ``bool`` Flag to enable check mode
-    :param debug: ``bool`` Flag to enable debug logging
-    :param kwargs: ``dict`` Dictionary of arbitrary arguments; mostly for
-        catching Ansible's required `--list` parameter without name shadowing
-        the `list` built-in.
-    :param environment: ``str`` Directory containing the base env.d
+    :param kwargs: ``dict`` Dictionary of arbitrary arguments, as accepted by
+        ``main``.
+    :returns: ``str`` JSON mapping of queue names to their counters
     """
-    if debug:
-        _prepare_debug_logger()
-
     try:
         user_defined_config = filesys.load_user_configuration(config)
     except filesys.MissingDataSource as ex:
         raise SystemExit(ex)
 
-    base_env_dir = environment
-    base_env = filesys.load_environment(base_env_dir, {})
-    environment = filesys.load_environment(config, base_env)
+    inventory, _ = filesys.load_inventory(config, INVENTORY_SKEL,
+                                          backup=False)
+
+    context = ip.AllocationContext.from_config(
+        user_defined_config.get('ipam')
+    )
+    ip.set_used_ips(user_defined_config, inventory, context)
+    user_defined_setup(user_defined_config, inventory, context)
+
+    queues = dict(
+        (name, cidr)
+        for name, cidr in (user_defined_config.get('cidr_networks') or
+                           {}).items()
+        if cidr is not None
+    )
+    manager = context.create_manager(queues)
+
+    return json.dumps(
+        manager.report(),
+        indent=4,
+        separators=(',', ': '),
+        sort_keys=True
+    )
+
+
+def host_vars(host, config=None, **kwargs):
+    """Return the variables of one host of the stored inventory.
+
+    The variables are read through the host index of the stored inventory,
+    which is only generated when none was stored yet.
+
+    :param host: ``str`` Name of the host
+    :param config: ``str`` Directory from which to pull configs and overrides
+    :param kwargs: ``dict`` Dictionary of arbitrary arguments, passed to
+        ``main`` when the inventory has to be generated.
+    :returns: ``str`` JSON object of the host variables, empty if the host
+        is unknown
+    """
+    variables = filesys.load_host_vars(host, config)
+    if variables is None:
+        main(config=config, **kwargs)
+        variables = filesys.load_host_vars(host, config)
+    return variables
+
+
+def _toolkit_files():
+    """Return the paths of the modules generating the inventory."""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    return sorted(
+        os.path.join(base_dir, name)
+        for name in os.listdir(base_dir)
+        if name.endswith('.py')
+    )
+
+
+def _read_inventory(inventory_file):
+    """Return the JSON of a stored inventory."""
+    with open(inventory_file, 'rb') as f:
+        return f.read().decode('ascii')
+
+
+def _fingerprint_inputs(config, environment, stored, load_cached=True):
+    """Fingerprint the inputs of the inventory and look for a cached result.
+
+    The inputs are the user configuration, conf.d, both env.d directories,
+    the existing inventory and the modules of this package. They match the
+    fingerprint stored by the last run when the content hashes of the same
+    set of files are equal; only files whose size or modification time
+    changed are read.
+
+    :param config: ``str`` Directory from which to pull configs and overrides
+    :param environment: ``str`` Directory containing the base env.d
+    :param stored: ``dict`` Fingerprint saved by the last run
+    :param load_cached: ``bool`` Whether to load the stored inventory
+    :returns: ``(dict, dict)`` Fingerprint of the current inputs, and when
+        the inputs are unchanged the ``cached``, ``inventory_file`` and,
+        if loaded, ``inventory`` results of ``build_inventory``, otherwise
+        None
+    """
+    previous = stored.get('files')
+    paths = filesys.input_files(config, environment) + _toolkit_files()
+    fingerprint = {'files': filesys.fingerprint_files(paths, previous)}
+    if 'inventory' not in stored:
+        return fingerprint, None
+    if not filesys.same_contents(previous, fingerprint['files']):
+        return fingerprint, None
+
+    fingerprint['inventory'] = stored['inventory']
+    if 'snapshot' in stored:
+        fingerprint['snapshot'] = stored['snapshot']
+    if fingerprint != stored:
+        # Some files were touched without being changed; remember their new
+        # modification times so that they are not hashed again.
+        filesys.save_fingerprint(fingerprint,
+                                 os.path.dirname(stored['inventory']))
+    cached = {'cached': True, 'inventory_file': stored['inventory']}
+    if load_cached:
+        cached['inventory'] = json.loads(_read_inventory(stored['inventory']))
+    return fingerprint, cached
+
+
+def _same_files(stored, fingerprint, paths):
+    """Return whether some files are unchanged since the last run.
+
+    :param stored: ``dict`` Fingerprint saved by the last run
+    :param fingerprint: ``dict`` Fingerprint of the current inputs
+    :param paths: ``list`` Paths of the files to compare
+    """
+    old_files, new_files = stored['files'], fingerprint['files']
+    return filesys.same_contents(
+        dict((path, old_files[path]) for path in paths if path in old_files),
+        dict((path, new_files[path]) for path in paths if path in new_files)
+    )
+
+
+def _config_snapshot(user_defined_config, environment):
+    """Return a snapshot of the configuration an inventory is generated from.
+
+    The user configuration is kept as is, to be compared host by host; the
+    environment is only kept as a hash. The order of its keys is part of the
+    hash, since groups and containers are created in that order.
+
+    :param user_defined_config: ``dict`` User defined information
+    :param environment: ``dict`` Merged environment
+    """
+    environment_json = json.dumps(environment, default=str)
+    return {
+        'config': json.loads(json.dumps(user_defined_config, default=str)),
+        'environment': hashlib.sha256(
+            environment_json.encode('utf-8')
+        ).hexdigest()
+    }
+
+
+def _changed_hosts(stored, fingerprint, snapshot):
+    """Return the hosts whose configuration changed since the last run.
+
+    Only the entries of the host groups of the user configuration may
+    differ from the snapshot of the last run. The rest of the configuration,
+    the environment, the modules of this package and the stored inventory
+    must be unchanged since that run wrote it.
+
+    Containers are matched to their host by name prefix, so the hosts whose
+    names start with the name of a changed host, or the other way around,
+    are returned as well.
+
+    :param stored: ``dict`` Fingerprint saved by the last run
+    :param fingerprint: ``dict`` Fingerprint of the current inputs
+    :param snapshot: ``dict`` Result of ``_config_snapshot`` for this run
+    :returns: ``set`` Names of the added, changed and removed hosts, or None
+        when the whole inventory has to be generated
+    """
+    previous = stored.get('snapshot')
+    if not previous or previous['environment'] != snapshot['environment']:
+        return None
+
+    if not _same_files(stored, fingerprint,
+                       [stored['inventory']] + _toolkit_files()):
+        return None
+
+    old_config, new_config = previous['config'], snapshot['config']
+    host_groups = [key for key in set(old_config) | set(new_config)
+                   if key.endswith('hosts')]
+    for key in set(old_config) | set(new_config):
+        if key in host_groups:
+            continue
+        if old_config.get(key) != new_config.get(key):
+            return None
+
+    changed = set()
+    names = set()
+    for key in host_groups:
+        old_hosts = old_config.get(key) or {}
+        new_hosts = new_config.get(key) or {}
+        if not (isinstance(old_hosts, dict) and isinstance(new_hosts, dict)):
+            return None
+        names.update(new_hosts)
+        for host in set(old_hosts) | set(new_hosts):
+            if old_hosts.get(host) != new_hosts.get(host):
+                changed.add(host)
+
+    related = set(
+        name for name in names
+        for host in changed
+        if name.startswith(host) or host.startswith(name)
+    )
+    return changed | related
+
+
+def build_inventory(config=None, environment=None, check=False,
+                    context=None):
+    """Generate the inventory and return it as a dictionary.
+
+    This is what ``main`` runs, for callers which use the inventory in
+    process rather than print it.
+
+    Unless running in check mode or with a given context, the stored
+    inventory is returned without being regenerated when none of the inputs
+    changed since the last run. When only host entries of the user
+    configuration changed, only those hosts and their containers and
+    networks are built again; the other hosts keep their entries from the
+    stored inventory.
+
+    :param config: ``str`` Directory from which to pull configs and overrides
+    :param environment: ``str`` Directory containing the base env.d
+    :param check: ``bool`` Flag to enable check mode. The inventory is not
+        written when the configuration is found to be ok.
+    :param context: ``ip.AllocationContext`` Allocation state to use for the
+        run. Each run gets a fresh context by default, so separate calls
+        never share used IP addresses. The IPAM plugin of a default context
+        is selected by the ``ipam`` section of the user configuration.
+    :returns: ``dict`` with the following keys:
+        ``inventory``, the inventory dictionary;
+        ``inventory_file``, the path of the stored inventory, None if it was
+        not written;
+        ``cached``, whether the stored inventory was unchanged;
+        ``checked``, whether check mode found the configuration ok;
+        ``allocation``, the utilisation counters of every ``cidr_networks``
+        queue after the run, None if no addresses were allocated or the
+        IPAM plugin does not report them.
+    """
+    return _build_inventory(config, environment, check, context,
+                            load_cached=True)
+
+
+def _build_inventory(config, environment, check, context, load_cached):
+    """Generate the inventory, see ``build_inventory``.
+
+    :param load_cached: ``bool`` Whether to load the stored inventory when
+        it is unchanged. Otherwise ``inventory`` is None in that case.
+    """
+    result = {
+        'inventory': None,
+        'inventory_file': None,
+        'cached': False,
+        'checked': False,
+        'allocation': None
+    }
+
+    stored = fingerprint = None
+    if not check and context is None:
+        with timing.phase('fingerprint'):
+            stored = filesys.load_fingerprint(config) or {}
+            fingerprint, cached = _fingerprint_inputs(config, environment,
+                                                      stored, load_cached)
+        if cached:
+            logger.debug("Inputs unchanged, using the stored inventory")
+            result.update(cached)
+            return result
+
+    with timing.phase('load_config'):
+        try:
+            user_defined_config = filesys.load_user_configuration(config)
+        except filesys.MissingDataSource as ex:
+            raise SystemExit(ex)
+
+    with timing.phase('load_environment'):
+        base_env_dir = environment
+        base_env = filesys.load_environment(base_env_dir, {})
+        environment = filesys.load_environment(config, base_env)
 
     # Load existing inventory file if found
     inventory, inv_path = filesys.load_inventory(config, INVENTORY_SKEL)
+    _ordered_groups(inventory)
 
-    # Save the users container cidr as a group variable
-    cidr_networks = user_defined_config.get('cidr_networks')
-    if not cidr_networks:
-        raise SystemExit('No container CIDR specified in user config')
+    snapshot = limit_hosts = None
+    if fingerprint is not None:
+        with timing.phase('config_diff'):
+            snapshot = _config_snapshot(user_defined_config, environment)
+            limit_hosts = _changed_hosts(stored, fingerprint, snapshot)
+        if limit_hosts is not None:
+            logger.debug("Only building hosts %s", sorted(limit_hosts))
 
+    # make sure user_defined config is self contained
+    with timing.phase('validate'):
+        _check_config_settings(user_defined_config, environment)
+
+    # Save the users container cidr as a group variable
+    cidr_networks = user_defined_config['cidr_networks']
     if 'container' in cidr_networks:
         user_cidr = cidr_networks['container']
-    elif 'management' in cidr_networks:
-        user_cidr = cidr_networks['management']
     else:
-        raise SystemExit('No container or management network '
-                         'specified in user config.')
-
-    # make sure user_defined config is self contained
-    _check_config_settings(
-        cidr_networks,
-        user_defined_config,
-        environment.get('container_skel')
-    )
+        user_cidr = cidr_networks['management']
 
     # Add the container_cidr into the all global ansible group_vars
     _parse_global_variables(user_cidr, inventory, user_defined_config)
 
-    # Load all of the IP addresses that we know are used and set the queue
-    ip.set_used_ips(user_defined_config, inventory)
-    user_defined_setup(user_defined_config, inventory)
-    skel_setup(environment, inventory)
+    if context is None:
+        context = ip.AllocationContext.from_config(
+            user_defined_config.get('ipam')
+        )
 
-    _check_group_branches(
-        user_defined_config,
-        environment.get('physical_skel')
-    )
-    logger.debug("Loading physical skel.")
-    skel_load(
-        environment.get('physical_skel'),
-        inventory
-    )
-    logger.debug("Loading component skel")
-    skel_load(
-        environment.get('component_skel'),
-        inventory
-    )
+    with timing.phase('skeleton'):
+        # Load all of the IP addresses that we know are used and set the
+        # queue
+        ip.set_used_ips(user_defined_config, inventory, context)
+        user_defined_setup(user_defined_config, inventory, context,
+                           limit_hosts)
+        skeleton = sk.Skeleton.compile(environment)
+        skel_setup(environment, inventory, skeleton)
+
+        logger.debug("Loading physical and component skel.")
+        for parent, child in skeleton.edges:
+            _parse_belongs_to(child, [parent], inventory)
     container_skel_load(
         environment.get('container_skel'),
         inventory,
-        user_defined_config
+        user_defined_config,
+        context,
+        limit_hosts,
+        skeleton
     )
 
     # Look at inventory and ensure all entries have all required values.
-    _ensure_inventory_uptodate(
-        inventory=inventory,
-        container_skel=environment.get('container_skel'),
-    )
+    with timing.phase('ensure_uptodate'):
+        _ensure_inventory_uptodate(
+            inventory=inventory,
+            container_skel=environment.get('container_skel'),
+        )
+    result['inventory'] = inventory
+    timing.count('hosts', len(inventory['_meta']['hostvars']))
 
-    # Load the inventory json
-    inventory_json = json.dumps(
-        inventory,
-        indent=4,
-        separators=(',', ': '),
-        sort_keys=True
-    )
+    if context.manager is not None:
+        try:
+            result['allocation'] = context.manager.report()
+        except NotImplementedError:
+            pass
 
     if check:
         if _check_all_conf_groups_present(user_defined_config, environment):
-            return 'Configuration ok!'
+            result['checked'] = True
+            return result
 
     # Save a list of all hosts and their given IP addresses
-    hostnames_ips = _collect_hostnames(inventory)
-    filesys.write_hostnames(config, hostnames_ips)
+    with timing.phase('write_hostnames'):
+        hostnames_ips = _collect_hostnames(inventory)
+        filesys.write_hostnames(config, hostnames_ips)
 
     if logger.isEnabledFor(logging.DEBUG):
         num_hosts = len(inventory['_meta']['hostvars'])
         logger.debug("%d hosts found.", num_hosts)
 
     # Save new dynamic inventory
-    filesys.save_inventory(inventory_json, inv_path)
+    with timing.phase('write_inventory'):
+        inventory_file = filesys.write_inventory(inventory, inv_path)
+    result['inventory_file'] = inventory_file
+
+    # Commit the allocations made by transactional IPAM plugins
+    if context.manager is not None:
+        try:
+            context.manager.save()
+        except NotImplementedError:
+            pass
+
+    # Remember the inputs this inventory was generated from
+    if fingerprint is not None:
+        with timing.phase('save_fingerprint'):
+            fingerprint['files'].update(
+                filesys.fingerprint_files([inventory_file])
+            )
+            fingerprint['inventory'] = inventory_file
+            fingerprint['snapshot'] = snapshot
+            filesys.save_fingerprint(fingerprint, inv_path)
+
+    return result
+
+
+def main(config=None, check=False, debug=False, environment=None,
+         context=None, **kwargs):
+    """Run the main application.
+
+    :param config: ``str`` Directory from which to pull configs and overrides
+    :param check: ``bool`` Flag to enable check mode
+    :param debug: ``bool`` Flag to enable debug logging
+    :param kwargs: ``dict`` Dictionary of arbitrary arguments; mostly for
+        catching Ansible's required `--list` parameter without name shadowing
+        the `list` built-in.
+    :param environment: ``str`` Directory containing the base env.d
+    :param context: ``ip.AllocationContext`` Allocation state to use for the
+        run, see ``build_inventory``.
+    :returns: ``str`` JSON of the inventory, as stored
+    """
+    if debug:
+        _prepare_debug_logger()
 
-    return inventory_json
+    result = _build_inventory(config, environment, check, context,
+                              load_cached=False)
+    if result['checked']:
+        return 'Configuration ok!'
+    with timing.phase('read_inventory'):
+        return _read_inventory(result['inventory_file'])
@@ -16,99 +16,495 @@
 # (c) 2014, Kevin Carter <kevin.carter@rackspace.com>
 # (c) 2016, Nolan Brubaker <nolan.brubaker@rackspace.com>
 
-import copy
+import bisect
+import collections
+import hashlib
+import inspect
 import logging
 import netaddr
-try:
-    import Queue
-except ImportError:
-    import queue as Queue
+from osa_toolkit import timing
 import random
+import sqlite3
 
 logger = logging.getLogger('osa-inventory')
 
 
-USED_IPS = set()
+# IPv4 addresses are stored as IPv4-mapped IPv6 integers (::ffff:a.b.c.d) so
+# that both address families can share a single integer space without
+# colliding.
+_V4_MAPPED = 0xffff00000000
+_V4_MAX = 0xffffffff
 
 
-def get_ip_address(name, ip_q):
-    """Return an IP address from our IP Address queue."""
+def _ip_to_int(ip):
+    """Convert an IP address into its integer key.
+
+    :param ip: ``str`` IP address
+    :returns: ``int`` Integer representation, IPv4 addresses being mapped
+        into the IPv6 space.
+    """
+    addr = netaddr.IPAddress(ip)
+    if addr.version == 4:
+        return addr.value + _V4_MAPPED
+    return addr.value
+
+
+def _int_to_ip(value):
+    """Convert an integer key created by ``_ip_to_int`` into an IP address.
+
+    :param value: ``int`` Integer representation of an address
+    :returns: ``str`` IP address
+    """
+    if _V4_MAPPED <= value <= _V4_MAPPED + _V4_MAX:
+        return str(netaddr.IPAddress(value - _V4_MAPPED, 4))
+    return str(netaddr.IPAddress(value, 6))
+
+
+def _canonical(ip):
+    """Return the canonical string form of an IP address."""
+    return _int_to_ip(_ip_to_int(ip))
+
+
+def _stable_hash(*parts):
+    """Return a 64bit hash of some strings, stable across processes."""
+    digest = hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+    return int(digest[:16], 16)
+
+
+def _count(start, end):
+    """Yield the integers ``start`` to ``end`` inclusive, of any size."""
+    while start <= end:
+        yield start
+        start += 1
+
+
+def _network_bounds(net):
+    """Return the first and last integer keys of a ``netaddr.IPNetwork``."""
+    offset = _V4_MAPPED if net.version == 4 else 0
+    return net.first + offset, net.last + offset
+
+
+def _prefixlen(net):
+    """Return the prefix length of a network within the IPv6 key space."""
+    if net.version == 4:
+        return net.prefixlen + 96
+    return net.prefixlen
+
+
+class IntervalSet(object):
+    """Set of integers stored as sorted, non-overlapping inclusive ranges.
+
+    Memory use scales with the number of distinct ranges held rather than
+    the number of members, so marking a whole network as used costs the same
+    as marking a single address.
+    """
+    def __init__(self, ranges=None):
+        self._starts = []
+        self._ends = []
+        self._size = 0
+        for start, end in ranges or ():
+            self.add_range(start, end)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, value):
+        index = bisect.bisect_right(self._starts, value) - 1
+        return index >= 0 and self._ends[index] >= value
+
+    def __iter__(self):
+        for start, end in self.ranges():
+            for value in _count(start, end):
+                yield value
+
+    def __eq__(self, other):
+        if not isinstance(other, IntervalSet):
+            return NotImplemented
+        return self._starts == other._starts and self._ends == other._ends
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def ranges(self):
+        """Return the ``(start, end)`` tuples making up the set."""
+        return list(zip(self._starts, self._ends))
+
+    def copy(self):
+        new = IntervalSet()
+        new._starts = list(self._starts)
+        new._ends = list(self._ends)
+        new._size = self._size
+        return new
+
+    def add(self, value):
+        self.add_range(value, value)
+
+    def discard(self, value):
+        self.discard_range(value, value)
+
+    def add_range(self, start, end):
+        """Add all integers between ``start`` and ``end`` inclusive.
+
+        Overlapping and adjacent ranges are merged.
+        """
+        if start > end:
+            return
+        starts, ends = self._starts, self._ends
+        first = bisect.bisect_left(ends, start - 1)
+        last = bisect.bisect_right(starts, end + 1)
+        removed = 0
+        if first < last:
+            start = min(start, starts[first])
+            end = max(end, ends[last - 1])
+            for index in range(first, last):
+                removed += ends[index] - starts[index] + 1
+        starts[first:last] = [start]
+        ends[first:last] = [end]
+        self._size += end - start + 1 - removed
+
+    def discard_range(self, start, end):
+        """Remove all integers between ``start`` and ``end`` inclusive."""
+        if start > end:
+            return
+        starts, ends = self._starts, self._ends
+        first = bisect.bisect_left(ends, start)
+        last = bisect.bisect_right(starts, end)
+        if first >= last:
+            return
+        removed = 0
+        for index in range(first, last):
+            removed += ends[index] - starts[index] + 1
+        new_starts = []
+        new_ends = []
+        if starts[first] < start:
+            new_starts.append(starts[first])
+            new_ends.append(start - 1)
+            removed -= start - starts[first]
+        if ends[last - 1] > end:
+            new_starts.append(end + 1)
+            new_ends.append(ends[last - 1])
+            removed -= ends[last - 1] - end
+        starts[first:last] = new_starts
+        ends[first:last] = new_ends
+        self._size -= removed
+
+    def count(self, start, end):
+        """Return how many members fall between ``start`` and ``end``."""
+        starts, ends = self._starts, self._ends
+        total = 0
+        index = bisect.bisect_left(ends, start)
+        while index < len(starts) and starts[index] <= end:
+            total += min(end, ends[index]) - max(start, starts[index]) + 1
+            index += 1
+        return total
+
+    def gaps(self, start, end):
+        """Yield ``(start, end)`` ranges between the bounds not in the set."""
+        starts, ends = self._starts, self._ends
+        index = bisect.bisect_left(ends, start)
+        cursor = start
+        while index < len(starts) and starts[index] <= end:
+            if starts[index] > cursor:
+                yield cursor, starts[index] - 1
+            cursor = max(cursor, ends[index] + 1)
+            index += 1
+        if cursor <= end:
+            yield cursor, end
+
+
+class IPRanges(object):
+    """Set of IP addresses stored as merged ranges.
+
+    Both single addresses and whole ranges can be added in constant memory,
+    and membership tests are a binary search over the stored ranges.
+    """
+    def __init__(self, ips=None):
+        self.intervals = IntervalSet()
+        if ips is not None:
+            self.update(ips)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def __contains__(self, ip):
+        try:
+            return _ip_to_int(ip) in self.intervals
+        except (netaddr.AddrFormatError, TypeError, ValueError):
+            return False
+
+    def __iter__(self):
+        for value in self.intervals:
+            yield _int_to_ip(value)
+
+    def add(self, ip):
+        self.intervals.add(_ip_to_int(ip))
+
+    def discard(self, ip):
+        self.intervals.discard(_ip_to_int(ip))
+
+    def update(self, ips):
+        if isinstance(ips, IPRanges):
+            for start, end in ips.intervals.ranges():
+                self.intervals.add_range(start, end)
+            return
+        for ip in ips:
+            self.add(ip)
+
+    def add_range(self, start, end):
+        """Add every address from ``start`` to ``end`` inclusive."""
+        self.intervals.add_range(_ip_to_int(start), _ip_to_int(end))
+
+
+class AllocationContext(object):
+    """IP allocation state for a single inventory run.
+
+    A context is created for every run and passed to the functions which
+    reserve or hand out addresses, so that several inventories can be built
+    in one process without sharing state.
+
+    Addresses are handed out by an :class:`IPBasePlugin` instance, created
+    through :method:`AllocationContext.create_manager` once all of the used
+    addresses are known.
+    """
+    def __init__(self, used_ips=None, plugin=None, options=None):
+        """Create a context
+
+        :param used_ips: Iterable of IP addresses already in use. Addresses
+            found assigned to hosts are also recorded in ``allocated_ips``,
+            the others are reserved.
+        :param plugin: ``str`` Name of the IPAM plugin to allocate with.
+            Defaults to ``DEFAULT_PLUGIN``.
+        :param options: ``dict`` Keyword arguments for the plugin.
+        """
+        self.used_ips = IPRanges(used_ips)
+        self.allocated_ips = IPRanges()
+        self.plugin = plugin or DEFAULT_PLUGIN
+        self.options = options or {}
+        self.manager = None
+
+    @classmethod
+    def from_config(cls, ipam_config):
+        """Create a context from the ``ipam`` section of user config.
+
+        :param ipam_config: ``dict`` Mapping with optional ``plugin`` and
+            ``options`` keys, or None to use the defaults.
+        """
+        ipam_config = ipam_config or {}
+        return cls(plugin=ipam_config.get('plugin'),
+                   options=ipam_config.get('options'))
+
+    def create_manager(self, queues=None, owners=None):
+        """Create the IPAM plugin instance for this run.
+
+        :param queues: ``dict`` Queue names mapped to their CIDR
+        :param owners: ``dict`` Variables of every host in inventory, keyed
+            by host name, passed to the plugin so it can forget hosts that
+            were removed.
+        :returns: ``IPBasePlugin`` The new plugin instance, also stored as
+            ``manager``.
+        """
+        plugin_class = get_plugin(self.plugin)
+        self.manager = plugin_class(queues=queues, used_ips=self.used_ips,
+                                    **self.options)
+        self.manager.mark_allocated(self.allocated_ips)
+        if owners is not None:
+            self.manager.reconcile(owners)
+        return self.manager
+
+
+_MASK64 = 0xffffffffffffffff
+
+
+class AddressPermutation(object):
+    """Keyed pseudo-random permutation of the offsets ``0 .. size - 1``.
+
+    Offsets are shuffled with a small Feistel network over the next even
+    power of two above ``size``, cycle walking any value that falls outside
+    of the range. Any offset can be looked up in constant time and without
+    materialising the range, so networks of any size can be walked in a
+    random order.
+    """
+    rounds = 4
+
+    def __init__(self, size, key=None):
+        """Create a permutation over ``size`` offsets.
+
+        :param size: ``int`` Number of offsets to permute
+        :param key: ``int`` Key selecting the permutation. A random key is
+            used if none is given.
+        """
+        if key is None:
+            key = random.getrandbits(64)
+
+        self.size = size
+        self._half_bits = max(((size - 1).bit_length() + 1) // 2, 1)
+        self._half_mask = (1 << self._half_bits) - 1
+        self._keys = []
+        for round_number in range(self.rounds):
+            key = self._mix(key + round_number)
+            self._keys.append(key)
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def _mix(value):
+        """Return a 64bit hash of ``value`` (splitmix64 finaliser)."""
+        value = (value + 0x9e3779b97f4a7c15) & _MASK64
+        value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+        value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & _MASK64
+        return value ^ (value >> 31)
+
+    def _encrypt(self, value):
+        left = value >> self._half_bits
+        right = value & self._half_mask
+        for key in self._keys:
+            mixed = self._mix((right ^ key) & _MASK64) & self._half_mask
+            left, right = right, left ^ mixed
+        return (left << self._half_bits) | right
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError("Permutation index out of range")
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+
+_EXHAUSTED_MESSAGE = (
+    'Cannot retrieve requested amount of IP addresses. Increase the %s'
+    ' range in your openstack_user_config.yml.'
+)
+
+
+def _takes_owner(get):
+    """Return whether a plugin ``get`` method accepts an ``owner`` argument.
+
+    Plugins written before owners were passed implement
+    ``get(self, queue_name)`` only.
+
+    :param get: Bound ``get`` method of a plugin
+    """
     try:
-        ip_addr = ip_q.get(timeout=1)
-        while ip_addr in USED_IPS:
-            ip_addr = ip_q.get(timeout=1)
-        else:
-            USED_IPS.add(ip_addr)
-            return str(ip_addr)
+        spec = inspect.getfullargspec(get)
+        keywords = spec.varkw
+        names = spec.args + spec.kwonlyargs
     except AttributeError:
-        return None
-    except Queue.Empty:
-        raise SystemExit(
-            'Cannot retrieve requested amount of IP addresses. Increase the %s'
-            ' range in your openstack_user_config.yml.' % name
-        )
+        # Python 2
+        spec = inspect.getargspec(get)
+        keywords = spec.keywords
+        names = spec.args
+    return keywords is not None or 'owner' in names
 
 
-def load_ip_q(cidr, ip_q):
-    """Load the IP queue with all IP addresses from a given cidr.
+def _plugin_get(ip_q, name, owner=None):
+    """Get an address from a plugin, naming the owner if it accepts one.
 
-    :param cidr: ``str``  IP address with cidr notation
+    :param ip_q: ``IPBasePlugin`` Plugin instance managing the queues
+    :param name: ``str`` Name of the queue to take the address from
+    :param owner: ``str`` Name of the host the address is for
     """
-    _all_ips = [str(i) for i in list(netaddr.IPNetwork(cidr))]
-    base_exclude = [
-        str(netaddr.IPNetwork(cidr).network),
-        str(netaddr.IPNetwork(cidr).broadcast)
-    ]
-    USED_IPS.update(base_exclude)
-    for ip in random.sample(_all_ips, len(_all_ips)):
-        if ip not in USED_IPS:
-            ip_q.put(ip)
-
-
-def load_optional_q(config, cidr_name):
-    """Load optional queue with ip addresses.
-
-    :param config: ``dict``  User defined information
-    :param cidr_name: ``str``  Name of the cidr name
+    if _takes_owner(ip_q.get):
+        return ip_q.get(name, owner=owner)
+    return ip_q.get(name)
+
+
+def get_ip_address(name, ip_q, owner=None):
+    """Return an IP address from a queue of an IPAM plugin.
+
+    :param name: ``str`` Name of the queue to take the address from
+    :param ip_q: ``IPBasePlugin`` Plugin instance managing the queues
+    :param owner: ``str`` Name of the host the address is for
+    :returns: IP address, or None if there is no plugin or no such queue
     """
-    cidr = config.get(cidr_name)
-    ip_q = None
-    if cidr is not None:
-        ip_q = Queue.Queue()
-        load_ip_q(cidr=cidr, ip_q=ip_q)
-    return ip_q
+    try:
+        address = _plugin_get(ip_q, name, owner=owner)
+    except (AttributeError, NoSuchQueue):
+        return None
+    except EmptyQueue:
+        raise SystemExit(_EXHAUSTED_MESSAGE % name)
+    if address:
+        timing.count('ips_allocated')
+    return address
+
 
+def reserve_ip_addresses(ip_q, owners):
+    """Reserve every IP address needed by a run up front.
 
-def set_used_ips(user_defined_config, inventory):
-    """Set all of the used ips into a global list.
+    Addresses are reserved with one ``get_many`` call per queue. If any
+    queue cannot satisfy its whole request, everything reserved so far is
+    released before exiting, so no partial allocation is left behind.
+
+    :param ip_q: ``IPBasePlugin`` Plugin instance managing the queues
+    :param owners: ``dict`` Queue names mapped to the list of hosts needing
+        an address from that queue. Unknown queues are ignored.
+    :returns: ``Reservation`` holding the reserved addresses
+    """
+    reservation = Reservation(ip_q)
+    for name, hosts in owners.items():
+        try:
+            reservation.reserve(name, hosts)
+        except NoSuchQueue:
+            continue
+        except EmptyQueue:
+            reservation.release_unused()
+            raise SystemExit(_EXHAUSTED_MESSAGE % name)
+    return reservation
+
+
+def set_used_ips(user_defined_config, inventory, context):
+    """Set all of the used ips into the allocation context.
+
+    Ranges given as ``"start,end"`` are stored as a single interval rather
+    than being expanded into individual addresses.
 
     :param user_defined_config: ``dict`` User defined configuration
     :param inventory: ``dict`` Living inventory of containers and hosts
+    :param context: ``AllocationContext`` Allocation state of the run
     """
     used_ips = user_defined_config.get('used_ips')
     if isinstance(used_ips, list):
         for ip in used_ips:
             split_ip = ip.split(',')
             if len(split_ip) >= 2:
-                ip_range = list(
-                    netaddr.iter_iprange(
-                        split_ip[0],
-                        split_ip[-1]
-                    )
-                )
-                USED_IPS.update([str(i) for i in ip_range])
+                logger.debug("IP range %s - %s set as used",
+                             split_ip[0], split_ip[-1])
+                context.used_ips.add_range(split_ip[0].strip(),
+                                           split_ip[-1].strip())
             else:
                 logger.debug("IP %s set as used", split_ip[0])
-                USED_IPS.add(split_ip[0])
+                context.used_ips.add(split_ip[0])
 
     # Find all used IP addresses and ensure that they are not used again
     for host_entry in inventory['_meta']['hostvars'].values():
-        networks = host_entry.get('container_networks', dict())
-        for network_entry in networks.values():
-            address = network_entry.get('address')
+        for address in _host_addresses(host_entry):
+            logger.debug("IP %s set as used", address)
+            context.used_ips.add(address)
+            context.allocated_ips.add(address)
+
+
+def _ip_ranges(ips):
+    """Return the integer ranges of ``IPRanges`` or of a list of addresses."""
+    if isinstance(ips, IPRanges):
+        return ips.intervals.ranges()
+    return [(_ip_to_int(ip), _ip_to_int(ip)) for ip in ips]
+
+
+def _host_addresses(host_entry):
+    """Yield the IPv4 and IPv6 addresses of the networks of a host.
+
+    :param host_entry: ``dict`` Variables of the host in inventory
+    """
+    networks = host_entry.get('container_networks') or {}
+    for network_entry in networks.values():
+        for key in ('address', 'address_v6'):
+            address = network_entry.get(key)
             if address:
-                logger.debug("IP %s set as used", address)
-                USED_IPS.add(address)
+                yield address
 
 
 class NoSuchQueue(Exception):
@@ -119,6 +515,17 @@ class EmptyQueue(Exception):
     pass
 
 
+def _owners_for(count, owners):
+    """Return a list of ``count`` owners, defaulting every owner to None."""
+    if owners is None:
+        return [None] * count
+    owners = list(owners)
+    if len(owners) != count:
+        raise ValueError("Expected {0} owners, got {1}".format(count,
+                                                               len(owners)))
+    return owners
+
+
 class IPBasePlugin(object):
     def load(self, queue_name, cidr):
         """Create and populate a queue with IP addresses
@@ -133,17 +540,44 @@ class IPBasePlugin(object):
         """
         raise NotImplementedError
 
-    def get(self, queue_name):
+    def get(self, queue_name, owner=None):
         """Reserve an IP address from a given queue.
 
         Should raise NoSuchQueue when the given queue name is not found,
         and EmptyQueue if the queue is empty.
 
+        ``owner`` names the host the address is for. Plugins may record it,
+        or use it to return the address already held by that host. It is
+        optional: plugins whose ``get`` takes no ``owner`` argument are
+        called with the queue name only.
+
         Some plugin implementations may be transactional, and require a call to
         ``save`` after reserving an IP.
         """
         raise NotImplementedError
 
+    def get_many(self, queue_name, count, owners=None):
+        """Reserve several IP addresses from a given queue at once.
+
+        Either all ``count`` addresses are reserved, or none are and
+        EmptyQueue is raised. ``owners`` optionally names the host for each
+        address, in order.
+
+        This default implementation calls ``get`` repeatedly and releases
+        what it got if the queue runs out. Plugins whose ``get`` may return
+        an address already held by an owner should override it.
+        """
+        owners = _owners_for(count, owners)
+        addresses = []
+        try:
+            for owner in owners:
+                addresses.append(_plugin_get(self, queue_name, owner=owner))
+        except EmptyQueue:
+            for address in addresses:
+                self.release(address)
+            raise
+        return addresses
+
     def release(self, ip):
         """Release an IP back into queues as assignable.
 
@@ -160,27 +594,178 @@ class IPBasePlugin(object):
         """
         raise NotImplementedError
 
+    def mark_allocated(self, ips):
+        """Record addresses which are already assigned to hosts.
+
+        The addresses are also part of ``used_ips``, so plugins that do not
+        keep utilisation counters can ignore this call.
+        """
+        pass
+
+    def reconcile(self, owners):
+        """Forget the addresses recorded for hosts no longer in inventory.
+
+        ``owners`` maps the name of every host in the inventory to its
+        variables. Plugins that do not record owners can ignore this call.
+        """
+        pass
+
+    def stats(self, queue_name):
+        """Return the utilisation counters of a queue.
+
+        This method is optional to implement. See :method:`IPManager.stats`
+        for the counters returned.
+        """
+        raise NotImplementedError
+
+    def report(self):
+        """Return the utilisation counters of every queue, keyed by name.
+
+        This method is optional to implement.
+        """
+        raise NotImplementedError
+
+
+class _Pool(object):
+    """Allocation state for a single named queue.
+
+    Addresses are taken from a FIFO of released addresses first, then from
+    the permutation walk, so both taking and returning an address are
+    constant time.
+    """
+    def __init__(self, net, key=None):
+        self.first, self.last = _network_bounds(net)
+        self.permutation = AddressPermutation(self.last - self.first + 1,
+                                              key=key)
+        self.cursor = 0
+        self.released = collections.deque()
+        # Number of free addresses, None until it is counted again
+        self.free = None
+
+    def free_count(self, used):
+        """Return the number of free addresses, counting them if unknown."""
+        if self.free is None:
+            self.free = sum(end - start + 1
+                            for start, end in used.gaps(self.first, self.last))
+        return self.free
+
+    def walk(self, used):
+        """Yield free addresses in allocation order without consuming them.
+
+        Released addresses come first, followed by the remainder of the
+        permutation and any addresses behind the cursor which have since
+        been freed.
+        """
+        seen = IntervalSet()
+        for address in self.released:
+            if address not in used and address not in seen:
+                seen.add(address)
+                yield address
+        # Offsets of an IPv6 network do not fit in a range() on every
+        # interpreter, so count them by hand.
+        index = self.cursor
+        while index < self.permutation.size:
+            address = self.first + self.permutation[index]
+            index += 1
+            if address not in used and address not in seen:
+                seen.add(address)
+                yield address
+        for start, end in used.gaps(self.first, self.last):
+            for address in _count(start, end):
+                if address not in seen:
+                    yield address
+
+    def give(self, address):
+        """Queue a freed address to be handed out again."""
+        self.released.append(address)
+
+    def take(self, used):
+        """Return the next free address, or None if the pool is exhausted."""
+        while self.released:
+            address = self.released.popleft()
+            if address not in used:
+                return address
+        while self.cursor < self.permutation.size:
+            address = self.first + self.permutation[self.cursor]
+            self.cursor += 1
+            if address not in used:
+                return address
+        # The walk is complete, so anything still free was freed without
+        # passing through release(), e.g. by emptying the used set.
+        return self.lowest(used)
+
+    def lowest(self, used):
+        """Return the lowest free address, or None if there is none."""
+        for start, _ in used.gaps(self.first, self.last):
+            return start
+        return None
+
+    def probe(self, used, digest):
+        """Return the first free address at or after the address of a digest.
+
+        The probe starts at the address of the permutation position picked
+        by the digest. If it is used, the probe jumps past the used range
+        holding it, wrapping around to the start of the network, so the
+        result only depends on the digest and on which addresses are used,
+        and costs a lookup in the used ranges whatever their size.
+        """
+        start = self.first + self.permutation[digest % self.permutation.size]
+        for low, high in ((start, self.last), (self.first, start - 1)):
+            for address, _ in used.gaps(low, high):
+                return address
+        return None
+
 
 class IPManager(IPBasePlugin):
     """Class to manage CIDRs and IPs from openstack-ansible inventory config
 
     CIDRs are managed via queues, which will be named for convenience. All IP
     addresses assigned are saved into the :method:`IPManager.used` set and
-    removed from their respective queue.
+    are no longer handed out by any queue.
+
+    Queues and used addresses are both kept as integer ranges, so memory
+    scales with the number of allocations rather than with the size of the
+    networks being managed. Each queue walks a keyed pseudo-random
+    permutation of its network, skipping used addresses as it goes.
+
+    With ``hashed`` placement the permutations are keyed by queue name and
+    CIDR, and an address requested for an owner is the first free address
+    from a position derived from a hash of the queue name and owner. Each
+    queue keeps a count of its free addresses, so an exhausted queue is
+    found without probing. Allocations
+    are then reproducible: the same inputs always give the same addresses,
+    whatever order the owners are processed in, unless their probes
+    collide. With ``sequential`` placement the lowest free address is
+    always handed out.
+
+    Networks of either address family are supported. Nothing is ever
+    enumerated, so an IPv6 /64 costs no more than an IPv4 /24, but listing
+    the free addresses of such a queue is not practical.
 
     IP addresses that are no longer in use may be freed back into the queues
     with the :method:`IPManager.release` method.
 
     """
-    def __init__(self, queues=None, used_ips=None):
+    placements = ('random', 'hashed', 'sequential')
+
+    def __init__(self, queues=None, used_ips=None, placement='random'):
         """Create a manager with various queues and a used IP blacklist
 
         :param queues: ``dict`` A dictionary containing queue names for keys
             and CIDR specifications for values.
         :param used_ips: ``set`` A set of IP addresses which are marked as used
-            and unassignable. Any iterable will be coerced into a set to remove
-            duplicate entries.
+            and unassignable. Any iterable is accepted; duplicate entries are
+            collapsed. An ``IPRanges`` object is copied range by range.
+        :param placement: ``str`` How addresses are picked, one of
+            ``random``, ``hashed`` or ``sequential``.
         """
+        if placement not in self.placements:
+            raise ValueError(
+                "Unknown IP placement {0}, expected one of {1}".format(
+                    placement, ', '.join(self.placements)
+                )
+            )
+        self._placement = placement
 
         if queues is None:
             queues = {}
@@ -188,16 +773,28 @@ class IPManager(IPBasePlugin):
         if used_ips is None:
             used_ips = set()
 
-        # If we receive a set already, this is essentially a no-op,
-        # not a wrapper.
-        self._used_ips = set(used_ips)
-        self._queues = queues
+        if isinstance(used_ips, IPRanges):
+            self._used_ips = used_ips.intervals.copy()
+        else:
+            self._used_ips = IntervalSet()
+            for ip in used_ips:
+                self._used_ips.add(_ip_to_int(ip))
+
+        # Used addresses which were not handed out to a host. Everything in
+        # the used set but not in here counts as allocated.
+        self._reserved = self._used_ips.copy()
+
+        # Queues map a name to the _Pool tracking its allocation walk.
+        self._queues = {}
 
         # The networks will be netaddr.IPNetwork objects for a given CIDR,
-        # kept so that if an IP is released from use, it is returned to the
-        # associated queue.
+        # kept so that callers can look up the CIDR backing a queue.
         self._networks = {}
 
+        # Index of queue names by prefix length and network, used to find
+        # the queues owning an address without testing every network.
+        self._prefix_index = {}
+
         # Populate any queues that were passed in already.
         for name, cidr in queues.items():
             self.load(name, cidr)
@@ -209,12 +806,13 @@ class IPManager(IPBasePlugin):
         IP addresses within this set will be masked when requesting a new IP,
         and thus not be returned to callers.
 
-        Set returned is a copy of the internal data structure.
+        Set returned is built from the internal ranges, so this is expensive
+        for large used ranges.
 
         :return: Set of IP addresses currently in use
         :rtrype: set
         """
-        return set(self._used_ips)
+        return set(_int_to_ip(i) for i in self._used_ips)
 
     @used.deleter
     def used(self):
@@ -223,34 +821,66 @@ class IPManager(IPBasePlugin):
         Any IP used will also be released back in to the associated
         queue.
         """
-        used_ips = set(self._used_ips)
-        for ip in used_ips:
-            self.release(ip)
-        self._used_ips = set()
+        self._used_ips = IntervalSet()
+        self._reserved = IntervalSet()
+        self._recount()
+
+    def _recount(self):
+        """Have every queue count its free addresses again when needed."""
+        for pool in self._queues.values():
+            pool.free = None
+
+    def _mark_used(self, address):
+        """Mark a free address as used, updating the queues holding it."""
+        self._used_ips.add(address)
+        for name in self._queues_for(address):
+            pool = self._queues[name]
+            if pool.free is not None:
+                pool.free -= 1
+
+    def _mark_free(self, address):
+        """Remove an address from the used set, updating its queues."""
+        if address not in self._used_ips:
+            return
+        self._used_ips.discard(address)
+        for name in self._queues_for(address):
+            pool = self._queues[name]
+            if pool.free is not None:
+                pool.free += 1
 
     @property
     def queues(self):
         """Dictionary of named queues, populated with IPs for a given CIDR.
 
-        Return values here are copies, to protect the internal structures
-        from unintentional changes.
+        Every queue is expanded into a list of its free addresses, so this is
+        only suitable for small networks.
         """
-        return copy.deepcopy(self._queues)
+        return dict((name, self[name]) for name in self._queues)
 
     def __getitem__(self, key):
-        """Short hand for accessing a named queue
+        """Short hand for listing the free addresses of a named queue
 
-        The list returned is a copy of the internal queue.
+        The list returned is built on each call, in the order the addresses
+        would be handed out to callers without an owner.
         """
-        return list(self._queues[key])
+        pool = self._queues[key]
+        if self._placement == 'sequential':
+            return [_int_to_ip(i)
+                    for start, end in self._used_ips.gaps(pool.first,
+                                                          pool.last)
+                    for i in _count(start, end)]
+        return [_int_to_ip(i) for i in pool.walk(self._used_ips)]
 
     def load(self, queue_name, cidr):
-        """Populates a named queue with all IPs in a CIDR
+        """Registers a named queue covering all IPs in a CIDR
 
-        Queues are implemented as a list, and will be populated by all IP
-        addresses within a CIDR, with the following exceptions:
+        A queue will hand out the IP addresses within a CIDR, with the
+        following exceptions:
             * The network and broadcast IP addresses
-            * Any IP address already in the used_ips set
+            * Any IP address in the used_ips set
+
+        No per address work is done, so loading a large network is as cheap
+        as loading a small one.
 
         :param queue_name: ``str`` Name to apply to a given CIDR
         :param cidr: ``str`` CIDR notation specifying range of IP addresses
@@ -258,68 +888,574 @@ class IPManager(IPBasePlugin):
         """
         net = netaddr.IPNetwork(cidr)
 
-        initial_ips = [str(i) for i in list(net)]
+        # We will never want to assign these to machines. IPv6 has no
+        # broadcast address, only the subnet-router anycast address.
+        excluded = [net.network]
+        if net.version == 4:
+            excluded.append(net.broadcast)
+        for address in excluded:
+            if address is not None:
+                self._used_ips.add(_ip_to_int(address))
+                self._reserved.add(_ip_to_int(address))
+
+        if queue_name in self._networks:
+            self._unindex(queue_name)
+
+        key = None
+        if self._placement == 'hashed':
+            key = _stable_hash(queue_name, str(net.cidr))
+        pool = self._queues[queue_name] = _Pool(net, key=key)
+        self._networks[queue_name] = net
 
-        # We will never want to assign these to machines.
+        prefixlen = _prefixlen(net)
+        networks = self._prefix_index.setdefault(prefixlen, {})
+        key = pool.first >> (128 - prefixlen)
+        networks.setdefault(key, []).append(queue_name)
+
+        # The excluded addresses may belong to other queues as well.
+        self._recount()
+
+    def _unindex(self, queue_name):
+        """Remove a queue from the prefix index."""
+        pool = self._queues[queue_name]
+        prefixlen = _prefixlen(self._networks[queue_name])
+        networks = self._prefix_index[prefixlen]
+        key = pool.first >> (128 - prefixlen)
+        networks[key].remove(queue_name)
+        if not networks[key]:
+            del networks[key]
+        if not networks:
+            del self._prefix_index[prefixlen]
+
+    def _queues_for(self, address):
+        """Return the names of all queues whose network holds an address.
+
+        :param address: ``int`` Integer key of the address
+        """
+        owners = []
+        for prefixlen, networks in self._prefix_index.items():
+            owners.extend(networks.get(address >> (128 - prefixlen), ()))
+        return owners
 
-        if net.network:
-            self._used_ips.update([str(net.network)])
-        if net.broadcast:
-            self._used_ips.update([str(net.broadcast)])
+    def get(self, queue_name, owner=None):
+        """Returns an usused IP address from a specified queue.
 
-        all_ips = [ip for ip in initial_ips if ip not in self._used_ips]
+        IPs returned follow a random permutation of the queue's network, so
+        that groups are not clustered by IP, and are marked as used.
 
-        # randomize so that we're not generating the expectation that
-        # groups are clustered by IP
-        random.shuffle(all_ips)
+        :param queue_name: ``str`` Name of the queue from which to retrieve
+            an IP.
+        :param owner: ``str`` Name of the host the IP is for. Only used with
+            ``hashed`` placement.
+        :returns: IP address
+        :rtype: str
+        :raises: ip.NoSuchQueue, ip.EmptyQueue
+        """
+        if queue_name not in self._queues:
+            raise NoSuchQueue("Queue {0} does not exist".format(queue_name))
 
-        self._queues[queue_name] = all_ips
-        self._networks[queue_name] = net
+        address = self._take(queue_name, owner)
+        if address is None:
+            raise EmptyQueue("Queue {0} is empty".format(queue_name))
 
-    def get(self, queue_name):
-        """Returns an usused IP address from a specified queue.
+        self._mark_used(address)
 
-        IPs returned will be marked as used and removed from the associated
-        queue.
+        return _int_to_ip(address)
+
+    def get_many(self, queue_name, count, owners=None):
+        """Returns several unused IP addresses from a specified queue.
+
+        Either all ``count`` addresses are returned, or none are reserved and
+        EmptyQueue is raised.
+
+        :param queue_name: ``str`` Name of the queue from which to retrieve
+            the IPs.
+        :param count: ``int`` Number of IPs to retrieve.
+        :param owners: ``list`` Names of the hosts the IPs are for. Only used
+            with ``hashed`` placement.
+        :returns: IP addresses
+        :rtype: list
+        :raises: ip.NoSuchQueue, ip.EmptyQueue
+        """
+        if queue_name not in self._queues:
+            raise NoSuchQueue("Queue {0} does not exist".format(queue_name))
+        owners = _owners_for(count, owners)
+
+        pool = self._queues[queue_name]
+        taken = []
+        for owner in owners:
+            address = self._take(queue_name, owner)
+            if address is None:
+                for address in taken:
+                    self._mark_free(address)
+                    pool.give(address)
+                raise EmptyQueue(
+                    "Queue {0} cannot supply {1} addresses".format(queue_name,
+                                                                   count)
+                )
+            self._mark_used(address)
+            taken.append(address)
+
+        return [_int_to_ip(address) for address in taken]
+
+    def _take(self, queue_name, owner):
+        """Pick the next address of a queue, or None if it is exhausted."""
+        pool = self._queues[queue_name]
+        if not pool.free_count(self._used_ips):
+            return None
+        if self._placement == 'sequential':
+            return pool.lowest(self._used_ips)
+        if self._placement == 'hashed' and owner is not None:
+            return pool.probe(self._used_ips, _stable_hash(queue_name, owner))
+        return pool.take(self._used_ips)
+
+    def release(self, ip):
+        """Free an IP from the used list and re-insert it to its queues.
+
+        The IP is re-inserted into every queue whose CIDR contains it; the
+        owning queues are found through a prefix index, so the cost does not
+        depend on the number of queues.
+
+        :param ip: ``str`` IP address which to release back into the usable
+            pool.
+        """
+        address = _ip_to_int(ip)
+        self._mark_free(address)
+        self._reserved.discard(address)
+
+        for name in self._queues_for(address):
+            self._queues[name].give(address)
+
+    def mark_allocated(self, ips):
+        """Record addresses which are already assigned to hosts.
+
+        The addresses are marked as used, and are counted as allocated
+        rather than reserved by :method:`IPManager.stats`.
+
+        :param ips: ``IPRanges`` or iterable of IP addresses
+        """
+        for start, end in _ip_ranges(ips):
+            self._used_ips.add_range(start, end)
+            self._reserved.discard_range(start, end)
+        self._recount()
+
+    def stats(self, queue_name):
+        """Return the utilisation counters of a queue.
+
+        Counters are computed from the used and reserved ranges, so the cost
+        depends on the number of ranges and not on the size of the network.
+
+        :param queue_name: ``str`` Name of the queue
+        :returns: ``dict`` with the queue ``cidr`` and the number of
+            addresses that are ``total``, ``reserved`` (network, broadcast
+            and configured used_ips), ``allocated`` to hosts and ``free``,
+            along with the size of the ``largest_free_block``.
+        """
+        try:
+            pool = self._queues[queue_name]
+        except KeyError:
+            raise NoSuchQueue(queue_name)
+
+        total = pool.last - pool.first + 1
+        used = self._used_ips.count(pool.first, pool.last)
+        reserved = self._reserved.count(pool.first, pool.last)
+        largest = 0
+        for start, end in self._used_ips.gaps(pool.first, pool.last):
+            largest = max(largest, end - start + 1)
+        return {
+            'cidr': str(self._networks[queue_name].cidr),
+            'total': total,
+            'reserved': reserved,
+            'allocated': used - reserved,
+            'free': total - used,
+            'largest_free_block': largest,
+        }
+
+    def report(self):
+        """Return the utilisation counters of every queue, keyed by name."""
+        return dict((name, self.stats(name)) for name in self._queues)
+
+
+class SQLiteIPManager(IPManager):
+    """IPManager keeping a persistent ledger of allocations in SQLite
+
+    Every address handed out is recorded along with its queue and owning
+    host, and is marked as used when the ledger is opened again. Getting an
+    address for an owner that already holds one in the queue returns the
+    recorded address, so repeated runs are stable.
+
+    Recorded addresses which fall outside of their queue's current CIDR are
+    dropped from the ledger when the queue is loaded, and
+    :method:`SQLiteIPManager.reconcile` drops those of hosts which have
+    left the inventory, so the ledger follows the environment. A recorded
+    address which is reserved, or held by another host, is dropped rather
+    than handed out again.
+
+    Changes are made inside a transaction which is only committed by
+    :method:`SQLiteIPManager.save`, so a run that fails part way leaves the
+    ledger as it was.
+    """
+    _schema = (
+        'CREATE TABLE IF NOT EXISTS queues ('
+        ' name TEXT PRIMARY KEY,'
+        ' cidr TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS allocations ('
+        ' address TEXT PRIMARY KEY,'
+        ' queue TEXT NOT NULL,'
+        ' owner TEXT)',
+        'CREATE INDEX IF NOT EXISTS allocations_owner'
+        ' ON allocations (owner, queue)',
+    )
+
+    def __init__(self, queues=None, used_ips=None, path=None,
+                 placement='random'):
+        """Open the ledger and create a manager with the recorded allocations
+
+        :param queues: ``dict`` A dictionary containing queue names for keys
+            and CIDR specifications for values.
+        :param used_ips: ``set`` IP addresses which are marked as used.
+        :param path: ``str`` Path of the SQLite database file, which is
+            created if missing.
+        :param placement: ``str`` How addresses are picked, see
+            :class:`IPManager`.
+        """
+        if path is None:
+            raise ValueError("The sqlite IPAM plugin requires a path")
+
+        self._connection = sqlite3.connect(path)
+        for statement in self._schema:
+            self._connection.execute(statement)
+        self._connection.commit()
+
+        super(SQLiteIPManager, self).__init__(used_ips=used_ips,
+                                              placement=placement)
+
+        # Addresses marked as used only because of the ledger, which are
+        # freed again when their row is dropped.
+        self._recorded = IntervalSet()
+        for (address,) in self._connection.execute(
+                'SELECT address FROM allocations'):
+            address = _ip_to_int(address)
+            if address not in self._used_ips:
+                self._used_ips.add(address)
+                self._recorded.add(address)
+
+        # Owners of the addresses held in inventory or handed out during
+        # this run, keyed by integer address.
+        self._holders = {}
+
+        for name, cidr in (queues or {}).items():
+            self.load(name, cidr)
+
+    def _drop(self, address):
+        """Remove an address from the ledger, freeing it if only recorded.
+
+        :param address: ``str`` IP address as stored in the ledger
+        """
+        self._connection.execute('DELETE FROM allocations WHERE address = ?',
+                                 (address,))
+        if _ip_to_int(address) in self._recorded:
+            self._recorded.discard(_ip_to_int(address))
+            super(SQLiteIPManager, self).release(address)
+
+    def _recorded_address(self, queue_name, owner):
+        """Return the address recorded for an owner in a queue, or None.
+
+        A recorded address is dropped when it is outside of the queue's
+        network, reserved, or held by another owner.
+        """
+        if owner is None:
+            return None
+        row = self._connection.execute(
+            'SELECT address FROM allocations '
+            'WHERE owner = ? AND queue = ?',
+            (owner, queue_name)
+        ).fetchone()
+        if row is None:
+            return None
+        address = row[0]
+        key = _ip_to_int(address)
+        if netaddr.IPAddress(address) not in self._networks[queue_name]:
+            self._drop(address)
+            return None
+        if (key in self._reserved or
+                self._holders.get(key, owner) != owner):
+            logger.debug("Dropping %s of %s, it is already used",
+                         address, owner)
+            self._drop(address)
+            return None
+        self._holders[key] = owner
+        return address
+
+    def load(self, queue_name, cidr):
+        """Register a queue, recording its CIDR in the ledger.
+
+        Addresses recorded for the queue which are outside of the CIDR, for
+        example because the network was resized, are dropped.
+
+        :param queue_name: ``str`` Name to apply to a given CIDR
+        :param cidr: ``str`` CIDR notation specifying range of IP addresses
+            which are available for assignment.
+        """
+        super(SQLiteIPManager, self).load(queue_name, cidr)
+        net = self._networks[queue_name]
+        self._connection.execute(
+            'INSERT OR REPLACE INTO queues (name, cidr) VALUES (?, ?)',
+            (queue_name, str(net.cidr))
+        )
+
+        stale = [address for (address,) in self._connection.execute(
+            'SELECT address FROM allocations WHERE queue = ?', (queue_name,)
+        ) if netaddr.IPAddress(address) not in net]
+        for address in stale:
+            logger.debug("Dropping %s from queue %s, outside of %s",
+                         address, queue_name, net.cidr)
+            self._drop(address)
+
+    def mark_allocated(self, ips):
+        """Record addresses which are already assigned to hosts.
+
+        These addresses stay used when their row is dropped from the
+        ledger.
+
+        :param ips: ``IPRanges`` or iterable of IP addresses
+        """
+        super(SQLiteIPManager, self).mark_allocated(ips)
+        for start, end in _ip_ranges(ips):
+            self._recorded.discard_range(start, end)
+
+    def reconcile(self, owners):
+        """Drop the addresses of owners which are no longer in inventory.
+
+        Addresses recorded without an owner are kept. The addresses held by
+        each host in inventory are remembered, so that they are not handed
+        out to another owner.
+
+        :param owners: ``dict`` Variables of every current host, keyed by
+            host name
+        """
+        for owner, host_entry in owners.items():
+            for address in _host_addresses(host_entry):
+                self._holders[_ip_to_int(address)] = owner
+                self._recorded.discard(_ip_to_int(address))
+
+        stale = [address for address, owner in self._connection.execute(
+            'SELECT address, owner FROM allocations WHERE owner IS NOT NULL'
+        ) if owner not in owners]
+        for address in stale:
+            logger.debug("Dropping %s, its owner has left the inventory",
+                         address)
+            self._drop(address)
+
+    def get(self, queue_name, owner=None):
+        """Return the address of an owner, or reserve a new one.
 
         :param queue_name: ``str`` Name of the queue from which to retrieve
             an IP.
+        :param owner: ``str`` Name of the host the IP is for.
         :returns: IP address
         :rtype: str
         :raises: ip.NoSuchQueue, ip.EmptyQueue
         """
-        if queue_name not in self._queues.keys():
+        if queue_name not in self._queues:
             raise NoSuchQueue("Queue {0} does not exist".format(queue_name))
 
-        try:
-            address = self._queues[queue_name].pop(0)
-        except IndexError:
-            raise EmptyQueue("Queue {0} is empty".format(queue_name))
-
-        self._used_ips.add(address)
+        address = self._recorded_address(queue_name, owner)
+        if address is not None:
+            return address
 
+        address = super(SQLiteIPManager, self).get(queue_name, owner=owner)
+        self._record(address, queue_name, owner)
         return address
 
-    def release(self, ip):
-        """Free an IP from the used list and re-insert it to its queue.
+    def _record(self, address, queue_name, owner):
+        """Record a newly reserved address in the ledger."""
+        self._holders[_ip_to_int(address)] = owner
+        self._connection.execute(
+            'INSERT OR REPLACE INTO allocations (address, queue, owner) '
+            'VALUES (?, ?, ?)',
+            (address, queue_name, owner)
+        )
+
+    def get_many(self, queue_name, count, owners=None):
+        """Return the addresses of several owners, reserving any missing.
+
+        Owners which already hold an address in the queue keep it. The
+        remaining addresses are reserved all at once, or not at all.
+
+        :param queue_name: ``str`` Name of the queue from which to retrieve
+            the IPs.
+        :param count: ``int`` Number of IPs to retrieve.
+        :param owners: ``list`` Names of the hosts the IPs are for.
+        :returns: IP addresses, in the order of ``owners``
+        :rtype: list
+        :raises: ip.NoSuchQueue, ip.EmptyQueue
+        """
+        if queue_name not in self._queues:
+            raise NoSuchQueue("Queue {0} does not exist".format(queue_name))
+        owners = _owners_for(count, owners)
 
-        Any IP freed will also be re-inserted into the associated queue, which
-        is calculated at deletion.
+        addresses = [None] * count
+        missing = []
+        for index, owner in enumerate(owners):
+            addresses[index] = self._recorded_address(queue_name, owner)
+            if addresses[index] is None:
+                missing.append(index)
 
-        If an IP matches multiple CIDR ranges available, it will be inserted
-        to the first one matched.
+        new_addresses = super(SQLiteIPManager, self).get_many(
+            queue_name, len(missing), owners=[owners[i] for i in missing]
+        )
+        for index, address in zip(missing, new_addresses):
+            addresses[index] = address
+            self._record(address, queue_name, owners[index])
+        return addresses
+
+    def release(self, ip):
+        """Free an IP and remove it from the ledger.
 
         :param ip: ``str`` IP address which to release back into the usable
             pool.
         """
-        self._used_ips.discard(ip)
+        super(SQLiteIPManager, self).release(ip)
+        self._recorded.discard(_ip_to_int(ip))
+        self._holders.pop(_ip_to_int(ip), None)
+        self._connection.execute('DELETE FROM allocations WHERE address = ?',
+                                 (_canonical(ip),))
+
+    def owner(self, ip):
+        """Return the owner recorded for an IP, or None.
+
+        :param ip: ``str`` IP address to look up
+        """
+        row = self._connection.execute(
+            'SELECT owner FROM allocations WHERE address = ?',
+            (_canonical(ip),)
+        ).fetchone()
+        if row is not None:
+            return row[0]
 
-        # Use the IP class for membership comparison to the network
-        addr = netaddr.IPAddress(ip)
+    def owned_by(self, owner):
+        """Return the addresses recorded for an owner, keyed by queue name.
 
-        # TODO(nrb): Should this be ordered somehow to be more determinate?
-        # Alphabetical by queue name seems easiest, but not necessarily
-        # accurate or relevant.
-        for name, network in self._networks.items():
-            if addr in network:
-                self._queues[name].append(ip)
+        :param owner: ``str`` Name of the host to look up
+        """
+        return dict(
+            (queue, address) for address, queue in self._connection.execute(
+                'SELECT address, queue FROM allocations WHERE owner = ?',
+                (owner,)
+            )
+        )
+
+    def save(self):
+        """Commit all allocations and releases made since the last save."""
+        self._connection.commit()
+
+    def close(self):
+        """Close the ledger, discarding any unsaved changes."""
+        self._connection.rollback()
+        self._connection.close()
+
+
+class Reservation(object):
+    """Addresses reserved in bulk from an IPAM plugin, handed out by owner.
+
+    A reservation offers the same ``get`` call as a plugin, so it can be
+    used in place of one once the addresses for a run have been reserved.
+    Requests it holds no address for are passed on to the plugin.
+    """
+    def __init__(self, manager):
+        """Create an empty reservation
+
+        :param manager: ``IPBasePlugin`` Plugin to reserve addresses from
+        """
+        self._manager = manager
+        self._reserved = {}
+
+    def reserve(self, queue_name, owners):
+        """Reserve one address per owner from a queue.
+
+        :param queue_name: ``str`` Name of the queue
+        :param owners: ``list`` Names of the hosts needing an address
+        :raises: ip.NoSuchQueue, ip.EmptyQueue
+        """
+        owners = list(owners)
+        addresses = self._manager.get_many(queue_name, len(owners),
+                                           owners=owners)
+        by_owner = self._reserved.setdefault(queue_name, {})
+        for owner, address in zip(owners, addresses):
+            by_owner.setdefault(owner, collections.deque()).append(address)
+
+    def get(self, queue_name, owner=None):
+        """Hand out the address reserved for an owner.
+
+        Addresses reserved for other owners are never handed out, requests
+        without a reservation are passed on to the plugin.
+
+        :param queue_name: ``str`` Name of the queue
+        :param owner: ``str`` Name of the host the address is for
+        """
+        addresses = self._reserved.get(queue_name, {}).get(owner)
+        if not addresses:
+            return _plugin_get(self._manager, queue_name, owner=owner)
+        return addresses.popleft()
+
+    def release_unused(self):
+        """Release every address that has not been handed out."""
+        for by_owner in self._reserved.values():
+            for addresses in by_owner.values():
+                while addresses:
+                    self._manager.release(addresses.popleft())
+
+
+class NoSuchPlugin(Exception):
+    pass
+
+
+# Entry point group searched for IPAM plugins not shipped with osa_toolkit.
+PLUGIN_NAMESPACE = 'osa_toolkit.ipam'
+
+DEFAULT_PLUGIN = 'memory'
+
+_PLUGINS = {
+    'memory': IPManager,
+    'sqlite': SQLiteIPManager,
+}
+
+
+def register_plugin(name, plugin_class):
+    """Make an IPAM plugin available under a given name.
+
+    :param name: ``str`` Name used to select the plugin in configuration
+    :param plugin_class: ``IPBasePlugin`` subclass, which is instantiated
+        with ``queues`` and ``used_ips`` keyword arguments plus any
+        configured options.
+    """
+    _PLUGINS[name] = plugin_class
+
+
+def get_plugin(name):
+    """Return the IPAM plugin class registered for a name.
+
+    Built in and explicitly registered plugins are checked first, then the
+    ``osa_toolkit.ipam`` entry point group.
+
+    :param name: ``str`` Name of the plugin
+    :raises: ip.NoSuchPlugin
+    """
+    if name in _PLUGINS:
+        return _PLUGINS[name]
+
+    try:
+        import pkg_resources
+    except ImportError:
+        pkg_resources = None
+
+    if pkg_resources is not None:
+        for entry_point in pkg_resources.iter_entry_points(PLUGIN_NAMESPACE,
+                                                           name):
+            plugin_class = entry_point.load()
+            logger.debug("Loaded IPAM plugin %s from %s", name, entry_point)
+            _PLUGINS[name] = plugin_class
+            return plugin_class
+
+    raise NoSuchPlugin("IPAM plugin {0} is not available".format(name))
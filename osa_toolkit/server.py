@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Serve the generated inventory over a Unix socket."""
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from osa_toolkit import client
+from osa_toolkit import filesystem as filesys
+from osa_toolkit import generate
+
+
+logger = logging.getLogger('osa-inventory')
+
+DEFAULT_ENVIRONMENT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'playbooks', 'inventory'
+)
+
+
+def _real_path(path):
+    """Return the canonical form of a directory path."""
+    return os.path.realpath(os.path.expanduser(path))
+
+
+class InventoryState(object):
+    """Generated inventory of a configuration, kept in memory
+
+    The input files of the inventory are checked on every request and the
+    inventory is generated again as soon as one of them changed. The JSON
+    and its host offsets are replaced together as a single tuple, so a
+    request never pairs the offsets of one inventory with the JSON of
+    another.
+    """
+    def __init__(self, config=None, environment=None):
+        """Create the state of a configuration
+
+        :param config: ``str`` Directory from which to pull configs and
+            overrides
+        :param environment: ``str`` Directory containing the base env.d
+        """
+        self.config = config
+        self.environment = environment
+        self._files = None
+        # (inventory JSON, host offsets), or None until first generated
+        self._inventory = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Generate the inventory again if any of its inputs changed."""
+        with self._lock:
+            paths = filesys.input_files(self.config, self.environment)
+            files = filesys.fingerprint_files(paths, self._files)
+            if (self._inventory is not None and
+                    filesys.same_contents(files, self._files)):
+                self._files = files
+                return
+
+            logger.info("Inventory inputs changed, generating inventory")
+            inventory_json = generate.main(config=self.config,
+                                           environment=self.environment)
+            self._inventory = (inventory_json,
+                               filesys.host_offsets(inventory_json))
+
+            # The stored inventory was just written, take it in again.
+            paths = filesys.input_files(self.config, self.environment)
+            self._files = filesys.fingerprint_files(paths, files)
+
+    def serves(self, config=None, environment=None):
+        """Return whether the state is for the given directories.
+
+        Directories which are not given are not checked.
+
+        :param config: ``str`` Directory from which to pull configs and
+            overrides
+        :param environment: ``str`` Directory containing the base env.d
+        """
+        if (config is not None and
+                _real_path(config) != _real_path(self.config or
+                                                 client.DEFAULT_CONFIG_DIR)):
+            return False
+        if (environment is not None and
+                _real_path(environment) != _real_path(self.environment or
+                                                      DEFAULT_ENVIRONMENT)):
+            return False
+        return True
+
+    def list(self):
+        """Return the whole inventory as JSON."""
+        self.refresh()
+        inventory_json, _ = self._inventory
+        return inventory_json
+
+    def host(self, name):
+        """Return the variables of a host as JSON, empty if it is unknown.
+
+        :param name: ``str`` Name of the host
+        """
+        self.refresh()
+        inventory_json, host_offsets = self._inventory
+        offsets = host_offsets.get(name)
+        if offsets is None:
+            return '{}'
+        offset, length = offsets
+        return inventory_json[offset:offset + length]
+
+
+class InventoryRequestHandler(socketserver.StreamRequestHandler):
+    """Answer one ``list`` or ``host <name>`` command per connection
+
+    The command line is followed by optional ``config <path>`` and
+    ``environment <path>`` lines and an empty line. Replies start with a
+    status line, ``ok``, ``error`` or ``mismatch`` when the paths are not
+    the ones served, followed by the inventory JSON or the error message.
+    """
+    def handle(self):
+        line = self.rfile.readline().decode('utf-8').strip()
+        command, _, argument = line.partition(' ')
+        options = {}
+        while True:
+            option = self.rfile.readline().decode('utf-8').rstrip('\n')
+            if not option:
+                break
+            name, _, value = option.partition(' ')
+            options[name] = value
+        inventory = self.server.inventory
+        if not inventory.serves(config=options.get('config'),
+                                environment=options.get('environment')):
+            body = 'The server serves {} with the environment {}'.format(
+                inventory.config, inventory.environment
+            )
+            self.wfile.write('mismatch\n{}'.format(body).encode('utf-8'))
+            return
+        try:
+            if command == 'list':
+                body = self.server.inventory.list()
+            elif command == 'host':
+                body = self.server.inventory.host(argument)
+            else:
+                raise ValueError("Unknown command '{}'".format(command))
+            status = 'ok'
+        except (Exception, SystemExit) as ex:
+            logger.error("Request '%s' failed: %s", line, ex)
+            status, body = 'error', str(ex)
+        self.wfile.write('{}\n{}'.format(status, body).encode('utf-8'))
+
+
+class InventoryServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    """Unix socket server answering inventory requests in threads"""
+    daemon_threads = True
+
+    def __init__(self, socket_path, inventory):
+        """Bind the server to a socket
+
+        A socket file left over by a server which is no longer running is
+        replaced.
+
+        :param socket_path: ``str`` Path of the socket to listen on
+        :param inventory: ``InventoryState`` Inventory to serve
+        """
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except socket.error:
+                os.remove(socket_path)
+            else:
+                raise SystemExit(
+                    'An inventory server is already listening on '
+                    '{}'.format(socket_path)
+                )
+            finally:
+                probe.close()
+
+        self.socket_path = socket_path
+        self.inventory = inventory
+        socketserver.UnixStreamServer.__init__(self, socket_path,
+                                               InventoryRequestHandler)
+        os.chmod(socket_path, 0o600)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def args(arg_list):
+    """Setup argument Parsing."""
+    parser = argparse.ArgumentParser(
+        usage='%(prog)s',
+        description='OpenStack Inventory Server',
+        epilog='Inventory Server Licensed "Apache 2.0"')
+
+    parser.add_argument(
+        '--config',
+        help='Path containing the user defined configuration files',
+        required=False,
+        default=None
+    )
+
+    parser.add_argument(
+        '-e',
+        '--environment',
+        help=('Directory that contains the base env.d directory.\n'
+              'Defaults to <OSA_ROOT>/playbooks/inventory/.'),
+        required=False,
+        default=DEFAULT_ENVIRONMENT,
+    )
+
+    parser.add_argument(
+        '-s',
+        '--socket',
+        help=('Path of the Unix socket to listen on. Defaults to '
+              '$OSA_INVENTORY_SOCKET, or openstack_inventory.sock in the '
+              'configuration directory.'),
+        required=False,
+        default=None
+    )
+
+    return vars(parser.parse_args(arg_list))
+
+
+def _terminate(signum, frame):
+    raise SystemExit(0)
+
+
+def main(arg_list=None):
+    """Run the inventory server until it is interrupted or terminated."""
+    logging.basicConfig(level=logging.INFO)
+    user_args = args(arg_list)
+
+    socket_path = user_args['socket'] or client.socket_path(
+        user_args['config']
+    )
+    inventory = InventoryState(config=user_args['config'],
+                               environment=user_args['environment'])
+    # Fail before listening if the configuration is broken.
+    inventory.refresh()
+
+    server = InventoryServer(socket_path, inventory)
+    signal.signal(signal.SIGTERM, _terminate)
+    logger.info("Serving inventory on %s", socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Compiled inventory skeleton.
+
+The ``physical_skel``, ``component_skel`` and ``container_skel`` sections of
+an environment are compiled into the groups of the inventory, the graph of
+parent and child groups and the containers to build for each group of
+hosts.
+"""
+
+
+class SkeletonCycleError(Exception):
+    def __init__(self, groups):
+        self.groups = groups
+
+        error_msg = ("Groups of the inventory skeleton belong to each other: "
+                     "{}")
+
+        self.message = error_msg.format(' -> '.join(groups))
+
+    def __str__(self):
+        return self.message
+
+
+class Skeleton(object):
+    """Groups, group graph and containers of an environment
+
+    ``groups`` lists the groups in the order they are created, each with a
+    flag telling whether it holds child groups. Container groups, whose
+    name ends with ``container``, only hold hosts.
+
+    ``edges`` lists the ``(parent, child)`` relations of ``physical_skel``
+    then ``component_skel``, in file order.
+
+    ``containers`` lists the ``(component, container name, group of hosts,
+    properties)`` entries of ``container_skel``.
+
+    The group graph must be acyclic.
+    """
+    def __init__(self, groups, edges, containers):
+        """Create a skeleton from its compiled parts.
+
+        :param groups: ``list`` ``(name, has_children)`` pairs
+        :param edges: ``list`` ``(parent, child)`` pairs
+        :param containers: ``list`` ``(component, container_name,
+            container_type, properties)`` entries
+        :raises: SkeletonCycleError
+        """
+        self.groups = [tuple(group) for group in groups]
+        self.edges = [tuple(edge) for edge in edges]
+        self.containers = [tuple(container) for container in containers]
+        self.children = {}
+        for parent, child in self.edges:
+            self.children.setdefault(parent, []).append(child)
+
+        self._check_acyclic()
+
+    @classmethod
+    def compile(cls, environment):
+        """Compile the skeleton of an environment.
+
+        :param environment: ``dict`` Known environment information
+        :raises: SkeletonCycleError
+        """
+        groups = []
+        known = set()
+
+        def add_group(name, has_children):
+            if name not in known:
+                known.add(name)
+                groups.append((name, has_children))
+
+        for key, value in environment.items():
+            if key == 'version':
+                continue
+            for _key, _value in value.items():
+                add_group(_key, not _key.endswith('container'))
+                for assignment in _value.get('belongs_to', []):
+                    add_group(assignment, True)
+
+        edges = []
+        for key in ('physical_skel', 'component_skel'):
+            for child, value in (environment.get(key) or {}).items():
+                for parent in value['belongs_to']:
+                    edges.append((parent, child))
+
+        containers = []
+        for key, value in (environment.get('container_skel') or {}).items():
+            if value.get('contains', False) or value.get('belongs_to', False):
+                for assignment in value['contains']:
+                    for container_type in value['belongs_to']:
+                        containers.append((assignment, key, container_type,
+                                           value.get('properties', {})))
+
+        return cls(groups, edges, containers)
+
+    def _nodes(self):
+        nodes = [name for name, _ in self.groups]
+        known = set(nodes)
+        for edge in self.edges:
+            for name in edge:
+                if name not in known:
+                    known.add(name)
+                    nodes.append(name)
+        return nodes
+
+    def _check_acyclic(self):
+        # Groups are removed parents first; any group left over is part of,
+        # or below, a cycle.
+        nodes = self._nodes()
+        parents = dict((node, 0) for node in nodes)
+        for _, child in self.edges:
+            parents[child] += 1
+
+        removed = 0
+        ready = [node for node in nodes if not parents[node]]
+        while ready:
+            node = ready.pop()
+            removed += 1
+            for child in self.children.get(node, []):
+                parents[child] -= 1
+                if not parents[child]:
+                    ready.append(child)
+
+        if removed < len(nodes):
+            remaining = [node for node in nodes if parents[node]]
+            raise SkeletonCycleError(self._find_cycle(remaining))
+
+    def _find_cycle(self, remaining):
+        # Every group left out of the topological order has a parent which
+        # was left out as well, so walking up from one ends in a cycle.
+        left_out = set(remaining)
+        parents = {}
+        for parent, child in self.edges:
+            if parent in left_out:
+                parents.setdefault(child, []).append(parent)
+
+        path = []
+        seen = {}
+        node = remaining[0]
+        while node not in seen:
+            seen[node] = len(path)
+            path.append(node)
+            node = parents[node][0]
+        cycle = path[seen[node]:] + [node]
+        cycle.reverse()
+        return cycle
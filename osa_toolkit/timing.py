@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Wall time and counters of the phases of an inventory run.
+
+The inventory code marks its phases with ``phase`` and counts its work
+with ``count``. Both do nothing unless a ``Profile`` is made active with
+``profiling``, which is meant for a single run of a command line tool: the
+active profile is shared by all threads.
+"""
+
+import contextlib
+import json
+import os
+import time
+
+
+FORMATS = ('json', 'prometheus')
+
+_PROMETHEUS_PREFIX = 'osa_inventory'
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class _NullProfile(object):
+    """Profile recording nothing, active when profiling is disabled"""
+    _phase = _NullPhase()
+
+    def phase(self, name):
+        return self._phase
+
+    def count(self, name, value=1):
+        pass
+
+
+class Profile(object):
+    """Wall time spent in each phase and counters of a run"""
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+        self._order = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the wall time spent in the block to a phase.
+
+        :param name: ``str`` Name of the phase
+        """
+        start = time.time()
+        try:
+            yield self
+        finally:
+            if name not in self.phases:
+                self._order.append(name)
+                self.phases[name] = 0.0
+            self.phases[name] += time.time() - start
+
+    def count(self, name, value=1):
+        """Add to a counter.
+
+        :param name: ``str`` Name of the counter
+        :param value: ``int`` Amount to add
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """Return the phases, in the order they first ran, and counters."""
+        return {
+            'phases': [
+                {'name': name, 'seconds': self.phases[name]}
+                for name in self._order
+            ],
+            'counters': dict(self.counters)
+        }
+
+    def to_json(self):
+        """Return the report as JSON."""
+        return json.dumps(self.report(), indent=4, separators=(',', ': '),
+                          sort_keys=True)
+
+    def to_prometheus(self):
+        """Return the report in the Prometheus text exposition format."""
+        name = '{}_phase_seconds'.format(_PROMETHEUS_PREFIX)
+        lines = [
+            '# HELP {} Wall time spent in a phase of inventory '
+            'generation.'.format(name),
+            '# TYPE {} gauge'.format(name),
+        ]
+        for phase in self._order:
+            lines.append('{}{{phase="{}"}} {!r}'.format(name, phase,
+                                                        self.phases[phase]))
+        for counter in sorted(self.counters):
+            name = '{}_{}'.format(_PROMETHEUS_PREFIX, counter)
+            lines.append('# HELP {} Inventory generation counter {}.'.format(
+                name, counter))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, self.counters[counter]))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path, report_format='json'):
+        """Write the report to a file.
+
+        The report is written to a temporary file renamed over the target,
+        as expected by the textfile collector of the Prometheus node
+        exporter.
+
+        :param path: ``str`` Path of the report file
+        :param report_format: ``str`` One of ``FORMATS``
+        """
+        if report_format == 'prometheus':
+            content = self.to_prometheus()
+        else:
+            content = self.to_json() + '\n'
+
+        temp_file = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_file, 'w') as f:
+            f.write(content)
+        os.rename(temp_file, path)
+
+
+_active = _NullProfile()
+
+
+def phase(name):
+    """Return a context manager timing a phase of the active profile.
+
+    :param name: ``str`` Name of the phase
+    """
+    return _active.phase(name)
+
+
+def count(name, value=1):
+    """Add to a counter of the active profile.
+
+    :param name: ``str`` Name of the counter
+    :param value: ``int`` Amount to add
+    """
+    _active.count(name, value)
+
+
+@contextlib.contextmanager
+def profiling(profile):
+    """Make a profile the active one for the duration of the block.
+
+    :param profile: ``Profile`` Profile to record into
+    """
+    global _active
+    previous = _active
+    _active = profile
+    try:
+        yield profile
+    finally:
+        _active = previous
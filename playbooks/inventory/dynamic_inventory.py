@@ -19,13 +19,15 @@ import argparse
 import os
 import sys
 
+# The generator is only imported when the inventory server can not answer,
+# so that asking the server stays cheap.
 try:
-    from osa_toolkit import generate
+    from osa_toolkit import client
 except ImportError:
     current_path = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
     lib_path = os.path.join(current_path, '..', '..', 'osa_toolkit')
     sys.path.append(lib_path)
-    from osa_toolkit import generate
+    from osa_toolkit import client
 
 
 # Function kept in order to use relative pathing for the env.d directory
@@ -48,12 +50,26 @@ def args(arg_list):
         action='store_true'
     )
 
+    parser.add_argument(
+        '--host',
+        help='List the variables of a single host',
+        required=False,
+        default=None
+    )
+
     parser.add_argument(
         '--check',
         help="Configuration check only, don't generate inventory",
         action='store_true',
     )
 
+    parser.add_argument(
+        '--ip-report',
+        help=('Report the utilisation of every cidr_networks queue, '
+              "don't generate inventory"),
+        action='store_true',
+    )
+
     parser.add_argument(
         '-d',
         '--debug',
@@ -63,6 +79,21 @@ def args(arg_list):
         default=False,
     )
 
+    parser.add_argument(
+        '--profile',
+        help=('Write the time spent in each phase of inventory generation '
+              'and its counters to this file'),
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        '--profile-format',
+        help='Format of the --profile report',
+        choices=['json', 'prometheus'],
+        default='json',
+    )
+
     parser.add_argument(
         '-e',
         '--environment',
@@ -75,7 +106,63 @@ def args(arg_list):
     return vars(parser.parse_args(arg_list))
 
 
+def from_server(all_args):
+    """Return the answer of a running inventory server, or None.
+
+    Only ``--list`` and ``--host`` requests are sent to the server, and only
+    when they are not profiled. None is also returned when the server
+    serves another configuration or environment directory.
+    """
+    if (all_args['check'] or all_args['ip_report'] or all_args['debug'] or
+            all_args['profile']):
+        return None
+
+    if all_args['host'] is not None:
+        command = 'host {}'.format(all_args['host'])
+    else:
+        command = 'list'
+
+    try:
+        return client.request(
+            command,
+            client.socket_path(all_args['config']),
+            config=all_args['config'] or client.DEFAULT_CONFIG_DIR,
+            environment=all_args['environment']
+        )
+    except client.ServerUnavailable:
+        return None
+    except client.ServerError as ex:
+        raise SystemExit(ex)
+
+
+def generate_output(all_args):
+    """Generate the requested output in process."""
+    from osa_toolkit import generate
+    from osa_toolkit import timing
+
+    profile_path = all_args.pop('profile')
+    profile_format = all_args.pop('profile_format')
+    if profile_path is None:
+        return _generate_output(generate, all_args)
+
+    with timing.profiling(timing.Profile()) as profile:
+        output = _generate_output(generate, all_args)
+    profile.save(profile_path, profile_format)
+    return output
+
+
+def _generate_output(generate, all_args):
+    host = all_args.pop('host')
+    if all_args.pop('ip_report'):
+        return generate.ip_report(**all_args)
+    elif host is not None:
+        return generate.host_vars(host, **all_args)
+    return generate.main(**all_args)
+
+
 if __name__ == '__main__':
     all_args = args(sys.argv[1:])
-    output = generate.main(**all_args)
+    output = from_server(all_args)
+    if output is None:
+        output = generate_output(all_args)
     print(output)
@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Benchmark inventory generation on synthetic deployments.
+
+A deployment of the requested number of physical hosts is written to a
+temporary configuration directory: three infrastructure hosts running
+the shared services with an affinity of two for RabbitMQ and the utility
+container, storage hosts and compute hosts. The AIO provider networks are
+used and an env.d override adds one container to every compute host, so
+the number of containers grows with the number of hosts.
+
+Each deployment is timed for three scenarios:
+
+* ``full``: generate the inventory from scratch,
+* ``noop``: generate it again without changing anything,
+* ``add_host``: add one compute host to an existing inventory.
+
+The fastest of ``--repeat`` runs is kept, together with the wall time of
+the phases of that run. The peak of memory allocated by Python is taken
+from one more run of each scenario with ``tracemalloc``, which is not
+available on Python 2.
+
+Results can be saved with ``--save`` and compared to saved results with
+``--baseline``, in which case the exit status is 1 when a scenario is
+slower or uses more memory than the baseline beyond ``--tolerance``.
+Baselines only hold for the machine they were recorded on.
+"""
+
+import argparse
+import json
+import netaddr
+import os
+from os import path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import yaml
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from osa_toolkit import generate
+from osa_toolkit import timing
+
+ENVIRONMENT = path.join(path.dirname(path.abspath(__file__)), '..',
+                        'playbooks', 'inventory')
+
+DEFAULT_SIZES = (10, 100, 1000, 5000)
+
+SCENARIOS = ('full', 'noop', 'add_host')
+
+INFRA_GROUPS = (
+    'shared-infra_hosts',
+    'repo-infra_hosts',
+    'os-infra_hosts',
+    'identity_hosts',
+    'network_hosts',
+    'storage-infra_hosts',
+    'haproxy_hosts',
+    'log_hosts',
+)
+
+INFRA_AFFINITY = {'rabbit_mq_container': 2, 'utility_container': 2}
+
+NETWORKS = {
+    'container': '10.0.0.0/16',
+    'tunnel': '10.1.0.0/16',
+    'storage': '10.2.0.0/16',
+}
+
+PROVIDER_NETWORKS = [
+    {'network': {
+        'container_bridge': 'br-mgmt',
+        'container_type': 'veth',
+        'container_interface': 'eth1',
+        'ip_from_q': 'container',
+        'type': 'raw',
+        'group_binds': ['all_containers', 'hosts'],
+        'is_container_address': True,
+        'is_ssh_address': True,
+    }},
+    {'network': {
+        'container_bridge': 'br-vxlan',
+        'container_type': 'veth',
+        'container_interface': 'eth10',
+        'ip_from_q': 'tunnel',
+        'type': 'vxlan',
+        'range': '1:1000',
+        'net_name': 'vxlan',
+        'group_binds': ['neutron_linuxbridge_agent'],
+    }},
+    {'network': {
+        'container_bridge': 'br-vlan',
+        'container_type': 'veth',
+        'container_interface': 'eth12',
+        'host_bind_override': 'eth12',
+        'type': 'flat',
+        'net_name': 'flat',
+        'group_binds': ['neutron_linuxbridge_agent'],
+    }},
+    {'network': {
+        'container_bridge': 'br-vlan',
+        'container_type': 'veth',
+        'container_interface': 'eth11',
+        'type': 'vlan',
+        'range': '1:1',
+        'net_name': 'vlan',
+        'group_binds': ['neutron_linuxbridge_agent'],
+    }},
+    {'network': {
+        'container_bridge': 'br-storage',
+        'container_type': 'veth',
+        'container_interface': 'eth2',
+        'ip_from_q': 'storage',
+        'type': 'raw',
+        'group_binds': ['glance_api', 'cinder_api', 'cinder_volume',
+                        'nova_compute', 'swift_proxy'],
+    }},
+]
+
+COMPUTE_ENVIRONMENT = {
+    'component_skel': {
+        'benchmark_agent': {'belongs_to': ['benchmark_all']},
+    },
+    'container_skel': {
+        'benchmark_agent_container': {
+            'belongs_to': ['compute_containers'],
+            'contains': ['benchmark_agent'],
+        },
+    },
+}
+
+
+def make_config(host_count):
+    """Return the user configuration of a synthetic deployment.
+
+    :param host_count: ``int`` Number of physical hosts
+    """
+    addresses = netaddr.IPNetwork(NETWORKS['container'])
+    config = {
+        'cidr_networks': dict(NETWORKS),
+        'used_ips': [
+            '{0},{1}'.format(net[1], net[9]) for net in
+            (netaddr.IPNetwork(cidr) for cidr in sorted(NETWORKS.values()))
+        ],
+        'global_overrides': {
+            'internal_lb_vip_address': str(addresses[10]),
+            'external_lb_vip_address': '192.0.2.10',
+            'tunnel_bridge': 'br-vxlan',
+            'management_bridge': 'br-mgmt',
+            'provider_networks': PROVIDER_NETWORKS,
+        },
+    }
+    for group in INFRA_GROUPS:
+        config[group] = {}
+    config['storage_hosts'] = {}
+    config['compute_hosts'] = {}
+
+    infra_count = min(3, host_count)
+    storage_count = (host_count - infra_count) // 10
+    for index in range(host_count):
+        address = str(addresses[index + 100])
+        if index < infra_count:
+            name = 'infra{}'.format(index + 1)
+            for group in INFRA_GROUPS:
+                config[group][name] = {'ip': address}
+            config['shared-infra_hosts'][name]['affinity'] = dict(
+                INFRA_AFFINITY
+            )
+        elif index < infra_count + storage_count:
+            name = 'storage{}'.format(index - infra_count + 1)
+            config['storage_hosts'][name] = {'ip': address}
+        else:
+            name = 'compute{}'.format(index - infra_count - storage_count + 1)
+            config['compute_hosts'][name] = {'ip': address}
+    return config
+
+
+def add_compute_host(config):
+    """Add a compute host to a configuration made by ``make_config``.
+
+    :param config: ``dict`` User configuration
+    """
+    addresses = netaddr.IPNetwork(NETWORKS['container'])
+    host_count = sum(len(config[group]) for group in
+                     ('shared-infra_hosts', 'storage_hosts', 'compute_hosts'))
+    name = 'compute{}'.format(len(config['compute_hosts']) + 1)
+    config['compute_hosts'][name] = {'ip': str(addresses[host_count + 100])}
+
+
+def write_config(config_dir, config):
+    """Write a user configuration and the env.d override to a directory.
+
+    :param config_dir: ``str`` Configuration directory
+    :param config: ``dict`` User configuration
+    """
+    env_dir = path.join(config_dir, 'env.d')
+    if not path.isdir(env_dir):
+        os.makedirs(env_dir)
+    with open(path.join(env_dir, 'benchmark.yml'), 'w') as f:
+        f.write(yaml.safe_dump(COMPUTE_ENVIRONMENT, default_flow_style=False))
+    with open(path.join(config_dir, 'openstack_user_config.yml'), 'w') as f:
+        f.write(yaml.safe_dump(config, default_flow_style=False))
+
+
+def _generate(config_dir):
+    return generate.main(config=config_dir, environment=ENVIRONMENT)
+
+
+def _timed_run(config_dir):
+    with timing.profiling(timing.Profile()) as profile:
+        start = time.time()
+        output = _generate(config_dir)
+        seconds = time.time() - start
+    phases = dict((phase['name'], phase['seconds'])
+                  for phase in profile.report()['phases'])
+    return seconds, phases, output
+
+
+def _peak_memory(config_dir):
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        _generate(config_dir)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class Deployment(object):
+    """Temporary configuration directories of a synthetic deployment"""
+    def __init__(self, host_count, work_dir):
+        """Create a deployment
+
+        :param host_count: ``int`` Number of physical hosts
+        :param work_dir: ``str`` Directory to create configurations in
+        """
+        self.host_count = host_count
+        self.work_dir = work_dir
+        self.config = make_config(host_count)
+        self.generated = None
+
+    def prepare(self, scenario):
+        """Return a configuration directory ready to run a scenario.
+
+        :param scenario: ``str`` One of ``SCENARIOS``
+        """
+        if scenario == 'noop':
+            if self.generated is None:
+                self.generated = self.prepare('full')
+                _generate(self.generated)
+            return self.generated
+
+        config_dir = path.join(self.work_dir,
+                               'run{}'.format(len(os.listdir(self.work_dir))))
+        write_config(config_dir, self.config)
+        if scenario == 'add_host':
+            # The stored inventory refers to its own path, so it is generated
+            # in place rather than copied.
+            _generate(config_dir)
+            config = json.loads(json.dumps(self.config))
+            add_compute_host(config)
+            write_config(config_dir, config)
+        return config_dir
+
+    def run(self, scenario, repeat=1):
+        """Return the timings of a scenario.
+
+        :param scenario: ``str`` One of ``SCENARIOS``
+        :param repeat: ``int`` Number of timed runs
+        :returns: ``dict`` Wall time of the fastest run and of its phases,
+            peak memory allocated by a run in bytes and the output of the
+            fastest run
+        """
+        best = None
+        for _ in range(repeat):
+            result = _timed_run(self.prepare(scenario))
+            if best is None or result[0] < best[0]:
+                best = result
+        seconds, phases, output = best
+        return {
+            'seconds': seconds,
+            'phases': phases,
+            'peak_memory': _peak_memory(self.prepare(scenario)),
+            'output': output
+        }
+
+
+def run_benchmark(host_count, repeat=1, scenarios=SCENARIOS):
+    """Benchmark the scenarios of a synthetic deployment.
+
+    :param host_count: ``int`` Number of physical hosts
+    :param repeat: ``int`` Number of timed runs of each scenario
+    :param scenarios: ``tuple`` Scenarios to run
+    :returns: ``dict`` Size of the inventory and the results of each
+        scenario
+    """
+    work_dir = tempfile.mkdtemp(prefix='osa-inventory-benchmark-')
+    try:
+        deployment = Deployment(host_count, work_dir)
+        results = {}
+        inventory_hosts = None
+        for scenario in scenarios:
+            results[scenario] = deployment.run(scenario, repeat)
+            output = results[scenario].pop('output')
+            if inventory_hosts is None:
+                inventory_hosts = len(json.loads(output)['_meta']['hostvars'])
+        return {
+            'hosts': host_count,
+            'containers': inventory_hosts - host_count,
+            'scenarios': results
+        }
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of results against a baseline.
+
+    Only the sizes and scenarios found in both are compared.
+
+    :param results: ``dict`` Results of ``run_benchmarks``
+    :param baseline: ``dict`` Results of an earlier run
+    :param tolerance: ``float`` Allowed increase, 0.25 for 25%
+    :returns: ``list`` Description of every regression
+    """
+    regressions = []
+
+    def check(name, value, base_value):
+        if value is not None and base_value:
+            if value > base_value * (1 + tolerance):
+                regressions.append(
+                    '{}: {:.4g} against {:.4g} (+{:.0%})'.format(
+                        name, value, base_value, value / base_value - 1
+                    )
+                )
+
+    for size, result in sorted(results['sizes'].items(),
+                               key=lambda item: int(item[0])):
+        base_result = baseline['sizes'].get(size)
+        if base_result is None:
+            continue
+        for scenario in SCENARIOS:
+            current = result['scenarios'].get(scenario)
+            base = base_result['scenarios'].get(scenario)
+            if current is None or base is None:
+                continue
+            name = '{} hosts {}'.format(size, scenario)
+            check('{} seconds'.format(name), current['seconds'],
+                  base['seconds'])
+            check('{} peak memory'.format(name), current['peak_memory'],
+                  base['peak_memory'])
+            for phase, seconds in sorted(current['phases'].items()):
+                # Ignore phases too short to be timed reliably.
+                if seconds >= 0.01:
+                    check('{} phase {} seconds'.format(name, phase), seconds,
+                          base['phases'].get(phase))
+    return regressions
+
+
+def run_benchmarks(sizes, repeat=1, scenarios=SCENARIOS, out=None):
+    """Benchmark synthetic deployments of several sizes.
+
+    :param sizes: ``list`` Numbers of physical hosts
+    :param repeat: ``int`` Number of timed runs of each scenario
+    :param scenarios: ``tuple`` Scenarios to run
+    :param out: File to print the results to as they come
+    """
+    results = {
+        'python': platform.python_version(),
+        'sizes': {}
+    }
+    for host_count in sizes:
+        result = run_benchmark(host_count, repeat, scenarios)
+        results['sizes'][str(host_count)] = result
+        if out is not None:
+            for scenario in scenarios:
+                timings = result['scenarios'][scenario]
+                memory = timings['peak_memory']
+                out.write('{:>6} hosts {:>6} containers {:<9} {:>9.3f}s '
+                          '{:>10}\n'.format(
+                              host_count, result['containers'], scenario,
+                              timings['seconds'],
+                              '-' if memory is None else
+                              '{:.1f}MiB'.format(memory / 1048576.0)
+                          ))
+            out.flush()
+    return results
+
+
+def args(arg_list):
+    """Setup argument Parsing."""
+    parser = argparse.ArgumentParser(
+        usage='%(prog)s',
+        description='OpenStack Inventory Generator Benchmark',
+        epilog='Inventory Benchmark Licensed "Apache 2.0"')
+
+    parser.add_argument(
+        '--sizes',
+        help='Comma separated numbers of physical hosts to benchmark',
+        type=lambda value: [int(size) for size in value.split(',')],
+        default=list(DEFAULT_SIZES)
+    )
+
+    parser.add_argument(
+        '--scenarios',
+        help='Comma separated scenarios to run, out of {}'.format(
+            ', '.join(SCENARIOS)),
+        type=lambda value: tuple(value.split(',')),
+        default=SCENARIOS
+    )
+
+    parser.add_argument(
+        '--repeat',
+        help='Number of timed runs of each scenario, the fastest is kept',
+        type=int,
+        default=1
+    )
+
+    parser.add_argument(
+        '--save',
+        help='Save the results to a JSON file, to be used as baseline',
+        default=None
+    )
+
+    parser.add_argument(
+        '--baseline',
+        help='Compare the results to a file written with --save',
+        default=None
+    )
+
+    parser.add_argument(
+        '--tolerance',
+        help='Allowed increase over the baseline, 0.25 for 25%%',
+        type=float,
+        default=0.25
+    )
+
+    parsed = parser.parse_args(arg_list)
+    unknown = set(parsed.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(
+            ', '.join(sorted(unknown))))
+    return vars(parsed)
+
+
+def main(arg_list=None):
+    user_args = args(arg_list)
+    results = run_benchmarks(user_args['sizes'], user_args['repeat'],
+                             user_args['scenarios'], out=sys.stdout)
+
+    if user_args['save']:
+        with open(user_args['save'], 'w') as f:
+            f.write(json.dumps(results, indent=4, separators=(',', ': '),
+                               sort_keys=True) + '\n')
+
+    if user_args['baseline']:
+        with open(user_args['baseline']) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, user_args['tolerance'])
+        for regression in regressions:
+            sys.stdout.write('REGRESSION {}\n'.format(regression))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Microbenchmarks of the IP address allocation of ``osa_toolkit.ip``.
+
+Every operation is measured on networks from /24 to /12 whose addresses
+are already used at several densities. Used addresses come in blocks at
+the start of every 1024 addresses, so a denser network also has longer runs
+of used addresses to skip. The operations are:
+
+* ``load``: register a queue with ``IPManager.load``,
+* ``set_used_ips``: record the ``used_ips`` ranges of the configuration and
+  the addresses of an inventory with ``set_used_ips``,
+* ``get``, ``get_ip_address`` and ``get_many``: hand out ``--count``
+  addresses, with each placement of ``IPManager``,
+* ``release``: give the addresses back in allocation order (``fifo``),
+  reverse order (``lifo``) or a shuffled order (``random``), then hand them
+  out again.
+
+Each operation reports the number of addresses or entries processed per
+second, for the fastest of ``--repeat`` runs, and the peak of memory
+allocated by Python during one more run with ``tracemalloc``, which is not
+available on Python 2.
+
+Results can be saved with ``--save`` and compared to saved results with
+``--baseline``, in which case the exit status is 1 when an operation is
+slower or uses more memory than the baseline beyond ``--tolerance``.
+Baselines only hold for the machine they were recorded on.
+"""
+
+import argparse
+import json
+import netaddr
+import platform
+import random
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from osa_toolkit import ip
+
+DEFAULT_PREFIXES = (24, 20, 16, 12)
+
+DEFAULT_DENSITIES = (0.0, 0.5, 0.9)
+
+RELEASE_PATTERNS = ('fifo', 'lifo', 'random')
+
+BLOCK_SIZE = 1024
+
+QUEUE = 'container'
+
+
+def _network(prefix):
+    return netaddr.IPNetwork('10.0.0.0/{}'.format(prefix))
+
+
+def used_ranges(prefix, density):
+    """Return the used address ranges of a network.
+
+    :param prefix: ``int`` Prefix length of the network
+    :param density: ``float`` Share of the addresses which are used
+    :returns: ``list`` ``"start,end"`` ranges, in the ``used_ips`` format
+    """
+    net = _network(prefix)
+    block_size = min(BLOCK_SIZE, net.size)
+    used_per_block = int(block_size * density)
+    if not used_per_block:
+        return []
+    ranges = []
+    for block in range(net.first, net.last + 1, block_size):
+        # Skip the network address, which is never handed out.
+        start = max(block, net.first + 1)
+        end = min(block + used_per_block - 1, net.last - 1)
+        if start <= end:
+            ranges.append('{},{}'.format(netaddr.IPAddress(start),
+                                         netaddr.IPAddress(end)))
+    return ranges
+
+
+def _range_size(used_range):
+    start, end = used_range.split(',')
+    return int(netaddr.IPAddress(end)) - int(netaddr.IPAddress(start)) + 1
+
+
+class Case(object):
+    """One operation measured with a set of parameters"""
+    def __init__(self, operation, prefix, density, placement=None,
+                 pattern=None, count=500):
+        """Create a case
+
+        :param operation: ``str`` Name of the operation
+        :param prefix: ``int`` Prefix length of the network
+        :param density: ``float`` Share of the addresses which are used
+        :param placement: ``str`` Placement of the ``IPManager``
+        :param pattern: ``str`` One of ``RELEASE_PATTERNS``
+        :param count: ``int`` Number of addresses to hand out
+        """
+        self.operation = operation
+        self.prefix = prefix
+        self.density = density
+        self.placement = placement or 'random'
+        self.pattern = pattern
+        self.used = used_ranges(prefix, density)
+        free = _network(prefix).size - 2 - sum(
+            _range_size(used_range) for used_range in self.used
+        )
+        self.count = max(min(count, free // 2), 1)
+
+    @property
+    def name(self):
+        name = '{} /{} density={}'.format(self.operation, self.prefix,
+                                          self.density)
+        if self.operation not in ('load', 'set_used_ips'):
+            name += ' placement={}'.format(self.placement)
+        if self.pattern:
+            name += ' release={}'.format(self.pattern)
+        return name
+
+    def _context(self):
+        context = ip.AllocationContext(options={'placement': self.placement})
+        ip.set_used_ips({'used_ips': self.used}, {'_meta': {'hostvars': {}}},
+                        context)
+        return context
+
+    def _manager(self):
+        return self._context().create_manager(
+            {QUEUE: str(_network(self.prefix))}
+        )
+
+    def _owners(self):
+        return ['host{}'.format(index) for index in range(self.count)]
+
+    def prepare(self):
+        """Return the operation ready to run and the number of ops it does.
+
+        Everything the operation needs is built beforehand, so that only the
+        operation itself is timed.
+        """
+        return getattr(self, '_prepare_{}'.format(self.operation))()
+
+    def _prepare_load(self):
+        manager = self._manager()
+        cidr = str(_network(self.prefix))
+
+        def run():
+            # Loading a queue again replaces it.
+            for _ in range(self.count):
+                manager.load(QUEUE, cidr)
+        return run, self.count
+
+    def _prepare_set_used_ips(self):
+        manager = self._manager()
+        hostvars = dict(
+            (owner, {'container_networks': {
+                'container_address': {'address': address}
+            }})
+            for owner, address in zip(self._owners(),
+                                      manager.get_many(QUEUE, self.count))
+        )
+        config = {'used_ips': self.used}
+        inventory = {'_meta': {'hostvars': hostvars}}
+
+        def run():
+            ip.set_used_ips(config, inventory, ip.AllocationContext())
+        return run, len(self.used) + len(hostvars)
+
+    def _prepare_get(self):
+        manager = self._manager()
+        owners = self._owners()
+
+        def run():
+            for owner in owners:
+                manager.get(QUEUE, owner=owner)
+        return run, self.count
+
+    def _prepare_get_ip_address(self):
+        manager = self._manager()
+        owners = self._owners()
+
+        def run():
+            for owner in owners:
+                ip.get_ip_address(QUEUE, manager, owner=owner)
+        return run, self.count
+
+    def _prepare_get_many(self):
+        manager = self._manager()
+        owners = self._owners()
+
+        def run():
+            manager.get_many(QUEUE, self.count, owners=owners)
+        return run, self.count
+
+    def _prepare_release(self):
+        manager = self._manager()
+        owners = self._owners()
+        addresses = manager.get_many(QUEUE, self.count, owners=owners)
+        if self.pattern == 'lifo':
+            addresses.reverse()
+        elif self.pattern == 'random':
+            random.Random(self.count).shuffle(addresses)
+
+        def run():
+            for address in addresses:
+                manager.release(address)
+            for owner in owners:
+                manager.get(QUEUE, owner=owner)
+        return run, self.count * 2
+
+
+def make_cases(prefixes=DEFAULT_PREFIXES, densities=DEFAULT_DENSITIES,
+               placements=ip.IPManager.placements, count=500):
+    """Return every case for a set of parameters.
+
+    :param prefixes: ``list`` Prefix lengths of the networks
+    :param densities: ``list`` Shares of the addresses which are used
+    :param placements: ``list`` Placements of the ``IPManager``
+    :param count: ``int`` Number of addresses to hand out
+    """
+    cases = []
+    for prefix in prefixes:
+        for density in densities:
+            for operation in ('load', 'set_used_ips'):
+                cases.append(Case(operation, prefix, density, count=count))
+            for placement in placements:
+                for operation in ('get', 'get_ip_address', 'get_many'):
+                    cases.append(Case(operation, prefix, density, placement,
+                                      count=count))
+                for pattern in RELEASE_PATTERNS:
+                    cases.append(Case('release', prefix, density, placement,
+                                      pattern, count=count))
+    return cases
+
+
+def _peak_memory(case):
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        run, _ = case.prepare()
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_case(case, repeat=1):
+    """Measure a case.
+
+    :param case: ``Case`` Case to measure
+    :param repeat: ``int`` Number of timed runs, the fastest is kept
+    :returns: ``dict`` Operations per second and peak memory allocated while
+        preparing and running the operation, in bytes
+    """
+    best = None
+    for _ in range(repeat):
+        run, ops = case.prepare()
+        start = time.time()
+        run()
+        seconds = max(time.time() - start, 1e-9)
+        if best is None or seconds < best:
+            best = seconds
+    return {
+        'ops_per_second': ops / best,
+        'peak_memory': _peak_memory(case)
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of results against a baseline.
+
+    Only the cases found in both are compared.
+
+    :param results: ``dict`` Results of ``run_cases``
+    :param baseline: ``dict`` Results of an earlier run
+    :param tolerance: ``float`` Allowed slow down or memory increase, 0.25
+        for 25%
+    :returns: ``list`` Description of every regression
+    """
+    regressions = []
+    for name, result in sorted(results['cases'].items()):
+        base = baseline['cases'].get(name)
+        if base is None:
+            continue
+        ops, base_ops = result['ops_per_second'], base['ops_per_second']
+        if ops < base_ops / (1 + tolerance):
+            regressions.append(
+                '{} ops/s: {:.4g} against {:.4g} ({:.0%})'.format(
+                    name, ops, base_ops, ops / base_ops - 1
+                )
+            )
+        memory, base_memory = result['peak_memory'], base['peak_memory']
+        if memory is not None and base_memory:
+            if memory > base_memory * (1 + tolerance):
+                regressions.append(
+                    '{} peak memory: {} against {} (+{:.0%})'.format(
+                        name, memory, base_memory, memory / base_memory - 1
+                    )
+                )
+    return regressions
+
+
+def run_cases(cases, repeat=1, out=None):
+    """Measure several cases.
+
+    :param cases: ``list`` Cases to measure
+    :param repeat: ``int`` Number of timed runs of each case
+    :param out: File to print the results to as they come
+    """
+    results = {
+        'python': platform.python_version(),
+        'cases': {}
+    }
+    for case in cases:
+        result = results['cases'][case.name] = run_case(case, repeat)
+        if out is not None:
+            memory = result['peak_memory']
+            out.write('{:<58} {:>12,.0f} ops/s {:>10}\n'.format(
+                case.name, result['ops_per_second'],
+                '-' if memory is None else
+                '{:.1f}MiB'.format(memory / 1048576.0)
+            ))
+            out.flush()
+    return results
+
+
+def _list_of(cast):
+    return lambda value: [cast(item) for item in value.split(',')]
+
+
+def args(arg_list):
+    """Setup argument Parsing."""
+    parser = argparse.ArgumentParser(
+        usage='%(prog)s',
+        description='OpenStack Inventory IP Allocation Benchmark',
+        epilog='Inventory Benchmark Licensed "Apache 2.0"')
+
+    parser.add_argument(
+        '--prefixes',
+        help='Comma separated prefix lengths of the networks',
+        type=_list_of(int),
+        default=list(DEFAULT_PREFIXES)
+    )
+
+    parser.add_argument(
+        '--densities',
+        help='Comma separated shares of used addresses, between 0 and 1',
+        type=_list_of(float),
+        default=list(DEFAULT_DENSITIES)
+    )
+
+    parser.add_argument(
+        '--placements',
+        help='Comma separated placements, out of {}'.format(
+            ', '.join(ip.IPManager.placements)),
+        type=_list_of(str),
+        default=list(ip.IPManager.placements)
+    )
+
+    parser.add_argument(
+        '--count',
+        help='Number of addresses handed out by each operation',
+        type=int,
+        default=500
+    )
+
+    parser.add_argument(
+        '--repeat',
+        help='Number of timed runs of each operation, the fastest is kept',
+        type=int,
+        default=1
+    )
+
+    parser.add_argument(
+        '--save',
+        help='Save the results to a JSON file, to be used as baseline',
+        default=None
+    )
+
+    parser.add_argument(
+        '--baseline',
+        help='Compare the results to a file written with --save',
+        default=None
+    )
+
+    parser.add_argument(
+        '--tolerance',
+        help='Allowed slow down over the baseline, 0.25 for 25%%',
+        type=float,
+        default=0.25
+    )
+
+    parsed = parser.parse_args(arg_list)
+    unknown = set(parsed.placements) - set(ip.IPManager.placements)
+    if unknown:
+        parser.error('unknown placements: {}'.format(
+            ', '.join(sorted(unknown))))
+    if not all(0 <= density < 1 for density in parsed.densities):
+        parser.error('densities must be at least 0 and lower than 1')
+    return vars(parsed)
+
+
+def main(arg_list=None):
+    user_args = args(arg_list)
+    cases = make_cases(user_args['prefixes'], user_args['densities'],
+                       user_args['placements'], user_args['count'])
+    results = run_cases(cases, user_args['repeat'], out=sys.stdout)
+
+    if user_args['save']:
+        with open(user_args['save'], 'w') as f:
+            f.write(json.dumps(results, indent=4, separators=(',', ': '),
+                               sort_keys=True) + '\n')
+
+    if user_args['baseline']:
+        with open(user_args['baseline']) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, user_args['tolerance'])
+        for regression in regressions:
+            sys.stdout.write('REGRESSION {}\n'.format(regression))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+import benchmark_inventory
+import benchmark_ip
+
+
+def make_results(seconds, peak_memory, phases=None):
+    return {
+        'sizes': {
+            '10': {
+                'hosts': 10,
+                'containers': 73,
+                'scenarios': {
+                    'full': {
+                        'seconds': seconds,
+                        'peak_memory': peak_memory,
+                        'phases': phases or {}
+                    }
+                }
+            }
+        }
+    }
+
+
+class TestInventoryBenchmark(unittest.TestCase):
+    def test_config_sizes(self):
+        config = benchmark_inventory.make_config(100)
+
+        self.assertEqual(3, len(config['shared-infra_hosts']))
+        self.assertEqual(9, len(config['storage_hosts']))
+        self.assertEqual(88, len(config['compute_hosts']))
+        self.assertEqual(2, config['shared-infra_hosts']['infra1']
+                         ['affinity']['rabbit_mq_container'])
+
+    def test_added_host_address_unused(self):
+        config = benchmark_inventory.make_config(10)
+        addresses = set(host['ip'] for group in ('shared-infra_hosts',
+                                                 'compute_hosts')
+                        for host in config[group].values())
+
+        benchmark_inventory.add_compute_host(config)
+
+        self.assertNotIn(config['compute_hosts']['compute8']['ip'],
+                         addresses)
+
+    def test_run_benchmark(self):
+        result = benchmark_inventory.run_benchmark(10)
+
+        self.assertEqual(10, result['hosts'])
+        # One container on each of the seven compute hosts
+        self.assertGreater(result['containers'], 7)
+        self.assertEqual(set(benchmark_inventory.SCENARIOS),
+                         set(result['scenarios']))
+        full = result['scenarios']['full']
+        self.assertIn('write_inventory', full['phases'])
+        self.assertNotIn('containers', result['scenarios']['noop']['phases'])
+
+    def test_compare_within_tolerance(self):
+        baseline = make_results(1.0, 1000)
+        results = make_results(1.2, 1100)
+
+        self.assertEqual([], benchmark_inventory.compare(results, baseline,
+                                                         0.25))
+
+    def test_compare_regressions(self):
+        baseline = make_results(1.0, 1000, {'containers': 0.5})
+        results = make_results(1.5, 1000, {'containers': 1.0})
+
+        regressions = benchmark_inventory.compare(results, baseline, 0.25)
+
+        self.assertEqual(2, len(regressions))
+        self.assertTrue(regressions[0].startswith('10 hosts full seconds'))
+        self.assertIn('phase containers', regressions[1])
+
+    def test_compare_skips_unknown_sizes(self):
+        baseline = make_results(1.0, 1000)
+        results = make_results(2.0, 2000)
+        results['sizes']['100'] = results['sizes'].pop('10')
+
+        self.assertEqual([], benchmark_inventory.compare(results, baseline,
+                                                         0.25))
+
+
+class TestIPBenchmark(unittest.TestCase):
+    def test_used_ranges(self):
+        used = benchmark_ip.used_ranges(20, 0.5)
+
+        self.assertEqual(['10.0.0.1,10.0.1.255', '10.0.4.0,10.0.5.255',
+                          '10.0.8.0,10.0.9.255', '10.0.12.0,10.0.13.255'],
+                         used)
+
+    def test_count_limited_by_free_addresses(self):
+        case = benchmark_ip.Case('get', 24, 0.9, count=1000)
+
+        self.assertEqual(12, case.count)
+
+    def test_cases(self):
+        cases = benchmark_ip.make_cases(prefixes=[24], densities=[0.5],
+                                        count=10)
+
+        names = set(case.name for case in cases)
+        self.assertEqual(len(cases), len(names))
+        self.assertIn('load /24 density=0.5', names)
+        self.assertIn('release /24 density=0.5 placement=hashed '
+                      'release=lifo', names)
+
+    def test_run_cases(self):
+        cases = benchmark_ip.make_cases(prefixes=[24], densities=[0.5],
+                                        placements=['sequential'], count=10)
+
+        results = benchmark_ip.run_cases(cases)
+
+        self.assertEqual(len(cases), len(results['cases']))
+        for result in results['cases'].values():
+            self.assertGreater(result['ops_per_second'], 0)
+
+    def test_compare(self):
+        baseline = {'cases': {
+            'get': {'ops_per_second': 1000.0, 'peak_memory': 1000},
+            'load': {'ops_per_second': 1000.0, 'peak_memory': 1000},
+        }}
+        results = {'cases': {
+            'get': {'ops_per_second': 700.0, 'peak_memory': 1000},
+            'load': {'ops_per_second': 900.0, 'peak_memory': None},
+            'release': {'ops_per_second': 1.0, 'peak_memory': 1},
+        }}
+
+        regressions = benchmark_ip.compare(results, baseline, 0.25)
+
+        self.assertEqual(1, len(regressions))
+        self.assertTrue(regressions[0].startswith('get ops/s'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,6 +12,8 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import copy
+import json
 import unittest
 
 from osa_toolkit import dictutils as du
@@ -156,5 +158,53 @@ class TestDictRemovalUnit(unittest.TestCase):
         self.assertNotIn('key1.1.1', base['key1']['key1.1'])
 
 
+class TestOrderedSet(unittest.TestCase):
+    def test_keeps_insertion_order(self):
+        members = du.OrderedSet(['b', 'a', 'b', 'c'])
+
+        self.assertEqual(['b', 'a', 'c'], members)
+
+    def test_append_if(self):
+        members = du.OrderedSet(['a'])
+
+        self.assertFalse(du.append_if(array=members, item='a'))
+        self.assertTrue(du.append_if(array=members, item='b'))
+        self.assertEqual(['a', 'b'], members)
+
+    def test_serialises_as_list(self):
+        members = du.OrderedSet(['b', 'a'])
+
+        self.assertEqual('{"hosts": ["b", "a"]}',
+                         json.dumps({'hosts': members}))
+
+    def test_removal_updates_membership(self):
+        members = du.OrderedSet(['a', 'b', 'c'])
+        members.remove('a')
+        members.pop()
+        del members[0]
+
+        self.assertEqual([], members)
+        self.assertNotIn('b', members)
+        members.append('b')
+        self.assertEqual(['b'], members)
+
+    def test_list_removal(self):
+        base = {'key1': du.OrderedSet(['value1', 'value2'])}
+
+        du.recursive_dict_removal(base, ['value1'])
+
+        self.assertEqual(['value2'], base['key1'])
+        self.assertNotIn('value1', base['key1'])
+
+    def test_deepcopy(self):
+        members = du.OrderedSet(['a', 'b'])
+
+        copied = copy.deepcopy(members)
+
+        self.assertEqual(['a', 'b'], copied)
+        self.assertIsInstance(copied, du.OrderedSet)
+        self.assertIn('a', copied)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -13,11 +13,15 @@
 # under the License.
 #
 
+import json
 import mock
 import os
 from os import path
+import shutil
 import sys
+import tempfile
 import unittest
+import yaml
 
 from test_inventory import cleanup
 from test_inventory import get_inventory
@@ -28,6 +32,7 @@ INV_DIR = 'playbooks/inventory'
 sys.path.append(path.join(os.getcwd(), INV_DIR))
 
 from osa_toolkit import filesystem as fs
+from osa_toolkit import generate
 
 TARGET_DIR = path.join(os.getcwd(), 'tests', 'inventory')
 USER_CONFIG_FILE = path.join(TARGET_DIR, 'openstack_user_config.yml')
@@ -99,5 +104,259 @@ class TestMultipleRuns(unittest.TestCase):
         cleanup()
 
 
+class TestWriteInventory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.inventory_file = path.join(self.tmpdir,
+                                        'openstack_inventory.json')
+
+    def tearDown(self):
+        cleanup()
+
+    def test_formatted_like_json_dumps(self):
+        inventory = get_inventory()
+
+        fs.write_inventory(inventory, self.tmpdir)
+
+        with open(self.inventory_file) as f:
+            written = f.read()
+        self.assertEqual(json.dumps(inventory, indent=4,
+                                    separators=(',', ': '), sort_keys=True),
+                         written)
+        with open(path.join(self.tmpdir, fs.HOST_INDEX_FILENAME)) as f:
+            index = json.load(f)
+        self.assertEqual(fs.host_offsets(written), index['hosts'])
+
+    def test_failed_write_keeps_inventory(self):
+        fs.write_inventory({'all': {'hosts': []}}, self.tmpdir)
+
+        with self.assertRaises(TypeError):
+            fs.write_inventory({'all': {'hosts': [object()]}}, self.tmpdir)
+
+        with open(self.inventory_file) as f:
+            self.assertEqual({'all': {'hosts': []}}, json.load(f))
+        self.assertEqual(
+            sorted(['openstack_inventory.json', fs.HOST_INDEX_FILENAME]),
+            sorted(os.listdir(self.tmpdir))
+        )
+
+    def test_files_synced_before_replacing(self):
+        with mock.patch('osa_toolkit.filesystem.os.fsync',
+                        side_effect=os.fsync) as fsync_mock:
+            fs.write_inventory({'all': {'hosts': []}}, self.tmpdir)
+            fs.save_fingerprint({'files': {}}, self.tmpdir)
+
+        # The inventory, its host index and the fingerprint
+        self.assertEqual(3, fsync_mock.call_count)
+        self.assertEqual(
+            sorted(['openstack_inventory.json', fs.HOST_INDEX_FILENAME,
+                    fs.FINGERPRINT_FILENAME]),
+            sorted(os.listdir(self.tmpdir))
+        )
+
+    def test_inventory_mode_kept(self):
+        fs.write_inventory({'all': {'hosts': []}}, self.tmpdir)
+        os.chmod(self.inventory_file, 0o600)
+
+        fs.write_inventory({'all': {'hosts': ['aio1']}}, self.tmpdir)
+
+        self.assertEqual(0o600, os.stat(self.inventory_file).st_mode & 0o777)
+        with open(self.inventory_file) as f:
+            self.assertEqual({'all': {'hosts': ['aio1']}}, json.load(f))
+
+    def test_check_mode_not_written(self):
+        with mock.patch('osa_toolkit.filesystem.write_inventory') as write:
+            result = generate.main(config=TARGET_DIR, check=True,
+                                   environment=INV_DIR)
+
+        self.assertEqual('Configuration ok!', result)
+        self.assertFalse(write.called)
+
+
+class TestFingerprintCache(unittest.TestCase):
+    def tearDown(self):
+        cleanup()
+
+    def test_unchanged_inputs_use_stored_inventory(self):
+        first = get_inventory(clean=False)
+
+        load_path = 'osa_toolkit.filesystem.load_user_configuration'
+        with mock.patch(load_path) as load_mock:
+            second = get_inventory(clean=False)
+
+        self.assertFalse(load_mock.called)
+        self.assertEqual(first, second)
+
+    def test_changed_inventory_regenerates(self):
+        get_inventory(clean=False)
+        inventory_file = path.join(TARGET_DIR, 'openstack_inventory.json')
+        with open(inventory_file) as f:
+            inventory = json.load(f)
+        inventory['all']['vars']['extra'] = 'value'
+        with open(inventory_file, 'w') as f:
+            json.dump(inventory, f)
+
+        regenerated = get_inventory(clean=False)
+
+        self.assertNotIn('extra', regenerated['all']['vars'])
+
+    def test_changed_config_regenerates(self):
+        get_inventory(clean=False)
+        with open(USER_CONFIG_FILE) as f:
+            original = f.read()
+        self.addCleanup(self.write_user_config, original)
+        self.write_user_config(
+            original + '\ncompute_hosts:\n  compute9:\n'
+            '    ip: 172.29.236.109\n'
+        )
+
+        regenerated = get_inventory(clean=False)
+
+        self.assertIn('compute9', regenerated['compute_hosts']['hosts'])
+
+    def test_check_mode_ignores_stored_inventory(self):
+        get_inventory(clean=False)
+
+        result = generate.main(config=TARGET_DIR, check=True,
+                               environment=INV_DIR)
+
+        self.assertEqual('Configuration ok!', result)
+
+    def write_user_config(self, content):
+        with open(USER_CONFIG_FILE, 'w') as f:
+            f.write(content)
+
+
+class TestIncrementalGeneration(unittest.TestCase):
+    def setUp(self):
+        self.inventory = get_inventory(clean=False)
+        with open(USER_CONFIG_FILE) as f:
+            self.original = f.read()
+        self.addCleanup(self.write_user_config, self.original)
+
+    def tearDown(self):
+        cleanup()
+
+    def built_hosts(self):
+        build_path = 'osa_toolkit.generate._build_container_hosts'
+        with mock.patch(build_path,
+                        side_effect=generate._build_container_hosts) as build:
+            inventory = get_inventory(clean=False)
+        return inventory, set(call[0][4] for call in build.call_args_list)
+
+    def test_added_host_only_builds_it(self):
+        self.add_compute_host()
+
+        inventory, built = self.built_hosts()
+
+        self.assertEqual(set(['compute9']), built)
+        self.assertIn('compute9', inventory['compute_hosts']['hosts'])
+        self.assertIn('compute9', inventory['nova_compute']['hosts'])
+        for host, host_vars in self.inventory['_meta']['hostvars'].items():
+            self.assertEqual(host_vars, inventory['_meta']['hostvars'][host])
+
+    def test_changed_settings_build_all_hosts(self):
+        self.write_user_config(
+            self.original + '\nextra_setting: value\n'
+        )
+
+        inventory, built = self.built_hosts()
+
+        self.assertIn('aio1', built)
+
+    def test_changed_inventory_builds_all_hosts(self):
+        inventory_file = path.join(TARGET_DIR, 'openstack_inventory.json')
+        self.inventory['all']['vars']['extra'] = 'value'
+        with open(inventory_file, 'w') as f:
+            json.dump(self.inventory, f)
+        self.add_compute_host()
+
+        inventory, built = self.built_hosts()
+
+        self.assertIn('aio1', built)
+
+    def add_compute_host(self):
+        config = yaml.safe_load(self.original)
+        config['compute_hosts']['compute9'] = {'ip': '172.29.236.109'}
+        self.write_user_config(yaml.safe_dump(config))
+
+    def write_user_config(self, content):
+        with open(USER_CONFIG_FILE, 'w') as f:
+            f.write(content)
+
+
+class TestHostVars(unittest.TestCase):
+    def setUp(self):
+        self.inventory = get_inventory(clean=False)
+
+    def tearDown(self):
+        cleanup()
+
+    def test_indexed_host_vars(self):
+        hostvars = self.inventory['_meta']['hostvars']
+
+        with mock.patch('osa_toolkit.filesystem.json.loads',
+                        side_effect=json.loads) as loads_mock:
+            found = dict((host, fs.load_host_vars(host, TARGET_DIR))
+                         for host in hostvars)
+
+        # Only the index is parsed, never the whole inventory
+        self.assertEqual(len(hostvars), loads_mock.call_count)
+        for host, variables in found.items():
+            self.assertEqual(hostvars[host], json.loads(variables))
+
+    def test_unknown_host(self):
+        self.assertEqual('{}', fs.load_host_vars('missing', TARGET_DIR))
+
+    def test_out_of_date_index(self):
+        inventory_file = path.join(TARGET_DIR, 'openstack_inventory.json')
+        self.inventory['_meta']['hostvars']['aio1']['extra'] = 'value'
+        with open(inventory_file, 'w') as f:
+            json.dump(self.inventory, f)
+
+        host_vars = json.loads(fs.load_host_vars('aio1', TARGET_DIR))
+
+        self.assertEqual('value', host_vars['extra'])
+
+    def test_generates_missing_inventory(self):
+        cleanup()
+
+        host_vars = json.loads(generate.host_vars('aio1', config=TARGET_DIR,
+                                                  environment=INV_DIR))
+
+        self.assertEqual('aio1', host_vars['container_name'])
+
+
+class TestFingerprintFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.file = path.join(self.tmpdir, 'user_config.yml')
+        with open(self.file, 'w') as f:
+            f.write('key: value\n')
+
+    def test_unchanged_file_is_not_read(self):
+        previous = fs.fingerprint_files([self.file])
+
+        with mock.patch('osa_toolkit.filesystem.open', create=True) as o:
+            current = fs.fingerprint_files([self.file], previous)
+
+        self.assertFalse(o.called)
+        self.assertEqual(previous, current)
+
+    def test_touched_file_keeps_hash(self):
+        previous = fs.fingerprint_files([self.file])
+        stat = os.stat(self.file)
+        os.utime(self.file, (stat.st_atime, stat.st_mtime + 10))
+
+        current = fs.fingerprint_files([self.file], previous)
+
+        self.assertEqual(previous[self.file]['sha256'],
+                         current[self.file]['sha256'])
+        self.assertNotEqual(previous[self.file]['mtime'],
+                            current[self.file]['mtime'])
+
+
 if __name__ == '__main__':
     unittest.main(catchbreak=True)
@@ -14,13 +14,12 @@ import collections
 import copy
 import json
 import mock
+import netaddr
 import os
 from os import path
-try:
-    import Queue
-except ImportError:
-    import queue as Queue
+import shutil
 import sys
+import tempfile
 import unittest
 import warnings
 import yaml
@@ -47,7 +46,16 @@ USER_CONFIG_FILE = path.join(TARGET_DIR, 'openstack_user_config.yml')
 CLEANUP = [
     'openstack_inventory.json',
     'openstack_hostnames_ips.yml',
-    'backup_openstack_inventory.tar'
+    'backup_openstack_inventory.tar',
+    'openstack_inventory_fingerprint.json',
+    'openstack_inventory_hosts.json'
+]
+
+# Sidecar files written next to the inventory by the tests which fake the
+# inventory location as INV_DIR
+INV_DIR_CLEANUP = [
+    'openstack_inventory_fingerprint.json',
+    'openstack_inventory_hosts.json'
 ]
 
 # Base config is a global configuration accessible for convenience.
@@ -92,6 +100,10 @@ def cleanup():
         f_file = path.join(TARGET_DIR, f_name)
         if os.path.exists(f_file):
             os.remove(f_file)
+    for f_name in INV_DIR_CLEANUP:
+        f_file = path.join(INV_DIR, f_name)
+        if os.path.exists(f_file):
+            os.remove(f_file)
 
 
 def get_inventory(clean=True, extra_args=None):
@@ -128,6 +140,14 @@ class TestArgParser(unittest.TestCase):
                                            '/etc/openstack_deploy'])
         self.assertEqual(arg_dict['config'], '/etc/openstack_deploy')
 
+    def test_host_arg(self):
+        arg_dict = dynamic_inventory.args(['--host', 'aio1'])
+        self.assertEqual(arg_dict['host'], 'aio1')
+
+    def test_ip_report_arg(self):
+        arg_dict = dynamic_inventory.args(['--ip-report'])
+        self.assertEqual(arg_dict['ip_report'], True)
+
 
 class TestAnsibleInventoryFormatConstraints(unittest.TestCase):
     inventory = None
@@ -498,10 +518,7 @@ class TestIps(unittest.TestCase):
         mock_open = mock.mock_open()
 
         for i in range(0, 99):
-            # tearDown is ineffective for this loop, so clean the USED_IPs
-            # on each run
             inventory = None
-            di.ip.USED_IPS = set()
 
             # Mock out the context manager being used to write files.
             # We don't need to hit the file system for this test.
@@ -522,19 +539,239 @@ class TestIps(unittest.TestCase):
                                          msg="IP %s duplicated." % addr)
 
     def test_empty_ip_queue(self):
-        q = Queue.Queue()
+        # The only address of a /32 is its network address.
+        manager = di.ip.IPManager(queues={'test': '192.168.0.0/32'})
         with self.assertRaises(SystemExit) as context:
             # TODO(nrb): import and use ip module directly
-            di.ip.get_ip_address('test', q)
+            di.ip.get_ip_address('test', manager)
         expectedLog = ("Cannot retrieve requested amount of IP addresses. "
                        "Increase the test range in your "
                        "openstack_user_config.yml.")
         self.assertEqual(str(context.exception), expectedLog)
 
+    @mock.patch('osa_toolkit.filesystem.load_environment')
+    @mock.patch('osa_toolkit.filesystem.load_user_configuration')
+    def test_runs_do_not_share_used_ips(self, mock_load_config,
+                                        mock_load_env):
+        mock_load_config.return_value = get_config()
+        mock_load_env.return_value = self.env
+
+        first = di.ip.AllocationContext()
+        second = di.ip.AllocationContext()
+        get_inventory(extra_args={'context': first})
+        get_inventory(extra_args={'context': second})
+
+        self.assertEqual(len(first.used_ips), len(second.used_ips))
+
+    @mock.patch('osa_toolkit.filesystem.load_environment')
+    @mock.patch('osa_toolkit.filesystem.load_user_configuration')
+    def test_exhausted_queue_allocates_nothing(self, mock_load_config,
+                                               mock_load_env):
+        config = get_config()
+        config['cidr_networks']['storage'] = '172.29.244.0/30'
+        mock_load_config.return_value = config
+        mock_load_env.return_value = self.env
+        context = di.ip.AllocationContext()
+
+        with self.assertRaises(SystemExit) as exit_context:
+            get_inventory(extra_args={'context': context})
+
+        self.assertIn('Increase the storage range',
+                      str(exit_context.exception))
+        fresh = di.ip.IPManager(queues=config['cidr_networks'],
+                                used_ips=context.used_ips)
+        for name in config['cidr_networks']:
+            self.assertEqual(len(fresh[name]), len(context.manager[name]))
+
+    @mock.patch('osa_toolkit.filesystem.load_environment')
+    @mock.patch('osa_toolkit.filesystem.load_user_configuration')
+    def test_sqlite_ipam_plugin(self, mock_load_config, mock_load_env):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        ledger = path.join(tmpdir, 'ipam.sqlite')
+        config = get_config()
+        config['ipam'] = {'plugin': 'sqlite', 'options': {'path': ledger}}
+        mock_load_config.return_value = config
+        mock_load_env.return_value = self.env
+
+        inventory = get_inventory()
+
+        manager = di.ip.SQLiteIPManager(path=ledger)
+        self.addCleanup(manager.close)
+        checked = 0
+        for host, hostvars in inventory['_meta']['hostvars'].items():
+            if hostvars['properties'].get('is_metal'):
+                continue
+            for network in hostvars['container_networks'].values():
+                if 'address' in network:
+                    self.assertEqual(host, manager.owner(network['address']))
+                    checked += 1
+        self.assertNotEqual(0, checked)
+
+    @mock.patch('osa_toolkit.filesystem.load_environment')
+    @mock.patch('osa_toolkit.filesystem.load_user_configuration')
+    def test_dual_stack_provider_network(self, mock_load_config,
+                                         mock_load_env):
+        config = get_config()
+        config['cidr_networks']['container_v6'] = 'fd00:29:236::/64'
+        for pn in config['global_overrides']['provider_networks']:
+            if pn['network'].get('ip_from_q') == 'container':
+                pn['network']['ip6_from_q'] = 'container_v6'
+        mock_load_config.return_value = config
+        mock_load_env.return_value = self.env
+
+        inventory = get_inventory()
+
+        v6_net = netaddr.IPNetwork('fd00:29:236::/64')
+        addresses = []
+        for hostvars in inventory['_meta']['hostvars'].values():
+            if hostvars['properties'].get('is_metal'):
+                continue
+            network = hostvars['container_networks']['container_address']
+            self.assertIn('address', network)
+            self.assertIn(netaddr.IPAddress(network['address_v6']), v6_net)
+            self.assertEqual('ffff:ffff:ffff:ffff::', network['netmask_v6'])
+            addresses.append(network['address_v6'])
+        self.assertNotEqual(0, len(addresses))
+        self.assertEqual(len(addresses), len(set(addresses)))
+
+    @mock.patch('osa_toolkit.filesystem.load_environment')
+    @mock.patch('osa_toolkit.filesystem.load_user_configuration')
+    def test_ipv6_addresses_kept_across_runs(self, mock_load_config,
+                                             mock_load_env):
+        config = get_config()
+        config['ipam'] = {'options': {'placement': 'sequential'}}
+        config['cidr_networks']['storage6'] = 'fd00:1::/64'
+        for pn in config['global_overrides']['provider_networks']:
+            if pn['network'].get('ip_from_q') == 'storage':
+                pn['network']['ip6_from_q'] = 'storage6'
+        mock_load_config.return_value = config
+        mock_load_env.return_value = self.env
+
+        get_inventory(clean=False, extra_args={
+            'context': di.ip.AllocationContext.from_config(config['ipam'])
+        })
+        config['image_hosts']['aio9'] = {'ip': '172.29.236.109'}
+        inventory = get_inventory(extra_args={
+            'context': di.ip.AllocationContext.from_config(config['ipam'])
+        })
+
+        addresses = []
+        for hostvars in inventory['_meta']['hostvars'].values():
+            for network in hostvars['container_networks'].values():
+                if 'address_v6' in network:
+                    addresses.append(network['address_v6'])
+        self.assertTrue(any(host.startswith('aio9_')
+                            for host in inventory['_meta']['hostvars']))
+        self.assertNotEqual(0, len(addresses))
+        self.assertEqual(len(addresses), len(set(addresses)))
+
+
+class TestBuildInventory(unittest.TestCase):
+    def tearDown(self):
+        cleanup()
+
+    def build(self, **kwargs):
+        return di.build_inventory(config=TARGET_DIR,
+                                  environment=BASE_ENV_DIR, **kwargs)
+
+    def test_inventory_dict(self):
+        result = self.build()
+
+        self.assertIn('aio1', result['inventory']['_meta']['hostvars'])
+        self.assertFalse(result['cached'])
+        self.assertFalse(result['checked'])
+        inventory_file = path.join(TARGET_DIR, 'openstack_inventory.json')
+        self.assertEqual(inventory_file, result['inventory_file'])
+        with open(inventory_file) as f:
+            self.assertEqual(json.load(f), result['inventory'])
+
+    def test_allocation(self):
+        result = self.build()
+
+        config = get_config()
+        self.assertEqual(set(config['cidr_networks']),
+                         set(result['allocation']))
+        self.assertGreater(result['allocation']['container']['allocated'], 1)
+
+    def test_unchanged_inputs(self):
+        first = self.build()
+
+        second = self.build()
+
+        self.assertTrue(second['cached'])
+        self.assertEqual(first['inventory'], second['inventory'])
+        self.assertEqual(first['inventory_file'], second['inventory_file'])
+
+    def test_check(self):
+        result = self.build(check=True)
+
+        self.assertTrue(result['checked'])
+        self.assertIsNone(result['inventory_file'])
+        self.assertIn('aio1', result['inventory']['_meta']['hostvars'])
+        self.assertFalse(path.exists(path.join(TARGET_DIR,
+                                               'openstack_inventory.json')))
+
+
+class TestIPReport(unittest.TestCase):
     def tearDown(self):
-        # Since the get_ip_address function touches USED_IPS,
-        # and USED_IPS is currently a global var, make sure we clean it out
-        di.ip.USED_IPS = set()
+        cleanup()
+
+    def test_report_without_inventory(self):
+        report = json.loads(di.ip_report(config=TARGET_DIR))
+
+        config = get_config()
+        self.assertEqual(set(config['cidr_networks']), set(report))
+        # Only the aio1 host address is allocated before any container.
+        self.assertEqual(1, report['container']['allocated'])
+        self.assertEqual(0, report['storage']['allocated'])
+
+    def test_report_counts_inventory_addresses(self):
+        inventory = get_inventory(clean=False)
+
+        report = json.loads(di.ip_report(config=TARGET_DIR))
+
+        container_net = netaddr.IPNetwork(report['container']['cidr'])
+        addresses = set()
+        for hostvars in inventory['_meta']['hostvars'].values():
+            candidates = [hostvars['container_address']]
+            for network in hostvars.get('container_networks', {}).values():
+                candidates.append(network.get('address'))
+            for address in candidates:
+                if address and netaddr.IPAddress(address) in container_net:
+                    addresses.add(address)
+        stats = report['container']
+        self.assertEqual(len(addresses), stats['allocated'])
+        self.assertEqual(stats['total'], (stats['reserved'] +
+                                          stats['allocated'] +
+                                          stats['free']))
+        self.assertTrue(0 < stats['largest_free_block'] <= stats['free'])
+
+    def test_report_does_not_backup_inventory(self):
+        get_inventory(clean=False)
+        backup = path.join(TARGET_DIR, 'backup_openstack_inventory.tar')
+        # A first generation has no previous inventory to back up.
+        self.assertFalse(path.exists(backup))
+
+        di.ip_report(config=TARGET_DIR)
+
+        self.assertFalse(path.exists(backup))
+
+    @mock.patch('osa_toolkit.filesystem.load_user_configuration')
+    def test_report_uses_configured_plugin(self, mock_load_config):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        config = get_config()
+        config['ipam'] = {'plugin': 'sqlite',
+                          'options': {'path': path.join(tmpdir, 'ipam.db')}}
+        mock_load_config.return_value = config
+        get_inventory()
+
+        report = json.loads(di.ip_report(config=TARGET_DIR))
+
+        # Without an inventory, the containers' addresses are only known to
+        # the ledger of the configured plugin.
+        self.assertLess(1, report['container']['allocated'])
 
 
 class TestConfigCheckBase(unittest.TestCase):
@@ -630,6 +867,17 @@ class TestConfigChecks(TestConfigCheckBase):
         expectedLog = "can't find storage in cidr_networks"
         self.assertEqual(str(context.exception), expectedLog)
 
+    def test_ip6_from_q_not_ipv6(self):
+        pns = self.user_defined_config['global_overrides']['provider_networks']
+        for pn in pns:
+            if pn['network'].get('ip_from_q') == 'container':
+                pn['network']['ip6_from_q'] = 'storage'
+        self.write_config()
+        with self.assertRaises(SystemExit) as context:
+            get_inventory()
+        expectedLog = "ip6_from_q storage is not an IPv6 network"
+        self.assertEqual(str(context.exception), expectedLog)
+
     def test_missing_cidr_networks_key(self):
         del self.user_defined_config['cidr_networks']
         self.write_config()
@@ -738,6 +986,74 @@ class TestConfigChecks(TestConfigCheckBase):
         self.assertTrue(ret)
 
 
+class TestConfigValidation(TestConfigCheckBase):
+    def test_all_errors_reported(self):
+        self.set_new_ip(self.user_defined_config, 'haproxy_hosts', 'aio1',
+                        '172.29.236.101')
+        self.user_defined_config['lxc_hosts'] = {
+            'lxc1': {'ip': '172.29.236.102'}
+        }
+        self.delete_provider_network('storage')
+
+        with self.assertRaises(di.ConfigValidationError) as context:
+            get_inventory()
+
+        errors = context.exception.errors
+        self.assertEqual(
+            [SystemExit, di.MultipleIpForHostError, di.LxcHostsDefined],
+            [type(error) for error in errors]
+        )
+        self.assertEqual("can't find storage in cidr_networks",
+                         str(errors[0]))
+        self.assertIn("The user configuration has 3 errors",
+                      str(context.exception))
+        for error in errors:
+            self.assertIn(str(error), str(context.exception))
+
+    def test_check_mode_reports_all_errors(self):
+        self.add_host('compute_hosts', 'compute1', '172.29.236.100')
+        self.add_host('storage_hosts', 'storage1', '172.29.236.100')
+
+        with self.assertRaises(di.ConfigValidationError) as context:
+            get_inventory(extra_args={'check': True})
+
+        self.assertEqual(['compute1', 'storage1'],
+                         sorted(error.new_host
+                                for error in context.exception.errors))
+
+    def test_conflict_reported_once(self):
+        config = collections.OrderedDict()
+        config['shared-infra_hosts'] = {'host1': {'ip': '192.168.1.1'}}
+        config['repo-infra_hosts'] = {'host1': {'ip': '192.168.1.1'}}
+        config['compute_hosts'] = {'host2': {'ip': '192.168.1.1'}}
+        config['storage_hosts'] = {'host2': {'ip': '192.168.1.1'}}
+
+        host_map = di._HostAddressMap(config)
+
+        self.assertEqual(1, len(host_map.shared_ips))
+        self.assertEqual([], host_map.multiple_ips)
+        self.assertEqual({'192.168.1.1': 'host1'}, host_map.hosts_by_ip)
+
+    def test_group_conflicts_grouped_by_parent(self):
+        physical_skel = {
+            'local-compute_hosts': {'belongs_to': ['compute_hosts']},
+            'rbd-compute_hosts': {'belongs_to': ['compute_hosts']},
+        }
+        config = {'compute_hosts': {'host1': {'ip': '192.168.1.1'}}}
+
+        errors = di._group_branch_errors(config, physical_skel)
+
+        self.assertEqual(1, len(errors))
+        self.assertIn('local-compute_hosts', str(errors[0]))
+        self.assertIn('rbd-compute_hosts', str(errors[0]))
+
+    def test_valid_config(self):
+        config = get_config()
+        env = fs.load_environment(BASE_ENV_DIR, {})
+
+        self.assertEqual([], di._config_errors(config, env))
+
+
 class TestStaticRouteConfig(TestConfigCheckBase):
     def setUp(self):
         super(TestStaticRouteConfig, self).setUp()
@@ -1123,8 +1439,7 @@ class TestOverridingEnvIntegration(OverridingEnvBase):
 
 class TestSetUsedIPS(unittest.TestCase):
     def setUp(self):
-        # Clean up the used ips in case other tests didn't.
-        di.ip.USED_IPS = set()
+        self.context = di.ip.AllocationContext()
 
         # Create a fake inventory just for this test.
         self.inventory = {'_meta': {'hostvars': {
@@ -1141,14 +1456,34 @@ class TestSetUsedIPS(unittest.TestCase):
 
         # TODO(nrb): This is a smell, needs to set more directly
 
-        di.ip.set_used_ips(config, self.inventory)
+        di.ip.set_used_ips(config, self.inventory, self.context)
+
+        self.assertEqual(len(self.context.used_ips), 2)
+        self.assertIn('172.12.1.1', self.context.used_ips)
+        self.assertIn('172.12.1.2', self.context.used_ips)
+
+    def test_adding_inventory_ipv6_addresses(self):
+        self.inventory['_meta']['hostvars']['host1']['container_networks'][
+            'net']['address_v6'] = 'fd00::1'
+
+        di.ip.set_used_ips({}, self.inventory, self.context)
+
+        self.assertIn('fd00::1', self.context.used_ips)
+        self.assertIn('fd00::1', self.context.allocated_ips)
+
+    def test_adding_used_ip_ranges(self):
+        config = {'used_ips': ['10.0.0.0,10.0.15.255', '10.1.0.1']}
 
-        self.assertEqual(len(di.ip.USED_IPS), 2)
-        self.assertIn('172.12.1.1', di.ip.USED_IPS)
-        self.assertIn('172.12.1.2', di.ip.USED_IPS)
+        di.ip.set_used_ips(config, self.inventory, self.context)
+
+        self.assertEqual(len(self.context.used_ips), 4096 + 1 + 2)
+        self.assertIn('10.0.8.1', self.context.used_ips)
+        self.assertIn('10.1.0.1', self.context.used_ips)
+        self.assertNotIn('10.0.16.0', self.context.used_ips)
+        self.assertEqual(3, len(self.context.used_ips.intervals.ranges()))
 
     def tearDown(self):
-        di.ip.USED_IPS = set()
+        self.context = None
 
 
 class TestConfigCheckFunctional(TestConfigCheckBase):
@@ -1184,6 +1519,74 @@ class TestNetworkEntry(unittest.TestCase):
         self.assertEqual(entry['interface'], 'eth1')
 
 
+class TestContainerIndex(unittest.TestCase):
+    def setUp(self):
+        self.hostvars = collections.OrderedDict()
+        self.hostvars['aio10'] = {'container_types': 'aio10-host_containers'}
+        self.hostvars['aio1_galera_container-1'] = {
+            'container_name': 'aio1_galera_container-1'
+        }
+        self.hostvars['aio1'] = {'container_types': 'aio1-host_containers'}
+        self.hostvars['infra1'] = {}
+        self.index = di._ContainerIndex(self.hostvars)
+
+    def test_prefix_in_hostvars_order(self):
+        self.assertEqual(['aio10', 'aio1_galera_container-1', 'aio1'],
+                         self.index.starting_with('aio1'))
+
+    def test_records_without_container_keys_skipped(self):
+        self.assertEqual([], self.index.starting_with('infra1'))
+
+    def test_update_new_record(self):
+        self.hostvars['aio1_rabbit_container-2'] = {
+            'container_name': 'aio1_rabbit_container-2'
+        }
+        self.index.update('aio1_rabbit_container-2')
+
+        self.assertEqual(['aio1_rabbit_container-2'],
+                         self.index.starting_with('aio1_rabbit'))
+
+    def test_update_renamed_record(self):
+        self.hostvars['infra1']['container_name'] = 'infra1'
+        self.index.update('infra1')
+        self.hostvars['infra1']['container_name'] = 'renamed'
+        self.index.update('infra1')
+
+        self.assertEqual([], self.index.starting_with('infra1'))
+        self.assertEqual(['infra1'], self.index.starting_with('renamed'))
+
+
+class TestGroupClosure(unittest.TestCase):
+    def setUp(self):
+        self.inventory = {
+            'all_containers': {'children': ['galera', 'rabbit']},
+            'galera': {'hosts': ['galera-1', 'shared-1']},
+            'rabbit': {'hosts': ['rabbit-1', 'shared-1']},
+            'hosts': {'hosts': ['aio1'], 'children': []},
+            'all': {'vars': {}},
+        }
+        self.closure = di._GroupClosure(self.inventory)
+
+    def test_children_first_each_host_once(self):
+        self.assertEqual(['galera-1', 'shared-1', 'rabbit-1'],
+                         self.closure.hosts('all_containers'))
+
+    def test_missing_group_and_group_without_hosts(self):
+        self.assertEqual([], self.closure.hosts('aio1'))
+        self.assertEqual([], self.closure.hosts('all'))
+
+    def test_union(self):
+        self.assertEqual(['aio1', 'galera-1', 'shared-1', 'rabbit-1'],
+                         self.closure.union(['hosts', 'all_containers',
+                                             'rabbit']))
+
+    def test_groups_walked_once(self):
+        self.closure.hosts('all_containers')
+        self.inventory['galera']['hosts'].append('galera-2')
+
+        self.assertNotIn('galera-2', self.closure.hosts('galera'))
+
+
 class TestDebugLogging(unittest.TestCase):
     @mock.patch('osa_toolkit.generate.logging')
     @mock.patch('osa_toolkit.generate.logger')
@@ -12,11 +12,116 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import os
+import shutil
+import tempfile
 import unittest
 
+import netaddr
+
 from osa_toolkit import ip
 
 
+class TestIntervalSet(unittest.TestCase):
+    def test_adding_merges_adjacent_ranges(self):
+        intervals = ip.IntervalSet([(1, 3), (7, 9)])
+        intervals.add_range(4, 6)
+
+        self.assertEqual([(1, 9)], intervals.ranges())
+        self.assertEqual(9, len(intervals))
+
+    def test_adding_overlapping_ranges(self):
+        intervals = ip.IntervalSet([(1, 5)])
+        intervals.add_range(3, 10)
+
+        self.assertEqual([(1, 10)], intervals.ranges())
+        self.assertEqual(10, len(intervals))
+
+    def test_discarding_splits_range(self):
+        intervals = ip.IntervalSet([(1, 10)])
+        intervals.discard_range(4, 6)
+
+        self.assertEqual([(1, 3), (7, 10)], intervals.ranges())
+        self.assertEqual(7, len(intervals))
+
+    def test_discarding_missing_value(self):
+        intervals = ip.IntervalSet([(1, 3)])
+        intervals.discard(5)
+
+        self.assertEqual([(1, 3)], intervals.ranges())
+
+    def test_membership(self):
+        intervals = ip.IntervalSet([(1, 3), (7, 9)])
+
+        self.assertIn(2, intervals)
+        self.assertIn(7, intervals)
+        self.assertNotIn(5, intervals)
+        self.assertNotIn(0, intervals)
+
+    def test_count_and_gaps(self):
+        intervals = ip.IntervalSet([(2, 3), (6, 6)])
+
+        self.assertEqual(3, intervals.count(0, 10))
+        self.assertEqual(1, intervals.count(3, 5))
+        self.assertEqual([(0, 1), (4, 5), (7, 10)],
+                         list(intervals.gaps(0, 10)))
+
+
+class TestIPRanges(unittest.TestCase):
+    def test_adding_range(self):
+        ranges = ip.IPRanges()
+        ranges.add_range('192.168.0.10', '192.168.3.255')
+
+        self.assertEqual(1014, len(ranges))
+        self.assertIn('192.168.2.1', ranges)
+        self.assertNotIn('192.168.0.9', ranges)
+
+    def test_mixed_families(self):
+        ranges = ip.IPRanges(['10.0.0.1', 'fd00::1'])
+
+        self.assertIn('10.0.0.1', ranges)
+        self.assertIn('fd00::1', ranges)
+        self.assertNotIn('::1', ranges)
+        self.assertEqual(set(['10.0.0.1', 'fd00::1']), set(ranges))
+
+    def test_invalid_address_not_contained(self):
+        self.assertNotIn('not-an-ip', ip.IPRanges(['10.0.0.1']))
+
+    def test_manager_copies_ranges(self):
+        ranges = ip.IPRanges()
+        ranges.add_range('192.168.0.0', '192.168.0.253')
+        manager = ip.IPManager(queues={'test': '192.168.0.0/24'},
+                               used_ips=ranges)
+
+        self.assertEqual('192.168.0.254', manager.get('test'))
+        self.assertNotIn('192.168.0.254', ranges)
+
+
+class TestAddressPermutation(unittest.TestCase):
+    def test_is_permutation(self):
+        for size in (1, 2, 3, 10, 254, 1000):
+            permutation = ip.AddressPermutation(size)
+            self.assertEqual(list(range(size)),
+                             sorted(permutation[i] for i in range(size)))
+
+    def test_keyed(self):
+        first = ip.AddressPermutation(1000, key=1)
+        second = ip.AddressPermutation(1000, key=1)
+
+        self.assertEqual([first[i] for i in range(10)],
+                         [second[i] for i in range(10)])
+
+    def test_large_range(self):
+        permutation = ip.AddressPermutation(2 ** 64)
+
+        self.assertTrue(0 <= permutation[0] < 2 ** 64)
+
+    def test_out_of_range(self):
+        with self.assertRaises(IndexError):
+            ip.AddressPermutation(10)[10]
+
+
 class TestIPManager(unittest.TestCase):
     def test_basic_instantiation(self):
         manager = ip.IPManager()
@@ -84,6 +189,36 @@ class TestIPManager(unittest.TestCase):
         self.assertNotEqual(['192.168.0.1', '192.168.0.2', '192.168.0.3'],
                             manager.queues['test'][0:3])
 
+    def test_queue_lists_allocation_order(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/24'})
+        expected = manager['test'][0:3]
+
+        self.assertEqual(expected, [manager.get('test') for _ in range(3)])
+
+    def test_released_ip_reused_after_walk(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/30'})
+        first = manager.get('test')
+        manager.get('test')
+        manager.release(first)
+
+        self.assertEqual(first, manager.get('test'))
+
+    def test_loading_large_network(self):
+        manager = ip.IPManager()
+        manager.load('test', '10.0.0.0/8')
+
+        self.assertEqual(2, len(manager.used))
+        self.assertTrue(manager.get('test').startswith('10.'))
+
+    def test_exhausting_queue(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/29'})
+        ips = set(manager.get('test') for _ in range(6))
+
+        self.assertEqual(6, len(ips))
+        self.assertEqual([], manager['test'])
+        with self.assertRaises(ip.EmptyQueue):
+            manager.get('test')
+
     def test_getting_ip(self):
         manager = ip.IPManager(queues={'test': '192.168.0.0/24'})
         my_ip = manager.get('test')
@@ -118,6 +253,256 @@ class TestIPManager(unittest.TestCase):
         self.assertNotIn(target_ip, manager.used)
         self.assertIn(target_ip, manager['test'])
 
+    def test_get_many(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/29'})
+        ips = manager.get_many('test', 6)
+
+        self.assertEqual(6, len(set(ips)))
+        self.assertEqual([], manager['test'])
+
+    def test_get_many_all_or_nothing(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/29'})
+        manager.get('test')
+
+        with self.assertRaises(ip.EmptyQueue):
+            manager.get_many('test', 6)
+
+        self.assertEqual(5, len(manager['test']))
+        self.assertEqual(3, len(manager.used))
+
+    def test_get_many_from_missing_queue(self):
+        manager = ip.IPManager()
+
+        with self.assertRaises(ip.NoSuchQueue):
+            manager.get_many('test', 1)
+
+    def test_get_many_owner_count_mismatch(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/29'})
+
+        with self.assertRaises(ValueError):
+            manager.get_many('test', 2, owners=['host1'])
+
+    def test_unknown_placement(self):
+        with self.assertRaises(ValueError):
+            ip.IPManager(placement='clustered')
+
+    def test_hashed_placement_reproducible(self):
+        owners = ['host{}'.format(i) for i in range(20)]
+        first = ip.IPManager(queues={'test': '192.168.0.0/24'},
+                             placement='hashed')
+        second = ip.IPManager(queues={'test': '192.168.0.0/24'},
+                              placement='hashed')
+
+        first_ips = [first.get('test', owner=o) for o in owners]
+        second_ips = second.get_many('test', len(owners), owners=owners)
+
+        self.assertEqual(first_ips, second_ips)
+
+    def test_hashed_placement_order_independent(self):
+        manager = ip.IPManager(queues={'test': '10.0.0.0/16'},
+                               placement='hashed')
+        other = ip.IPManager(queues={'test': '10.0.0.0/16'},
+                             placement='hashed')
+
+        first = manager.get('test', owner='host1')
+        other.get('test', owner='host2')
+
+        self.assertEqual(first, other.get('test', owner='host1'))
+
+    def test_hashed_placement_probes_collisions(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/29'},
+                               placement='hashed')
+        owners = ['host{}'.format(i) for i in range(6)]
+
+        ips = manager.get_many('test', 6, owners=owners)
+
+        self.assertEqual(6, len(set(ips)))
+        with self.assertRaises(ip.EmptyQueue):
+            manager.get('test', owner='host7')
+
+    def test_hashed_probe_wraps_to_last_free_address(self):
+        pool = ip._Pool(netaddr.IPNetwork('192.168.0.0/29'), key=1)
+        used = ip.IntervalSet([(pool.first, pool.last)])
+        used.discard(pool.first + pool.permutation[0])
+
+        for digest in range(pool.permutation.size):
+            self.assertEqual(pool.first + pool.permutation[0],
+                             pool.probe(used, digest))
+
+    def test_hashed_probe_does_not_count_used(self):
+        class UncountedSet(ip.IntervalSet):
+            def count(self, start, end):
+                raise AssertionError("probe counted the used addresses")
+
+        pool = ip._Pool(netaddr.IPNetwork('10.0.0.0/16'), key=1)
+
+        self.assertIsNotNone(pool.probe(UncountedSet(), 12345))
+
+    def test_hashed_probe_jumps_used_ranges(self):
+        pool = ip._Pool(netaddr.IPNetwork('10.0.0.0/8'), key=1)
+        used = ip.IntervalSet([(pool.first, pool.last - 1)])
+
+        self.assertEqual(pool.last, pool.probe(used, 12345))
+
+    def test_hashed_full_network_is_empty(self):
+        used_ips = ip.IPRanges()
+        used_ips.add_range('10.0.0.1', '10.255.255.254')
+        manager = ip.IPManager(queues={'test': '10.0.0.0/8'},
+                               used_ips=used_ips, placement='hashed')
+
+        with self.assertRaises(ip.EmptyQueue):
+            manager.get('test', owner='host1')
+
+    def test_free_count_follows_allocations(self):
+        manager = ip.IPManager(queues={'outer': '192.168.0.0/24',
+                                       'inner': '192.168.0.0/29'},
+                               placement='hashed')
+        outer = manager._queues['outer']
+        inner = manager._queues['inner']
+        # The broadcast address of the inner network is used as well
+        self.assertEqual(253, outer.free_count(manager._used_ips))
+        self.assertEqual(6, inner.free_count(manager._used_ips))
+
+        addresses = manager.get_many('inner', 2, owners=['host1', 'host2'])
+        manager.release(addresses[0])
+        manager.release(addresses[0])
+
+        self.assertEqual(252, outer.free)
+        self.assertEqual(5, inner.free)
+        self.assertEqual(252, len(manager['outer']))
+
+    def test_hashed_placement_without_owner(self):
+        first = ip.IPManager(queues={'test': '192.168.0.0/24'},
+                             placement='hashed')
+        second = ip.IPManager(queues={'test': '192.168.0.0/24'},
+                              placement='hashed')
+
+        self.assertEqual(first.get('test'), second.get('test'))
+
+    def test_sequential_placement(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/24'},
+                               used_ips=['192.168.0.2'],
+                               placement='sequential')
+
+        ips = [manager.get('test') for _ in range(3)]
+        manager.release('192.168.0.3')
+
+        self.assertEqual(['192.168.0.1', '192.168.0.3', '192.168.0.4'], ips)
+        self.assertEqual('192.168.0.3', manager.get('test'))
+        self.assertEqual('192.168.0.5', manager['test'][0])
+
+    def test_ipv6_network_is_not_enumerated(self):
+        manager = ip.IPManager(queues={'test': 'fd00::/64'})
+
+        ips = manager.get_many('test', 100)
+
+        self.assertEqual(100, len(set(ips)))
+        for address in ips:
+            self.assertIn(netaddr.IPAddress(address),
+                          netaddr.IPNetwork('fd00::/64'))
+        self.assertEqual(101, len(manager.used))
+
+    def test_ipv6_has_no_broadcast(self):
+        manager = ip.IPManager(queues={'test': 'fd00::/126'})
+
+        self.assertEqual(['fd00::1', 'fd00::2', 'fd00::3'],
+                         sorted(manager['test']))
+
+    def test_ipv6_hashed_placement(self):
+        first = ip.IPManager(queues={'test': 'fd00::/48'},
+                             placement='hashed')
+        second = ip.IPManager(queues={'test': 'fd00::/48'},
+                              placement='hashed')
+
+        self.assertEqual(first.get('test', owner='host1'),
+                         second.get('test', owner='host1'))
+
+    def test_stats(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/24'},
+                               used_ips=['192.168.0.100'],
+                               placement='sequential')
+        manager.get_many('test', 10)
+
+        self.assertEqual({'cidr': '192.168.0.0/24',
+                          'total': 256,
+                          'reserved': 3,
+                          'allocated': 10,
+                          'free': 243,
+                          'largest_free_block': 154},
+                         manager.stats('test'))
+
+    def test_stats_mark_allocated(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/24'},
+                               used_ips=['192.168.0.1', '192.168.0.2'])
+        manager.mark_allocated(['192.168.0.2'])
+
+        stats = manager.stats('test')
+
+        self.assertEqual(3, stats['reserved'])
+        self.assertEqual(1, stats['allocated'])
+
+    def test_stats_release_reserved(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/24'},
+                               used_ips=['192.168.0.1'])
+        manager.release('192.168.0.1')
+
+        self.assertEqual(2, manager.stats('test')['reserved'])
+        self.assertEqual(254, manager.stats('test')['free'])
+
+    def test_stats_ipv6(self):
+        manager = ip.IPManager(queues={'test': 'fd00::/64'})
+        manager.get('test')
+
+        stats = manager.stats('test')
+
+        self.assertEqual(2 ** 64, stats['total'])
+        self.assertEqual(1, stats['reserved'])
+        self.assertEqual(2 ** 64 - 2, stats['free'])
+
+    def test_stats_missing_queue(self):
+        manager = ip.IPManager()
+        with self.assertRaises(ip.NoSuchQueue):
+            manager.stats('test')
+
+    def test_report(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/24',
+                                       'other': '10.0.0.0/30'})
+
+        report = manager.report()
+
+        self.assertEqual(set(['test', 'other']), set(report))
+        self.assertEqual(2, report['other']['free'])
+
+    def test_release_ip_to_owning_queue(self):
+        manager = ip.IPManager(queues={'small': '192.168.0.0/30',
+                                       'other': '10.0.0.0/24'})
+        target_ip = manager.get('small')
+
+        manager.release(target_ip)
+
+        self.assertEqual(1, len(manager._queues['small'].released))
+        self.assertEqual(0, len(manager._queues['other'].released))
+        self.assertEqual(target_ip, manager.get('small'))
+
+    def test_release_ip_to_nested_queues(self):
+        manager = ip.IPManager(queues={'outer': '192.168.0.0/16',
+                                       'inner': '192.168.1.0/24'},
+                               used_ips=['192.168.1.10'])
+
+        manager.release('192.168.1.10')
+
+        self.assertEqual(1, len(manager._queues['outer'].released))
+        self.assertEqual(1, len(manager._queues['inner'].released))
+
+    def test_reloading_queue(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/24'})
+        manager.load('test', '10.0.0.0/24')
+
+        self.assertEqual(['test'],
+                         manager._queues_for(ip._ip_to_int('10.0.0.5')))
+        self.assertEqual([],
+                         manager._queues_for(ip._ip_to_int('192.168.0.5')))
+
     def test_save_not_implemented(self):
         manager = ip.IPManager()
 
@@ -152,5 +537,378 @@ class TestIPManager(unittest.TestCase):
         self.assertIn(target_ip, manager['test'])
 
 
+class TestSQLiteIPManager(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'ipam.sqlite')
+        self.managers = []
+
+    def tearDown(self):
+        for manager in self.managers:
+            manager.close()
+        shutil.rmtree(self.tmpdir)
+
+    def manager(self, **kwargs):
+        manager = ip.SQLiteIPManager(path=self.path, **kwargs)
+        self.managers.append(manager)
+        return manager
+
+    def test_requires_path(self):
+        with self.assertRaises(ValueError):
+            ip.SQLiteIPManager()
+
+    def test_saved_allocations_are_used(self):
+        manager = self.manager(queues={'test': '192.168.0.0/24'})
+        address = manager.get('test', owner='host1')
+        manager.save()
+
+        reopened = self.manager(queues={'test': '192.168.0.0/24'})
+
+        self.assertIn(address, reopened.used)
+        self.assertNotIn(address, reopened['test'])
+
+    def test_unsaved_allocations_are_discarded(self):
+        manager = self.manager(queues={'test': '192.168.0.0/24'})
+        address = manager.get('test', owner='host1')
+        manager.close()
+        self.managers.remove(manager)
+
+        reopened = self.manager(queues={'test': '192.168.0.0/24'})
+
+        self.assertNotIn(address, reopened.used)
+        self.assertEqual({}, reopened.owned_by('host1'))
+
+    def test_owner_keeps_address(self):
+        manager = self.manager(queues={'test': '192.168.0.0/24'})
+        address = manager.get('test', owner='host1')
+
+        self.assertEqual(address, manager.get('test', owner='host1'))
+        self.assertNotEqual(address, manager.get('test', owner='host2'))
+
+    def test_owner_lookups(self):
+        manager = self.manager(queues={'test': '192.168.0.0/24',
+                                       'other': '10.0.0.0/24'})
+        address = manager.get('test', owner='host1')
+        other = manager.get('other', owner='host1')
+
+        self.assertEqual('host1', manager.owner(address))
+        self.assertEqual({'test': address, 'other': other},
+                         manager.owned_by('host1'))
+
+    def test_get_many_keeps_owned_addresses(self):
+        manager = self.manager(queues={'test': '192.168.0.0/24'})
+        address = manager.get('test', owner='host1')
+
+        addresses = manager.get_many('test', 2, owners=['host2', 'host1'])
+
+        self.assertEqual(address, addresses[1])
+        self.assertEqual('host2', manager.owner(addresses[0]))
+
+    def test_get_many_all_or_nothing(self):
+        manager = self.manager(queues={'test': '192.168.0.0/30'})
+
+        with self.assertRaises(ip.EmptyQueue):
+            manager.get_many('test', 3, owners=['host1', 'host2', 'host3'])
+
+        self.assertEqual({}, manager.owned_by('host1'))
+        self.assertEqual(2, len(manager['test']))
+
+    def test_release_removes_allocation(self):
+        manager = self.manager(queues={'test': '192.168.0.0/24'})
+        address = manager.get('test', owner='host1')
+        manager.release(address)
+        manager.save()
+
+        reopened = self.manager(queues={'test': '192.168.0.0/24'})
+
+        self.assertIsNone(reopened.owner(address))
+        self.assertNotIn(address, reopened.used)
+
+    def test_resized_queue_drops_outside_addresses(self):
+        manager = self.manager(queues={'test': '192.168.0.0/24'})
+        address = manager.get('test', owner='host1')
+        manager.save()
+
+        reopened = self.manager(queues={'test': '10.0.0.0/24'})
+
+        self.assertIsNone(reopened.owner(address))
+        self.assertNotIn(address, reopened.used)
+        self.assertIn(netaddr.IPAddress(reopened.get('test', owner='host1')),
+                      netaddr.IPNetwork('10.0.0.0/24'))
+
+    def test_reconcile_drops_absent_owners(self):
+        manager = self.manager(queues={'test': '192.168.0.0/24'})
+        kept = manager.get('test', owner='host1')
+        dropped = manager.get('test', owner='host2')
+        manager.save()
+
+        reopened = self.manager(queues={'test': '192.168.0.0/24'})
+        reopened.reconcile({'host1': {}})
+
+        self.assertEqual({'test': kept}, reopened.owned_by('host1'))
+        self.assertEqual({}, reopened.owned_by('host2'))
+        self.assertIn(kept, reopened.used)
+        self.assertNotIn(dropped, reopened.used)
+
+    def test_reconcile_keeps_used_ips(self):
+        manager = self.manager(queues={'test': '192.168.0.0/24'})
+        address = manager.get('test', owner='host1')
+        manager.save()
+
+        reopened = self.manager(queues={'test': '192.168.0.0/24'},
+                                used_ips=[address])
+        reopened.reconcile({})
+
+        self.assertIsNone(reopened.owner(address))
+        self.assertIn(address, reopened.used)
+
+    def test_reserved_recorded_address_dropped(self):
+        manager = self.manager(queues={'test': '192.168.0.0/24'})
+        address = manager.get('test', owner='host1')
+        manager.save()
+
+        reopened = self.manager(queues={'test': '192.168.0.0/24'},
+                                used_ips=[address])
+        new_address = reopened.get('test', owner='host1')
+
+        self.assertNotEqual(address, new_address)
+        self.assertIsNone(reopened.owner(address))
+        self.assertIn(address, reopened.used)
+
+    def test_address_held_by_other_host_dropped(self):
+        manager = self.manager(queues={'test': '192.168.0.0/24'})
+        address = manager.get('test', owner='host1')
+        manager.save()
+
+        reopened = self.manager(queues={'test': '192.168.0.0/24'})
+        reopened.mark_allocated([address])
+        reopened.reconcile({
+            'host1': {},
+            'host2': {'container_networks': {'net': {'address': address}}},
+        })
+
+        self.assertNotEqual(address, reopened.get('test', owner='host1'))
+        self.assertIsNone(reopened.owner(address))
+        self.assertIn(address, reopened.used)
+
+    def test_held_address_kept_by_its_owner(self):
+        manager = self.manager(queues={'test': '192.168.0.0/24'})
+        address = manager.get('test', owner='host1')
+        manager.save()
+
+        reopened = self.manager(queues={'test': '192.168.0.0/24'})
+        reopened.mark_allocated([address])
+        reopened.reconcile({
+            'host1': {'container_networks': {'net': {'address': address}}},
+        })
+
+        self.assertEqual(address, reopened.get('test', owner='host1'))
+
+    def test_hashed_placement(self):
+        manager = self.manager(queues={'test': '192.168.0.0/24'},
+                               placement='hashed')
+        expected = ip.IPManager(queues={'test': '192.168.0.0/24'},
+                                placement='hashed')
+
+        self.assertEqual(expected.get('test', owner='host1'),
+                         manager.get('test', owner='host1'))
+
+    def test_registered(self):
+        self.assertIs(ip.SQLiteIPManager, ip.get_plugin('sqlite'))
+
+
+class FakePlugin(ip.IPBasePlugin):
+    def __init__(self, queues=None, used_ips=None, **options):
+        self.queues = queues
+        self.used_ips = used_ips
+        self.options = options
+        self.owners = None
+
+    def reconcile(self, owners):
+        self.owners = owners
+
+
+class TestPlugins(unittest.TestCase):
+    def tearDown(self):
+        ip._PLUGINS.pop('fake', None)
+
+    def test_default_plugin(self):
+        self.assertIs(ip.IPManager, ip.get_plugin(ip.DEFAULT_PLUGIN))
+
+    def test_missing_plugin(self):
+        with self.assertRaises(ip.NoSuchPlugin):
+            ip.get_plugin('no-such-plugin')
+
+    def test_registered_plugin(self):
+        ip.register_plugin('fake', FakePlugin)
+
+        self.assertIs(FakePlugin, ip.get_plugin('fake'))
+
+    def test_context_creates_manager(self):
+        ip.register_plugin('fake', FakePlugin)
+        context = ip.AllocationContext.from_config(
+            {'plugin': 'fake', 'options': {'path': '/tmp/ipam'}}
+        )
+        context.used_ips.add('192.168.0.1')
+
+        manager = context.create_manager({'test': '192.168.0.0/24'})
+
+        self.assertIs(manager, context.manager)
+        self.assertEqual({'test': '192.168.0.0/24'}, manager.queues)
+        self.assertIn('192.168.0.1', manager.used_ips)
+        self.assertEqual({'path': '/tmp/ipam'}, manager.options)
+
+    def test_context_reconciles_owners(self):
+        ip.register_plugin('fake', FakePlugin)
+        context = ip.AllocationContext(plugin='fake')
+
+        manager = context.create_manager({}, owners={'host1': {}})
+
+        self.assertEqual({'host1': {}}, manager.owners)
+
+    def test_context_defaults(self):
+        context = ip.AllocationContext.from_config(None)
+        manager = context.create_manager({'test': '192.168.0.0/24'})
+
+        self.assertIsInstance(manager, ip.IPManager)
+
+    def test_context_marks_allocated(self):
+        context = ip.AllocationContext()
+        context.used_ips.add('192.168.0.1')
+        context.used_ips.add('192.168.0.2')
+        context.allocated_ips.add('192.168.0.2')
+
+        manager = context.create_manager({'test': '192.168.0.0/24'})
+
+        self.assertEqual(1, manager.stats('test')['allocated'])
+
+
+class SimplePlugin(ip.IPBasePlugin):
+    def __init__(self, addresses):
+        self.addresses = list(addresses)
+        self.released = []
+
+    def get(self, queue_name, owner=None):
+        if not self.addresses:
+            raise ip.EmptyQueue(queue_name)
+        return self.addresses.pop(0)
+
+    def release(self, ip):
+        self.released.append(ip)
+
+
+class OwnerlessPlugin(SimplePlugin):
+    """Plugin written before owners were passed to ``get``"""
+    def get(self, queue_name):
+        return super(OwnerlessPlugin, self).get(queue_name)
+
+
+class TestOwnerlessPlugin(unittest.TestCase):
+    def test_takes_owner(self):
+        self.assertTrue(ip._takes_owner(SimplePlugin([]).get))
+        self.assertFalse(ip._takes_owner(OwnerlessPlugin([]).get))
+
+    def test_get_ip_address(self):
+        plugin = OwnerlessPlugin(['10.0.0.1'])
+
+        self.assertEqual('10.0.0.1',
+                         ip.get_ip_address('test', plugin, owner='host1'))
+
+    def test_reservation(self):
+        plugin = OwnerlessPlugin(['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        reservation = ip.reserve_ip_addresses(plugin,
+                                              {'test': ['host1', 'host2']})
+
+        self.assertEqual('10.0.0.2', reservation.get('test', owner='host2'))
+        self.assertEqual('10.0.0.3', reservation.get('test', owner='host3'))
+
+
+class TestBasePluginGetMany(unittest.TestCase):
+    def test_get_many(self):
+        plugin = SimplePlugin(['10.0.0.1', '10.0.0.2'])
+
+        self.assertEqual(['10.0.0.1', '10.0.0.2'],
+                         plugin.get_many('test', 2))
+
+    def test_get_many_releases_on_failure(self):
+        plugin = SimplePlugin(['10.0.0.1', '10.0.0.2'])
+
+        with self.assertRaises(ip.EmptyQueue):
+            plugin.get_many('test', 3)
+
+        self.assertEqual(['10.0.0.1', '10.0.0.2'], plugin.released)
+
+
+class TestReservation(unittest.TestCase):
+    def test_addresses_follow_owner(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/24'})
+        reservation = ip.reserve_ip_addresses(
+            manager, {'test': ['host1', 'host2']}
+        )
+        expected = reservation._reserved['test']['host2'][0]
+
+        self.assertEqual(expected, reservation.get('test', owner='host2'))
+
+    def test_unreserved_requests_fall_back(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/24'})
+        reservation = ip.reserve_ip_addresses(manager, {})
+
+        self.assertTrue(reservation.get('test').startswith('192.168.0.'))
+        with self.assertRaises(ip.NoSuchQueue):
+            reservation.get(None)
+
+    def test_other_reservations_not_taken(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/24'})
+        reservation = ip.reserve_ip_addresses(manager, {'test': ['host1']})
+        reserved = reservation._reserved['test']['host1'][0]
+
+        self.assertNotEqual(reserved, reservation.get('test', owner='host2'))
+        self.assertNotEqual(reserved, reservation.get('test'))
+        self.assertEqual(reserved, reservation.get('test', owner='host1'))
+
+    def test_missing_queues_ignored(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/24'})
+        reservation = ip.reserve_ip_addresses(manager, {None: ['host1']})
+
+        self.assertEqual({}, reservation._reserved)
+
+    def test_release_unused(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/30'})
+        reservation = ip.reserve_ip_addresses(
+            manager, {'test': ['host1', 'host2']}
+        )
+        reservation.get('test', owner='host1')
+        reservation.release_unused()
+
+        self.assertEqual(1, len(manager['test']))
+
+    def test_exhausted_queue_rolls_back_run(self):
+        manager = ip.IPManager(queues={'big': '10.0.0.0/24',
+                                       'small': '192.168.0.0/30'})
+        owners = collections.OrderedDict([
+            ('big', ['host1', 'host2', 'host3']),
+            ('small', ['host1', 'host2', 'host3']),
+        ])
+
+        with self.assertRaises(SystemExit):
+            ip.reserve_ip_addresses(manager, owners)
+
+        self.assertEqual(254, len(manager['big']))
+        self.assertEqual(2, len(manager['small']))
+
+
+class TestGetIPAddress(unittest.TestCase):
+    def test_missing_manager(self):
+        self.assertIsNone(ip.get_ip_address('test', None))
+
+    def test_missing_queue(self):
+        self.assertIsNone(ip.get_ip_address('test', ip.IPManager()))
+
+    def test_getting_address(self):
+        manager = ip.IPManager(queues={'test': '192.168.0.0/30'})
+
+        self.assertTrue(ip.get_ip_address('test', manager).startswith('192'))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import mock
+import os
+from os import path
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from test_inventory import cleanup
+from test_inventory import make_config
+
+INV_DIR = 'playbooks/inventory'
+
+sys.path.append(path.join(os.getcwd(), INV_DIR))
+
+from osa_toolkit import client
+import dynamic_inventory
+from osa_toolkit import server
+
+TARGET_DIR = path.join(os.getcwd(), 'tests', 'inventory')
+USER_CONFIG_FILE = path.join(TARGET_DIR, 'openstack_user_config.yml')
+
+
+def setUpModule():
+    # The setUpModule function is used by the unittest framework.
+    make_config()
+
+
+def tearDownModule():
+    # This file should only be removed after all tests are run,
+    # thus it is excluded from cleanup.
+    os.remove(USER_CONFIG_FILE)
+
+
+class TestInventoryServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(cleanup)
+        self.socket_path = path.join(self.tmpdir, 'inventory.sock')
+
+        self.inventory = server.InventoryState(config=TARGET_DIR,
+                                               environment=INV_DIR)
+        self.server = server.InventoryServer(self.socket_path,
+                                             self.inventory)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def request(self, command):
+        return client.request(command, self.socket_path)
+
+    def test_list(self):
+        inventory = json.loads(self.request('list'))
+
+        self.assertIn('aio1', inventory['_meta']['hostvars'])
+
+    def test_host(self):
+        inventory = json.loads(self.request('list'))
+
+        host_vars = json.loads(self.request('host aio1'))
+
+        self.assertEqual(inventory['_meta']['hostvars']['aio1'], host_vars)
+
+    def test_unknown_host(self):
+        self.assertEqual('{}', self.request('host missing'))
+
+    def test_unchanged_inputs_not_regenerated(self):
+        self.request('list')
+
+        with mock.patch('osa_toolkit.generate.main') as main_mock:
+            self.request('list')
+
+        self.assertFalse(main_mock.called)
+
+    def test_changed_config_regenerated(self):
+        self.request('list')
+        with open(USER_CONFIG_FILE) as f:
+            original = f.read()
+        self.addCleanup(self.write_user_config, original)
+        self.write_user_config(
+            original + '\ncompute_hosts:\n  compute9:\n'
+            '    ip: 172.29.236.109\n'
+        )
+
+        inventory = json.loads(self.request('list'))
+
+        self.assertIn('compute9', inventory['compute_hosts']['hosts'])
+
+    def test_unknown_command(self):
+        with self.assertRaises(client.ServerError) as context:
+            self.request('remove aio1')
+
+        self.assertIn("Unknown command 'remove'", str(context.exception))
+
+    def test_generation_error(self):
+        with mock.patch('osa_toolkit.generate.main') as main_mock:
+            main_mock.side_effect = SystemExit('bad configuration')
+            with self.assertRaises(client.ServerError) as context:
+                self.request('list')
+
+        self.assertEqual('bad configuration', str(context.exception))
+
+    def test_second_server_refused(self):
+        with self.assertRaises(SystemExit):
+            server.InventoryServer(self.socket_path, self.inventory)
+
+    def test_checked_paths(self):
+        body = client.request('list', self.socket_path, config=TARGET_DIR,
+                              environment=INV_DIR)
+
+        self.assertIn('aio1', json.loads(body)['_meta']['hostvars'])
+
+    def test_other_config_refused(self):
+        with self.assertRaises(client.ServerMismatch):
+            client.request('list', self.socket_path, config=self.tmpdir)
+
+    def test_other_environment_refused(self):
+        with self.assertRaises(client.ServerMismatch):
+            client.request('list', self.socket_path, config=TARGET_DIR,
+                           environment=self.tmpdir)
+
+    def test_dynamic_inventory_client(self):
+        all_args = dynamic_inventory.args(['--host', 'aio1',
+                                           '--config', TARGET_DIR])
+
+        with mock.patch.dict(os.environ,
+                             {client.SOCKET_ENV_VAR: self.socket_path}):
+            host_vars = json.loads(dynamic_inventory.from_server(all_args))
+
+        self.assertEqual('aio1', host_vars['container_name'])
+
+    def test_dynamic_inventory_other_environment(self):
+        all_args = dynamic_inventory.args(['--list', '--config', TARGET_DIR,
+                                           '--environment', self.tmpdir])
+
+        with mock.patch.dict(os.environ,
+                             {client.SOCKET_ENV_VAR: self.socket_path}):
+            self.assertIsNone(dynamic_inventory.from_server(all_args))
+
+    def write_user_config(self, content):
+        with open(USER_CONFIG_FILE, 'w') as f:
+            f.write(content)
+
+
+class TestClient(unittest.TestCase):
+    def test_socket_path_in_config_dir(self):
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual('/etc/openstack_deploy/openstack_inventory.sock',
+                             client.socket_path())
+
+    def test_socket_path_from_environment(self):
+        with mock.patch.dict(os.environ,
+                             {client.SOCKET_ENV_VAR: '/run/inv.sock'}):
+            self.assertEqual('/run/inv.sock', client.socket_path('/etc/x'))
+
+    def test_missing_server(self):
+        with self.assertRaises(client.ServerUnavailable):
+            client.request('list', '/nonexistent/inventory.sock')
+
+    def test_stale_socket(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        stale = path.join(tmpdir, 'inventory.sock')
+        with open(stale, 'w'):
+            pass
+
+        with self.assertRaises(client.ServerUnavailable):
+            client.request('list', stale)
+
+    def test_dynamic_inventory_falls_back(self):
+        all_args = dynamic_inventory.args(['--list'])
+
+        with mock.patch.dict(os.environ,
+                             {client.SOCKET_ENV_VAR: '/nonexistent.sock'}):
+            self.assertIsNone(dynamic_inventory.from_server(all_args))
+
+    def test_check_mode_not_sent(self):
+        all_args = dynamic_inventory.args(['--check'])
+
+        with mock.patch('osa_toolkit.client.request') as request_mock:
+            self.assertIsNone(dynamic_inventory.from_server(all_args))
+
+        self.assertFalse(request_mock.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import os
+from os import path
+import sys
+import unittest
+
+INV_DIR = 'playbooks/inventory'
+
+sys.path.append(path.join(os.getcwd(), INV_DIR))
+
+from osa_toolkit import filesystem as fs
+from osa_toolkit import skeleton as sk
+
+
+def make_environment():
+    environment = collections.OrderedDict()
+    environment['physical_skel'] = collections.OrderedDict([
+        ('shared-infra_containers', {'belongs_to': ['all_containers']}),
+        ('shared-infra_hosts', {'belongs_to': ['hosts']}),
+    ])
+    environment['component_skel'] = collections.OrderedDict([
+        ('galera', {'belongs_to': ['galera_all']}),
+    ])
+    environment['container_skel'] = collections.OrderedDict([
+        ('galera_container', {
+            'belongs_to': ['shared-infra_containers'],
+            'contains': ['galera'],
+            'properties': {'service_name': 'galera'}
+        }),
+        ('empty_container', {}),
+    ])
+    return environment
+
+
+class TestSkeleton(unittest.TestCase):
+    def setUp(self):
+        self.skeleton = sk.Skeleton.compile(make_environment())
+
+    def test_groups_in_creation_order(self):
+        self.assertEqual([
+            ('shared-infra_containers', True),
+            ('all_containers', True),
+            ('shared-infra_hosts', True),
+            ('hosts', True),
+            ('galera', True),
+            ('galera_all', True),
+            ('galera_container', False),
+            ('empty_container', False),
+        ], self.skeleton.groups)
+
+    def test_edges(self):
+        self.assertEqual([
+            ('all_containers', 'shared-infra_containers'),
+            ('hosts', 'shared-infra_hosts'),
+            ('galera_all', 'galera'),
+        ], self.skeleton.edges)
+
+    def test_containers(self):
+        self.assertEqual([
+            ('galera', 'galera_container', 'shared-infra_containers',
+             {'service_name': 'galera'}),
+        ], self.skeleton.containers)
+
+    def test_children(self):
+        self.assertEqual({
+            'all_containers': ['shared-infra_containers'],
+            'hosts': ['shared-infra_hosts'],
+            'galera_all': ['galera'],
+        }, self.skeleton.children)
+
+    def test_shipped_environment(self):
+        skeleton = sk.Skeleton.compile(fs.load_environment(INV_DIR, {}))
+
+        self.assertIn('compute_hosts', skeleton.children['hosts'])
+
+    def test_cycle(self):
+        environment = make_environment()
+        environment['physical_skel']['hosts'] = {
+            'belongs_to': ['shared-infra_hosts']
+        }
+
+        with self.assertRaises(sk.SkeletonCycleError) as context:
+            sk.Skeleton.compile(environment)
+
+        self.assertEqual(
+            ['shared-infra_hosts', 'hosts', 'shared-infra_hosts'],
+            context.exception.groups
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import mock
+import os
+from os import path
+import shutil
+import sys
+import tempfile
+import unittest
+
+from test_inventory import cleanup
+from test_inventory import get_inventory
+from test_inventory import make_config
+
+INV_DIR = 'playbooks/inventory'
+
+sys.path.append(path.join(os.getcwd(), INV_DIR))
+
+import dynamic_inventory
+from osa_toolkit import timing
+
+TARGET_DIR = path.join(os.getcwd(), 'tests', 'inventory')
+USER_CONFIG_FILE = path.join(TARGET_DIR, 'openstack_user_config.yml')
+
+
+def setUpModule():
+    # The setUpModule function is used by the unittest framework.
+    make_config()
+
+
+def tearDownModule():
+    # This file should only be removed after all tests are run,
+    # thus it is excluded from cleanup.
+    os.remove(USER_CONFIG_FILE)
+
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        self.profile = timing.Profile()
+
+    def test_phases_accumulate_in_order(self):
+        with mock.patch('osa_toolkit.timing.time.time',
+                        side_effect=[0.0, 1.0, 1.0, 3.0, 3.0, 3.5]):
+            with self.profile.phase('load'):
+                pass
+            with self.profile.phase('write'):
+                pass
+            with self.profile.phase('load'):
+                pass
+
+        self.assertEqual([{'name': 'load', 'seconds': 1.5},
+                          {'name': 'write', 'seconds': 2.0}],
+                         self.profile.report()['phases'])
+
+    def test_phase_timed_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.profile.phase('load'):
+                raise ValueError()
+
+        self.assertIn('load', self.profile.phases)
+
+    def test_counters(self):
+        self.profile.count('hosts', 3)
+        self.profile.count('hosts')
+
+        self.assertEqual({'hosts': 4}, self.profile.report()['counters'])
+
+    def test_prometheus(self):
+        self.profile.phases['load'] = 0.5
+        self.profile._order.append('load')
+        self.profile.count('hosts', 3)
+
+        lines = self.profile.to_prometheus().splitlines()
+
+        self.assertIn('osa_inventory_phase_seconds{phase="load"} 0.5', lines)
+        self.assertIn('# TYPE osa_inventory_hosts gauge', lines)
+        self.assertIn('osa_inventory_hosts 3', lines)
+
+    def test_save(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        report_file = path.join(tmpdir, 'profile.json')
+        self.profile.count('hosts')
+
+        self.profile.save(report_file)
+
+        with open(report_file) as f:
+            self.assertEqual(self.profile.report(), json.load(f))
+        self.assertEqual(['profile.json'], os.listdir(tmpdir))
+
+
+class TestProfiling(unittest.TestCase):
+    def tearDown(self):
+        cleanup()
+
+    def test_disabled_by_default(self):
+        with timing.phase('load'):
+            timing.count('hosts')
+
+        profile = timing.Profile()
+        with timing.profiling(profile):
+            pass
+        self.assertEqual({'phases': [], 'counters': {}}, profile.report())
+
+    def test_previous_profile_restored(self):
+        outer = timing.Profile()
+        inner = timing.Profile()
+
+        with timing.profiling(outer):
+            with timing.profiling(inner):
+                timing.count('hosts')
+            timing.count('files_parsed')
+
+        self.assertEqual({'hosts': 1}, inner.counters)
+        self.assertEqual({'files_parsed': 1}, outer.counters)
+
+    def test_inventory_run(self):
+        with timing.profiling(timing.Profile()) as profile:
+            inventory = get_inventory()
+
+        hostvars = inventory['_meta']['hostvars']
+        self.assertEqual(len(hostvars), profile.counters['hosts'])
+        containers = [host for host, host_vars in hostvars.items()
+                      if host_vars['physical_host'] != host]
+        self.assertEqual(len(containers),
+                         profile.counters['containers_created'])
+        self.assertGreater(profile.counters['ips_allocated'], 0)
+        self.assertGreater(profile.counters['files_parsed'], 1)
+        for name in ('load_config', 'load_environment', 'containers',
+                     'networks', 'write_inventory'):
+            self.assertIn(name, profile.phases)
+
+
+class TestProfileArgs(unittest.TestCase):
+    def tearDown(self):
+        cleanup()
+
+    def test_generate_output_saves_report(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        report_file = path.join(tmpdir, 'profile.prom')
+        all_args = dynamic_inventory.args([
+            '--config', TARGET_DIR,
+            '--environment', INV_DIR,
+            '--profile', report_file,
+            '--profile-format', 'prometheus'
+        ])
+
+        output = dynamic_inventory.generate_output(all_args)
+
+        self.assertIn('aio1', json.loads(output)['_meta']['hostvars'])
+        with open(report_file) as f:
+            report = f.read().splitlines()
+        self.assertIn('# TYPE osa_inventory_hosts gauge', report)
+
+    def test_profile_args(self):
+        all_args = dynamic_inventory.args(['--profile', '/tmp/profile.prom',
+                                           '--profile-format', 'prometheus'])
+
+        self.assertEqual('/tmp/profile.prom', all_args['profile'])
+        self.assertEqual('prometheus', all_args['profile_format'])
+
+    def test_profiled_run_not_sent_to_server(self):
+        all_args = dynamic_inventory.args(['--profile', '/tmp/profile.json'])
+
+        with mock.patch('osa_toolkit.client.request') as request_mock:
+            self.assertIsNone(dynamic_inventory.from_server(all_args))
+
+        self.assertFalse(request_mock.called)
+
+
+if __name__ == '__main__':
+    unittest.main()